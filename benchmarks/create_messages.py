@@ -0,0 +1,87 @@
+import time
+from typing import Optional
+
+import fire
+import rich
+from rich.table import Table
+
+from diffusion_prompt_upsampling.dspy_multi_modal import DSPyOpenAIMultiModalLM
+from diffusion_prompt_upsampling.image_transport import ImageTransport
+from diffusion_prompt_upsampling.utils import find_base64_images
+
+from image_transport import make_benchmark_image
+
+
+def create_messages_with_replace(prompt: str, system_prompt: str):
+    # The previous implementation of `DSPyOpenAIMultiModalLM.create_messages`,
+    # kept as the baseline for this benchmark
+    images = find_base64_images(prompt)
+    for image in images:
+        prompt = prompt.replace(image, "")
+    user_prompt = [{"type": "text", "text": prompt}]
+    for image in images:
+        user_prompt.append({"type": "image_url", "image_url": {"url": image}})
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def time_function(fn, num_iterations: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(num_iterations):
+        fn()
+    return (time.perf_counter() - start_time) / num_iterations
+
+
+def benchmark_create_messages(
+    image_size: Optional[int] = 1024,
+    max_num_images: Optional[int] = 8,
+    num_iterations: Optional[int] = 20,
+):
+    lm = DSPyOpenAIMultiModalLM(api_key="benchmark", system_prompt="Judge the images.")
+    create_messages = lm.create_messages.resolve_fn
+    image_url = ImageTransport(kind="png").encode(make_benchmark_image(image_size))
+    table = Table(title=f"create_messages ({image_size}px PNG images)")
+    for column in [
+        "images",
+        "prompt (MB)",
+        "replace (ms)",
+        "inline (ms)",
+        "handles (ms)",
+    ]:
+        table.add_column(column)
+    num_images = 1
+    while num_images <= max_num_images:
+        inline_prompt = "".join(
+            f"Base prompt {idx}: a photo of a cat\nImage {idx}: {image_url}\n"
+            for idx in range(num_images)
+        )
+        handle_prompt = "".join(
+            f"Base prompt {idx}: a photo of a cat\n"
+            f"Image {idx}: {lm.register_image(image_url)}\n"
+            for idx in range(num_images)
+        )
+        replace_time = time_function(
+            lambda: create_messages_with_replace(inline_prompt, lm.system_prompt),
+            num_iterations,
+        )
+        inline_time = time_function(
+            lambda: create_messages(lm, inline_prompt), num_iterations
+        )
+        handle_time = time_function(
+            lambda: create_messages(lm, handle_prompt), num_iterations
+        )
+        table.add_row(
+            str(num_images),
+            f"{len(inline_prompt) / 1e6:.2f}",
+            f"{replace_time * 1000:.2f}",
+            f"{inline_time * 1000:.2f}",
+            f"{handle_time * 1000:.2f}",
+        )
+        num_images *= 2
+    rich.print(table)
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_create_messages)
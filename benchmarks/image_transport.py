@@ -0,0 +1,62 @@
+import tempfile
+import time
+from typing import Optional
+
+import fire
+import numpy as np
+import rich
+from PIL import Image
+from rich.table import Table
+
+from diffusion_prompt_upsampling.image_transport import ImageTransport
+
+
+def make_benchmark_image(image_size: int) -> Image.Image:
+    # A smooth gradient with some noise, which compresses roughly like a generated
+    # image rather than like a flat color or pure noise
+    x, y = np.meshgrid(np.linspace(0, 1, image_size), np.linspace(0, 1, image_size))
+    gradient = np.stack([x, y, (x + y) / 2], axis=-1) * 255
+    noise = np.random.default_rng(0).normal(0, 8, gradient.shape)
+    return Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8))
+
+
+def benchmark_image_transport(
+    image_path: Optional[str] = None,
+    image_size: Optional[int] = 1024,
+    num_iterations: Optional[int] = 10,
+    judge_max_size: Optional[int] = 512,
+    quality: Optional[int] = 85,
+):
+    image = (
+        Image.open(image_path).convert("RGB")
+        if image_path is not None
+        else make_benchmark_image(image_size)
+    )
+    store_dir = tempfile.mkdtemp()
+    transports = {
+        "png": ImageTransport(kind="png"),
+        f"jpeg (q={quality})": ImageTransport(kind="jpeg", quality=quality),
+        f"webp (q={quality})": ImageTransport(kind="webp", quality=quality),
+        f"jpeg (q={quality}, {judge_max_size}px)": ImageTransport(
+            kind="jpeg", quality=quality, max_size=judge_max_size
+        ),
+        "raw": ImageTransport(kind="raw"),
+        "blob": ImageTransport(kind="blob", store_dir=store_dir),
+    }
+    table = Table(title=f"Image transport ({image.size[0]}x{image.size[1]})")
+    for column in ["transport", "encode (ms)", "payload (KB)"]:
+        table.add_column(column)
+    for name, transport in transports.items():
+        start_time = time.perf_counter()
+        for _ in range(num_iterations):
+            payload = transport.encode(image)
+        encode_time = (time.perf_counter() - start_time) / num_iterations
+        payload_size = (
+            len(image.tobytes()) if isinstance(payload, Image.Image) else len(payload)
+        )
+        table.add_row(name, f"{encode_time * 1000:.2f}", f"{payload_size / 1024:.1f}")
+    rich.print(table)
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_image_transport)
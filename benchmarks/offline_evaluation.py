@@ -0,0 +1,282 @@
+import asyncio
+import functools
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+import fire
+import rich
+import weave
+from rich.table import Table
+
+from diffusion_prompt_upsampling.cascade import CascadeJudgeModel
+from diffusion_prompt_upsampling.deduplication import DeduplicatedEvaluation
+from diffusion_prompt_upsampling.diffusion_model import (
+    UPSAMPLER_SYSTEM_PROMPT,
+    StableDiffusionXLModel,
+)
+from diffusion_prompt_upsampling.evaluation_log import ResumableEvaluation
+from diffusion_prompt_upsampling.image_transport import ImageTransport
+from diffusion_prompt_upsampling.judge_model import (
+    JUDGE_SYSTEM_PROMPT,
+    OpenAIJudgeModel,
+)
+from diffusion_prompt_upsampling.pipelined_evaluation import PipelinedEvaluation
+from diffusion_prompt_upsampling.profiling import enable_profiling
+from diffusion_prompt_upsampling.sharded_evaluation import ShardedEvaluation
+from diffusion_prompt_upsampling.usage import (
+    BudgetExceededError,
+    get_usage_tracker,
+    track_usage,
+)
+
+from stubs import ReplayMultiModalLM, TinyDiffusionPipeline
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_drawbench_fixture(num_rows: int):
+    with open(os.path.join(FIXTURES_DIR, "drawbench.jsonl")) as f:
+        rows = [json.loads(line) for line in f]
+    return [rows[idx % len(rows)] for idx in range(num_rows)]
+
+
+def compare_results(results: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    table = Table(title=f"Comparison with {baseline_path}")
+    for column in ["metric", "baseline", "current", "ratio"]:
+        table.add_column(column)
+    metrics = {"rows_per_second": lambda r: r["rows_per_second"]}
+    for stage in results["profile"]["stages"]:
+        metrics[f"{stage} p50"] = lambda r, stage=stage: r["profile"]["stages"][stage][
+            "p50"
+        ]
+    for name, get_metric in metrics.items():
+        try:
+            baseline_value, current_value = get_metric(baseline), get_metric(results)
+        except KeyError:
+            continue
+        table.add_row(
+            name,
+            f"{baseline_value:.4f}",
+            f"{current_value:.4f}",
+            f"{current_value / baseline_value:.2f}x" if baseline_value else "-",
+        )
+    rich.print(table)
+
+
+def build_offline_judge(
+    recorded_responses: dict,
+    llm_latency: float,
+    judge_batch_size: int = 1,
+    judge_image_max_size: Optional[int] = None,
+    cascade_audit_fraction: Optional[float] = None,
+):
+    judge_model = OpenAIJudgeModel(
+        judgement_llm=ReplayMultiModalLM(
+            recorded_responses["judge"],
+            latency=llm_latency,
+            model="gpt-4o",
+            system_prompt=JUDGE_SYSTEM_PROMPT,
+            stage="judge",
+        ),
+        batch_size=judge_batch_size,
+        batch_image_max_size=judge_image_max_size,
+    )
+    if cascade_audit_fraction is None:
+        return judge_model
+    return CascadeJudgeModel(judge_model, audit_fraction=cascade_audit_fraction)
+
+
+def build_offline_evaluation(
+    device: str,
+    num_rows: int,
+    upsample_prompt: bool,
+    llm_latency: float,
+    num_inference_steps: int,
+    image_size: int,
+    batch_size: int,
+    image_transport: str,
+    upsample_batch_size: int = 1,
+    judge_batch_size: int = 1,
+    judge_image_max_size: Optional[int] = None,
+    num_few_shot_examples: Optional[int] = None,
+    blank_image_fraction: float = 0.0,
+    cascade_audit_fraction: Optional[float] = None,
+    usage_kwargs: Optional[dict] = None,
+    judge_model=None,
+):
+    if usage_kwargs is not None:
+        track_usage(**usage_kwargs)
+    with open(os.path.join(FIXTURES_DIR, "recorded_responses.json")) as f:
+        recorded_responses = json.load(f)
+    diffusion_model = StableDiffusionXLModel(
+        model_name_or_path="tiny-diffusion-pipeline",
+        enable_cpu_offfload=False,
+        upsample_prompt=upsample_prompt,
+        batch_size=batch_size,
+        upsample_batch_size=upsample_batch_size,
+        num_few_shot_examples=num_few_shot_examples,
+        pipeline=TinyDiffusionPipeline(blank_fraction=blank_image_fraction).to(device),
+        image_transport=ImageTransport(kind=image_transport),
+        upsampler_llm=ReplayMultiModalLM(
+            recorded_responses["upsampler"],
+            latency=llm_latency,
+            model="gpt-4",
+            system_prompt=UPSAMPLER_SYSTEM_PROMPT,
+            stage="upsampler",
+        ),
+    )
+    # Judges are built in every shard worker unless one is given
+    if judge_model is None:
+        judge_model = build_offline_judge(
+            recorded_responses,
+            llm_latency,
+            judge_batch_size=judge_batch_size,
+            judge_image_max_size=judge_image_max_size,
+            cascade_audit_fraction=cascade_audit_fraction,
+        )
+    rows = [
+        {
+            **row,
+            "num_inference_steps": num_inference_steps,
+            "image_size": image_size,
+        }
+        for row in load_drawbench_fixture(num_rows)
+    ]
+    evaluation = weave.Evaluation(dataset=rows, scorers=[judge_model.score])
+    return evaluation, diffusion_model
+
+
+def benchmark_offline_evaluation(
+    num_rows: Optional[int] = 32,
+    upsample_prompt: Optional[bool] = True,
+    llm_latency: Optional[float] = 0.05,
+    num_inference_steps: Optional[int] = 4,
+    image_size: Optional[int] = 256,
+    batch_size: Optional[int] = 1,
+    upsample_batch_size: Optional[int] = 1,
+    judge_batch_size: Optional[int] = 1,
+    judge_image_max_size: Optional[int] = None,
+    num_few_shot_examples: Optional[int] = None,
+    blank_image_fraction: Optional[float] = 0.0,
+    cascade: Optional[bool] = False,
+    cascade_audit_fraction: Optional[float] = 0.1,
+    budget_tokens: Optional[int] = None,
+    budget_cost: Optional[float] = None,
+    budget_window_seconds: Optional[float] = None,
+    on_budget_exceeded: Optional[str] = "stop",
+    usage_log_path: Optional[str] = None,
+    image_transport: Optional[str] = "png",
+    pipelined: Optional[bool] = False,
+    deduplicate: Optional[bool] = False,
+    num_shards: Optional[int] = 1,
+    results_log_path: Optional[str] = None,
+    output_path: Optional[str] = None,
+    compare_with: Optional[str] = None,
+):
+    build_kwargs = {
+        "num_rows": num_rows,
+        "upsample_prompt": upsample_prompt,
+        "llm_latency": llm_latency,
+        "num_inference_steps": num_inference_steps,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "upsample_batch_size": upsample_batch_size,
+        "judge_batch_size": judge_batch_size,
+        "judge_image_max_size": judge_image_max_size,
+        "num_few_shot_examples": num_few_shot_examples,
+        "blank_image_fraction": blank_image_fraction,
+        "cascade_audit_fraction": cascade_audit_fraction if cascade else None,
+        "image_transport": image_transport,
+        "usage_kwargs": {
+            "max_tokens": budget_tokens,
+            "max_cost": budget_cost,
+            "window_seconds": budget_window_seconds,
+            "on_budget_exceeded": on_budget_exceeded,
+            "log_path": usage_log_path,
+        },
+    }
+    with open(os.path.join(FIXTURES_DIR, "recorded_responses.json")) as f:
+        judge_model = build_offline_judge(
+            json.load(f),
+            llm_latency,
+            judge_batch_size=judge_batch_size,
+            judge_image_max_size=judge_image_max_size,
+            cascade_audit_fraction=build_kwargs["cascade_audit_fraction"],
+        )
+    evaluation, diffusion_model = build_offline_evaluation(
+        "cpu", **build_kwargs, judge_model=judge_model
+    )
+    profiler = enable_profiling()
+    start_time = time.perf_counter()
+    # Running out of budget stops the evaluation, and a resumable run picks up
+    # from its log once the budget allows it
+    try:
+        if num_shards > 1:
+            with tempfile.TemporaryDirectory() as results_dir:
+                sharded_evaluation = ShardedEvaluation(
+                    functools.partial(build_offline_evaluation, **build_kwargs),
+                    num_shards=num_shards,
+                    results_path=results_log_path
+                    or os.path.join(results_dir, "results.jsonl"),
+                )
+                summary = sharded_evaluation.run()
+        elif pipelined:
+            pipelined_evaluation = PipelinedEvaluation(
+                evaluation, log_path=results_log_path
+            )
+            summary = asyncio.run(pipelined_evaluation.evaluate(diffusion_model))
+        elif deduplicate:
+            # Rows past the end of the fixture repeat it, so they are all duplicates
+            deduplicated_evaluation = DeduplicatedEvaluation(
+                evaluation, log_path=results_log_path
+            )
+            summary = asyncio.run(
+                deduplicated_evaluation.evaluate(diffusion_model.predict)
+            )
+            rich.print(f"{deduplicated_evaluation.savings=}")
+        elif results_log_path is not None:
+            resumable_evaluation = ResumableEvaluation(evaluation, results_log_path)
+            summary = asyncio.run(
+                resumable_evaluation.evaluate(diffusion_model.predict)
+            )
+        else:
+            summary = asyncio.run(evaluation.evaluate(diffusion_model.predict))
+    except BudgetExceededError as e:
+        rich.print(f"Evaluation stopped: {e}")
+        summary = None
+    wall_time = time.perf_counter() - start_time
+
+    results = {
+        "config": {
+            **build_kwargs,
+            "pipelined": pipelined,
+            "deduplicate": deduplicate,
+            "num_shards": num_shards,
+        },
+        "wall_time": wall_time,
+        "rows_per_second": num_rows / wall_time,
+        "summary": summary,
+        "profile": profiler.summary(),
+        "usage": get_usage_tracker().summary(),
+    }
+    if isinstance(judge_model, CascadeJudgeModel):
+        # Sharded runs judge in the workers, whose reports are not collected
+        results["cascade"] = judge_model.get_agreement_report()
+        rich.print(f"{results['cascade']=}")
+    profiler.print_summary()
+    get_usage_tracker().print_summary()
+    rich.print(f"Rows per second: {results['rows_per_second']:.2f}")
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if compare_with is not None:
+        compare_results(results, compare_with)
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_offline_evaluation)
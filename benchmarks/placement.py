@@ -0,0 +1,81 @@
+import resource
+import tempfile
+import time
+from typing import Optional
+
+import fire
+import rich
+from rich.table import Table
+
+from stubs import build_tiny_sdxl_pipeline
+
+SDXL = "stabilityai/stable-diffusion-xl-base-1.0"
+
+
+def benchmark_placement(
+    num_inference_steps: Optional[int] = 2,
+    image_size: Optional[int] = 64,
+):
+    from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+    from diffusion_prompt_upsampling.pipeline_registry import clear_pipelines
+    from diffusion_prompt_upsampling.placement import (
+        describe_plan,
+        format_memory,
+        plan_placement,
+    )
+
+    # The plans SDXL gets on GPUs of various sizes, with 16 GiB of CPU memory
+    table = Table(title=f"Placement of {SDXL} at 1024x1024")
+    for column in ["free device memory", "strategy", "dtype", "estimated peak"]:
+        table.add_column(column)
+    for device_memory in [24, 12, 9, 6, 3, 0.5]:
+        plan = plan_placement(
+            SDXL,
+            device="cuda",
+            device_memory=int(device_memory * 1024**3),
+            cpu_memory=16 * 1024**3,
+        )
+        table.add_row(
+            f"{device_memory} GiB",
+            plan.strategy,
+            plan.dtype,
+            format_memory(plan.estimated_peak_memory),
+        )
+    rich.print(table)
+    rich.print(f"SDXL on this machine: {describe_plan(plan_placement(SDXL))}")
+
+    # A tiny SDXL pipeline loaded from disk by the default loader, placed by the
+    # policy for this machine, so that the CPU path is exercised end to end
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pipeline_dir = f"{tmp_dir}/tiny-sdxl"
+        build_tiny_sdxl_pipeline(tmp_dir).save_pretrained(pipeline_dir)
+        clear_pipelines()
+        model = StableDiffusionXLModel(
+            model_name_or_path=pipeline_dir,
+            placement_image_size=image_size,
+            disable_progress_bar=True,
+        )
+        start_time = time.perf_counter()
+        model.get_pipeline()
+        load_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        model.generate_image(
+            "a photo of a cat",
+            num_inference_steps=num_inference_steps,
+            image_size=image_size,
+            seed=0,
+        )
+        generation_time = time.perf_counter() - start_time
+        clear_pipelines()
+    rich.print(
+        f"Tiny SDXL on this machine: {describe_plan(model.get_placement_plan())}"
+    )
+    rich.print(
+        f"Loaded in {load_time:.2f}s, generated a {image_size}x{image_size} image "
+        f"in {generation_time:.2f}s, peak RSS "
+        f"{format_memory(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)}"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_placement)
@@ -0,0 +1,108 @@
+import json
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import fire
+import rich
+from rich.table import Table
+
+from stubs import TinyDiffusionPipeline
+
+HEAVY_MODULES = ["torch", "diffusers", "transformers", "dspy", "weave"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "import_time": time.perf_counter() - start_time,
+    "heavy_modules": [m for m in {heavy_modules} if m in sys.modules],
+}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    # Imports are measured in a fresh interpreter, as this one has already
+    # imported everything the benchmark needs
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            IMPORT_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_startup(
+    load_latency: Optional[float] = 2.0,
+    num_inference_steps: Optional[int] = 2,
+    image_size: Optional[int] = 64,
+):
+    from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+    from diffusion_prompt_upsampling.pipeline_registry import clear_pipelines
+    from diffusion_prompt_upsampling.placement import PlacementPlan
+
+    def load_tiny_pipeline(model_name_or_path: str, plan: PlacementPlan):
+        # Stands in for reading the SDXL weights from disk and moving them to
+        # the device, which is what the registry saves on every reuse
+        time.sleep(load_latency)
+        return TinyDiffusionPipeline()
+
+    table = Table(title="Startup latencies (seconds)")
+    for column in ["step", "latency", "notes"]:
+        table.add_column(column)
+
+    for module in [
+        "diffusion_prompt_upsampling",
+        "diffusion_prompt_upsampling.diffusion_model",
+    ]:
+        result = measure_import(module)
+        table.add_row(
+            f"import {module}",
+            f"{result['import_time']:.4f}",
+            f"loads {', '.join(result['heavy_modules']) or 'nothing heavy'}",
+        )
+
+    clear_pipelines()
+    variants = [
+        {"use_stock_negative_prompt": False},
+        {"use_stock_negative_prompt": True},
+        {"use_stock_negative_prompt": True, "upsample_prompt": True},
+    ]
+    for idx, variant in enumerate(variants):
+        start_time = time.perf_counter()
+        model = StableDiffusionXLModel(
+            model_name_or_path="tiny-diffusion-pipeline",
+            placement_strategy="cpu",
+            pipeline_loader=load_tiny_pipeline,
+            **variant,
+        )
+        construction_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        model.get_pipeline()
+        pipeline_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        model.generate_image(
+            "a photo of a cat",
+            num_inference_steps=num_inference_steps,
+            image_size=image_size,
+        )
+        generation_time = time.perf_counter() - start_time
+        table.add_row(f"variant {idx} construction", f"{construction_time:.4f}", "")
+        table.add_row(
+            f"variant {idx} pipeline",
+            f"{pipeline_time:.4f}",
+            "loaded" if idx == 0 else "reused from the registry",
+        )
+        table.add_row(f"variant {idx} first image", f"{generation_time:.4f}", "")
+    rich.print(table)
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_startup)
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from openai.types.chat import ChatCompletion
+from PIL import Image
+
+from diffusion_prompt_upsampling.dspy_multi_modal import (
+    DSPyOpenAIMultiModalLM,
+    estimate_image_tokens,
+)
+from diffusion_prompt_upsampling.utils import get_data_url_image_size
+
+
+BATCH_PROMPT_PATTERN = re.compile(r"^\[\d+\] «(.*)»$", re.MULTILINE)
+
+
+def pick(responses: List[Dict], key: str) -> Dict:
+    # Responses are picked deterministically, so that a given request always gets
+    # the same answer across benchmark runs
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return responses[int.from_bytes(digest[:4], "little") % len(responses)]
+
+
+def estimate_usage(messages: List[Dict], content: str) -> Dict[str, int]:
+    # Same estimate as the one used for rate limiting and budgets: ~4 characters
+    # per text token and images billed by their size
+    prompt_tokens = 0
+    for message in messages:
+        parts = message["content"]
+        if isinstance(parts, str):
+            parts = [{"type": "text", "text": parts}]
+        for part in parts:
+            if part["type"] == "text":
+                prompt_tokens += len(part["text"]) // 4
+            else:
+                prompt_tokens += estimate_image_tokens(
+                    get_data_url_image_size(part["image_url"]["url"]),
+                    part["image_url"].get("detail"),
+                )
+    completion_tokens = len(content) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class ReplayChatCompletions:
+
+    def __init__(self, responses: List[Dict], latency: float = 0.0):
+        self.responses = responses
+        self.latency = latency
+
+    def get_content(self, messages: List[Dict]) -> str:
+        content = messages[-1]["content"]
+        image_urls = []
+        if not isinstance(content, str):
+            image_urls = [
+                part["image_url"]["url"]
+                for part in content
+                if part["type"] == "image_url"
+            ]
+            content = "".join(part.get("text", "") for part in content)
+        if len(image_urls) > 1:
+            # A batched judging request, answered with a recorded judgement for
+            # each of its images
+            judgements = [
+                json.loads(pick(self.responses, image_url)["content"])
+                for image_url in image_urls
+            ]
+            return json.dumps({"judgements": judgements})
+        batch_prompts = BATCH_PROMPT_PATTERN.findall(content)
+        if batch_prompts:
+            # A batched upsampling request, answered with the recorded answer for
+            # each of its base prompts
+            answers = [
+                pick(self.responses, prompt)["content"].split("Answer:")[-1].strip()
+                for prompt in batch_prompts
+            ]
+            return json.dumps({"answers": answers})
+        return pick(self.responses, json.dumps(messages, sort_keys=True))["content"]
+
+    def get_response(self, model: str, messages: List[Dict]) -> ChatCompletion:
+        content = self.get_content(messages)
+        return ChatCompletion.model_validate(
+            {
+                "id": "replay",
+                "object": "chat.completion",
+                "created": 0,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": content,
+                        },
+                    }
+                ],
+                "usage": estimate_usage(messages, content),
+            }
+        )
+
+    def create(self, model: str, messages: List[Dict], **kwargs) -> ChatCompletion:
+        time.sleep(self.latency)
+        return self.get_response(model, messages)
+
+
+class ReplayOpenAIClient:
+
+    def __init__(self, completions: ReplayChatCompletions):
+        self.chat = type("ReplayChat", (), {"completions": completions})()
+
+
+class ReplayMultiModalLM(DSPyOpenAIMultiModalLM):
+    """A `DSPyOpenAIMultiModalLM` answering from recorded responses offline.
+
+    Only the OpenAI clients are replaced, so message creation, rate limiting and
+    profiling go through the same code paths as with the real API.
+    """
+
+    def __init__(self, responses: List[Dict], latency: float = 0.0, **kwargs):
+        super().__init__(api_key="replay", **kwargs)
+        self._openai_client = ReplayOpenAIClient(
+            ReplayChatCompletions(responses, latency)
+        )
+
+
+class TinyDiffusionPipelineOutput:
+
+    def __init__(self, images: List[Image.Image]):
+        self.images = images
+
+
+class TinyDiffusionPipeline:
+    """A CPU stand-in for `AutoPipelineForText2Image`.
+
+    It runs a small convolutional "denoiser" over a latent for every inference
+    step, so its cost scales with the batch size, the image size and the number
+    of steps like a real diffusion pipeline, only much cheaper.
+    """
+
+    def __init__(
+        self,
+        latent_channels: int = 4,
+        hidden_channels: int = 32,
+        blank_fraction: float = 0.0,
+    ):
+        torch.manual_seed(0)
+        self.denoiser = torch.nn.Sequential(
+            torch.nn.Conv2d(latent_channels, hidden_channels, 3, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(hidden_channels, latent_channels, 3, padding=1),
+        )
+        self.decoder = torch.nn.Conv2d(latent_channels, 3 * 8 * 8, 1)
+        self.latent_channels = latent_channels
+        # The fraction of prompts whose images are blacked out, as a safety
+        # checker does for the images it flags
+        self.blank_fraction = blank_fraction
+
+    def to(self, device):
+        self.denoiser.to(device)
+        self.decoder.to(device)
+        return self
+
+    def enable_model_cpu_offload(self, **kwargs):
+        pass
+
+    def set_progress_bar_config(self, **kwargs):
+        pass
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        prompt: List[str],
+        negative_prompt: Optional[List[str]] = None,
+        num_inference_steps: int = 50,
+        height: int = 1024,
+        width: int = 1024,
+        guidance_scale: float = 7.0,
+        generator: Optional[List[torch.Generator]] = None,
+        callback_on_step_end=None,
+        **kwargs,
+    ) -> TinyDiffusionPipelineOutput:
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        # Like the real pipelines, the initial latents come from the generators
+        # when they are given, and are otherwise seeded by the prompt here so
+        # that the benchmarks stay deterministic
+        generators = (
+            generator
+            if generator is not None
+            else [
+                torch.Generator().manual_seed(
+                    int.from_bytes(
+                        hashlib.sha1(p.encode("utf-8")).digest()[:4], "little"
+                    )
+                )
+                for p in prompts
+            ]
+        )
+        latents = torch.stack(
+            [
+                torch.randn(
+                    self.latent_channels,
+                    height // 8,
+                    width // 8,
+                    generator=generator,
+                )
+                for generator in generators
+            ]
+        )
+        for step in range(num_inference_steps):
+            noise_pred = self.denoiser(torch.cat([latents, latents]))
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            latents = latents - 0.1 * (
+                noise_pred_uncond
+                + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            )
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {})
+        pixels = torch.nn.functional.pixel_shuffle(self.decoder(latents), 8)
+        pixels = (torch.sigmoid(pixels) * 255).to(torch.uint8).permute(0, 2, 3, 1)
+        for idx, p in enumerate(prompts):
+            digest = hashlib.sha1(f"blank:{p}".encode("utf-8")).digest()
+            if int.from_bytes(digest[:4], "little") < self.blank_fraction * 2**32:
+                pixels[idx] = 0
+        return TinyDiffusionPipelineOutput(
+            [Image.fromarray(np.ascontiguousarray(image)) for image in pixels.numpy()]
+        )
+
+
+def build_tiny_sdxl_pipeline(tokenizer_dir: str):
+    """A randomly initialized `StableDiffusionXLPipeline` with tiny components.
+
+    Unlike `TinyDiffusionPipeline`, it is a real diffusers pipeline, so it goes
+    through the same loading, placement and prompt encoding code as SDXL, while
+    being small enough to run on a CPU. Its tokenizer is built from a
+    character-level vocabulary written to `tokenizer_dir`, so that nothing is
+    downloaded.
+    """
+    from diffusers import (
+        AutoencoderKL,
+        EulerDiscreteScheduler,
+        StableDiffusionXLPipeline,
+        UNet2DConditionModel,
+    )
+    from transformers import (
+        CLIPTextConfig,
+        CLIPTextModel,
+        CLIPTextModelWithProjection,
+        CLIPTokenizer,
+    )
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    characters = list(bytes_to_unicode().values())
+    vocab = ["<|startoftext|>", "<|endoftext|>", "!"]
+    vocab += characters + [f"{character}</w>" for character in characters]
+    vocab_file = os.path.join(tokenizer_dir, "vocab.json")
+    merges_file = os.path.join(tokenizer_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump({token: idx for idx, token in enumerate(vocab)}, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        vocab_file, merges_file, pad_token="!", model_max_length=77
+    )
+
+    torch.manual_seed(0)
+    text_encoder_config = CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=2,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        vocab_size=len(vocab),
+        projection_dim=32,
+        hidden_act="gelu",
+    )
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 1),
+        projection_class_embeddings_input_dim=80,
+        cross_attention_dim=64,
+        norm_num_groups=1,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4,
+        sample_size=128,
+        norm_num_groups=1,
+    )
+    return StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_encoder_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_encoder_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=EulerDiscreteScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            steps_offset=1,
+            beta_schedule="scaled_linear",
+            timestep_spacing="leading",
+        ),
+    )
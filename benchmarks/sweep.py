@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import fire
+import rich
+import weave
+from rich.table import Table
+
+from diffusion_prompt_upsampling.diffusion_model import (
+    get_config_name,
+    get_sweep_configs,
+)
+from diffusion_prompt_upsampling.profiling import enable_profiling
+from diffusion_prompt_upsampling.sweep import SweepEvaluation
+
+from offline_evaluation import build_offline_evaluation
+
+
+def benchmark_sweep(
+    num_rows: Optional[int] = 16,
+    upsample_prompt: Optional[bool] = True,
+    llm_latency: Optional[float] = 0.05,
+    num_inference_steps: Optional[List[int]] = (2, 4, 8),
+    image_size: Optional[List[int]] = (64, 128, 256),
+    guidance_scale: Optional[List[float]] = (7.0,),
+    batch_size: Optional[int] = 4,
+):
+    grid = {
+        "num_inference_steps": list(num_inference_steps),
+        "image_size": list(image_size),
+        "guidance_scale": list(guidance_scale),
+    }
+    configs = get_sweep_configs(grid)
+
+    def build():
+        return build_offline_evaluation(
+            "cpu",
+            num_rows=num_rows,
+            upsample_prompt=upsample_prompt,
+            llm_latency=llm_latency,
+            num_inference_steps=4,
+            image_size=256,
+            batch_size=batch_size,
+            image_transport="png",
+        )
+
+    table = Table(title=f"Sweep over {len(configs)} configurations of {num_rows} rows")
+    for column in ["mode", "wall time", "upsample calls", "diffusion calls"]:
+        table.add_column(column)
+
+    # The baseline runs an evaluation per configuration, as the sweep replaces
+    profiler = enable_profiling()
+    evaluation, diffusion_model = build()
+    rows = list(evaluation.dataset.rows)
+    start_time = time.perf_counter()
+    baseline_summaries = {}
+    for config in configs:
+        config_evaluation = weave.Evaluation(
+            dataset=[{**row, **config} for row in rows], scorers=evaluation.scorers
+        )
+        baseline_summaries[get_config_name(config)] = asyncio.run(
+            config_evaluation.evaluate(diffusion_model.predict)
+        )
+    wall_time = time.perf_counter() - start_time
+    stages = profiler.summary()["stages"]
+    table.add_row(
+        "one evaluation per configuration",
+        f"{wall_time:.2f}s",
+        str(stages.get("upsample", {}).get("count", 0)),
+        str(stages["diffusion"]["count"]),
+    )
+
+    profiler = enable_profiling()
+    evaluation, diffusion_model = build()
+    start_time = time.perf_counter()
+    asyncio.run(SweepEvaluation(evaluation, grid).evaluate(diffusion_model))
+    wall_time = time.perf_counter() - start_time
+    stages = profiler.summary()["stages"]
+    table.add_row(
+        "sweep",
+        f"{wall_time:.2f}s",
+        str(stages.get("upsample", {}).get("count", 0)),
+        str(stages["diffusion"]["count"]),
+    )
+    rich.print(table)
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_sweep)
@@ -0,0 +1,86 @@
+import concurrent.futures
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+# Returned by a batch function in place of the result of an item it could not
+# process, which is then processed on its own by the caller that submitted it
+BATCH_FALLBACK = object()
+
+
+class MicroBatcher:
+    """Collects items submitted concurrently from several threads into batches.
+
+    Items are grouped by `key`, and a group is executed with `batch_fn(key, items)`
+    as soon as it holds `batch_size` items, or once the oldest waiting caller has
+    waited `max_wait_seconds`. Batches are executed by one of the waiting callers,
+    at most `max_concurrent_batches` at a time, and each caller receives the result
+    corresponding to its own item.
+
+    Items for which `batch_fn` returns `BATCH_FALLBACK` are processed with
+    `fallback_fn(key, item)` by the callers that submitted them, each in its own
+    thread, so that the fallbacks of a batch run concurrently rather than one
+    after the other in the thread that executed the batch.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[Hashable, List[Any]], List[Any]],
+        batch_size: int,
+        max_wait_seconds: float = 0.1,
+        max_concurrent_batches: int = 1,
+        fallback_fn: Optional[Callable[[Hashable, Any], Any]] = None,
+    ):
+        self.batch_fn = batch_fn
+        self.fallback_fn = fallback_fn
+        self.batch_size = batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._pending: Dict[Hashable, List[Tuple[Any, Future]]] = {}
+        self._pending_lock = threading.Lock()
+        self._execution_semaphore = threading.Semaphore(max_concurrent_batches)
+
+    def _pop_group(self, key: Hashable, future: Optional[Future] = None) -> List:
+        with self._pending_lock:
+            group = self._pending.get(key, [])
+            if future is not None and all(f is not future for _, f in group):
+                return []
+            return self._pending.pop(key, [])
+
+    def _run(self, key: Hashable, group: List[Tuple[Any, Future]]) -> None:
+        if len(group) == 0:
+            return
+        with self._execution_semaphore:
+            try:
+                results = self.batch_fn(key, [item for item, _ in group])
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                return
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+
+    def submit(self, key: Hashable, item: Any) -> Any:
+        future = Future()
+        with self._pending_lock:
+            group = self._pending.setdefault(key, [])
+            group.append((item, future))
+            is_full = len(group) >= self.batch_size
+            if is_full:
+                self._pending.pop(key)
+        if is_full:
+            self._run(key, group)
+        else:
+            try:
+                future.result(timeout=self.max_wait_seconds)
+            except concurrent.futures.TimeoutError:
+                self._run(key, self._pop_group(key, future))
+        result = future.result()
+        if result is BATCH_FALLBACK:
+            return self.fallback_fn(key, item)
+        return result
+
+    def flush(self) -> None:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for key, group in pending.items():
+            self._run(key, group)
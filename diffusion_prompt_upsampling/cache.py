@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+def hash_key(*parts: Any) -> str:
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PersistentCache:
+    """A thread-safe, SQLite-backed key-value cache with LRU/TTL eviction.
+
+    Entries are evicted in least-recently-used order once the cache grows beyond
+    `max_entries` or `max_size_bytes`, and ignored once they are older than
+    `ttl_seconds`. A cache opened with `read_only=True` never writes to disk and
+    serves expired entries as well, so that a frozen cache always gives the same
+    results across evaluation runs.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        namespace: str = "default",
+        max_entries: Optional[int] = None,
+        max_size_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        read_only: bool = False,
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.read_only:
+            # SQLite only reports "unable to open database file" otherwise
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    f"Cannot open the cache {path} read-only, it does not exist"
+                )
+            self._connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)"
+            )
+            self._connection.commit()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return (
+            not self.read_only
+            and self.ttl_seconds is not None
+            and time.time() - created_at > self.ttl_seconds
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None or self._is_expired(row[1]):
+                self.misses += 1
+                return None
+            if not self.read_only:
+                self._connection.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (time.time(), self.namespace, key),
+                )
+                self._connection.commit()
+            self.hits += 1
+            return pickle.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        if self.read_only:
+            return
+        blob = pickle.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, blob, len(blob), now, now),
+            )
+            self._evict()
+            self._connection.commit()
+
+    def update(self, key: str, update_fn: Callable[[Optional[Any]], Any]) -> None:
+        # Replaces the value of `key` with `update_fn` of its current value, or of
+        # None, in a single write transaction, so that concurrent updates from
+        # threads or processes sharing the database are not lost
+        if self.read_only:
+            return
+        with self._lock:
+            try:
+                self._connection.execute("BEGIN IMMEDIATE")
+                row = self._connection.execute(
+                    "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                value = (
+                    pickle.loads(row[0])
+                    if row is not None and not self._is_expired(row[1])
+                    else None
+                )
+                blob = pickle.dumps(update_fn(value))
+                now = time.time()
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (self.namespace, key, blob, len(blob), now, now),
+                )
+                self._evict()
+                self._connection.commit()
+            except BaseException:
+                self._connection.rollback()
+                raise
+
+    def _evict(self) -> None:
+        if self.ttl_seconds is not None:
+            self._connection.execute(
+                "DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+                (self.namespace, time.time() - self.ttl_seconds),
+            )
+        if self.max_entries is not None:
+            self._connection.execute(
+                """
+                DELETE FROM cache WHERE namespace = ? AND key NOT IN (
+                    SELECT key FROM cache WHERE namespace = ?
+                    ORDER BY accessed_at DESC LIMIT ?
+                )
+                """,
+                (self.namespace, self.namespace, self.max_entries),
+            )
+        if self.max_size_bytes is not None:
+            rows = self._connection.execute(
+                """
+                SELECT key, size FROM cache WHERE namespace = ?
+                ORDER BY accessed_at DESC
+                """,
+                (self.namespace,),
+            ).fetchall()
+            total_size, stale_keys = 0, []
+            for key, size in rows:
+                total_size += size
+                if total_size > self.max_size_bytes:
+                    stale_keys.append((self.namespace, key))
+            self._connection.executemany(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?", stale_keys
+            )
+
+    def clear(self) -> None:
+        if self.read_only:
+            return
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM cache WHERE namespace = ?", (self.namespace,)
+            )
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
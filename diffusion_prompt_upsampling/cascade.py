@@ -0,0 +1,255 @@
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+import weave
+from PIL import Image
+from pydantic import BaseModel
+
+from .cache import hash_key
+from .image_transport import image_hash, load_image
+from .judge_model import OpenAIJudgeModel
+from .profiling import get_profiler
+
+
+class LocalJudgement(BaseModel):
+    """The verdict of the local stage of a `CascadeJudgeModel`.
+
+    `judgement` is None when the local stage is not confident, in which case
+    the image is escalated to the LLM judge.
+    """
+
+    score: float
+    judgement: Optional[str] = None
+    reason: str = ""
+
+
+def get_image_statistics(image: Image.Image, size: int = 64) -> Dict[str, float]:
+    # Computed on a small grayscale thumbnail, as blank images are blank at any
+    # resolution
+    pixels = np.asarray(image.convert("L").resize((size, size)), dtype=np.float32) / 255
+    return {
+        "mean": float(pixels.mean()),
+        "std": float(pixels.std()),
+        "dark_fraction": float((pixels < 0.05).mean()),
+    }
+
+
+class ClipSimilarity:
+    """The cosine similarity of a prompt and an image according to a CLIP model.
+
+    The model is loaded on first use, so that a `CascadeJudgeModel` that never
+    sees an image past its image statistics check does not load it.
+    """
+
+    def __init__(
+        self, model_name_or_path: str = "openai/clip-vit-base-patch32", device="cpu"
+    ):
+        self.model_name_or_path = model_name_or_path
+        self.device = device
+        self._model, self._processor = None, None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                from transformers import CLIPModel, CLIPProcessor
+
+                self._processor = CLIPProcessor.from_pretrained(self.model_name_or_path)
+                self._model = (
+                    CLIPModel.from_pretrained(self.model_name_or_path)
+                    .to(self.device)
+                    .eval()
+                )
+        return self._model, self._processor
+
+    def __call__(self, prompt: str, image: Image.Image) -> float:
+        import torch
+
+        model, processor = self.load()
+        inputs = processor(
+            text=[prompt],
+            images=[image.convert("RGB")],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+        ).to(self.device)
+        with torch.no_grad():
+            outputs = model(**inputs)
+        return torch.nn.functional.cosine_similarity(
+            outputs.text_embeds, outputs.image_embeds
+        ).item()
+
+
+class CascadeJudgeModel(weave.Model):
+    """Judges images with a cheap local stage first, and an LLM judge when unsure.
+
+    The local stage rejects images that are blank or almost entirely black,
+    such as the images blacked out by a safety checker, from their pixel
+    statistics. If `clip_model_name_or_path` is set, it also rejects images
+    whose CLIP similarity to the base prompt is below `clip_reject_threshold`,
+    i.e. clearly off-topic, and accepts images above `clip_accept_threshold`
+    if set. Accepting is disabled by default, as CLIP similarity does not see
+    the wrong colors, counts and spatial relations the benchmark prompts are
+    designed to catch. Every other image is escalated to `judge`.
+
+    Images decided locally get a score of 0 or 1. To measure the accuracy
+    given up, a deterministic `audit_fraction` of them is also sent to the
+    judge, and `get_agreement_report` reports how often the two stages agree.
+    """
+
+    min_image_std: float = 0.01
+    max_dark_fraction: float = 0.98
+    clip_model_name_or_path: Optional[str] = None
+    clip_reject_threshold: Optional[float] = 0.15
+    clip_accept_threshold: Optional[float] = None
+    audit_fraction: float = 0.1
+    _judge: OpenAIJudgeModel
+    _clip_similarity: Optional[ClipSimilarity]
+    _counts: Dict[str, int]
+    _audit_score_errors: list
+    _counts_lock: threading.Lock
+
+    def __init__(
+        self,
+        judge: OpenAIJudgeModel,
+        min_image_std: Optional[float] = 0.01,
+        max_dark_fraction: Optional[float] = 0.98,
+        clip_model_name_or_path: Optional[str] = None,
+        clip_reject_threshold: Optional[float] = 0.15,
+        clip_accept_threshold: Optional[float] = None,
+        clip_device: Optional[str] = "cpu",
+        audit_fraction: Optional[float] = 0.1,
+    ):
+        super().__init__(
+            min_image_std=min_image_std,
+            max_dark_fraction=max_dark_fraction,
+            clip_model_name_or_path=clip_model_name_or_path,
+            clip_reject_threshold=clip_reject_threshold,
+            clip_accept_threshold=clip_accept_threshold,
+            audit_fraction=audit_fraction,
+        )
+        self._judge = judge
+        self._clip_similarity = (
+            ClipSimilarity(clip_model_name_or_path, device=clip_device)
+            if clip_model_name_or_path is not None
+            else None
+        )
+        self._counts = {
+            "num_scored": 0,
+            "num_rejected_locally": 0,
+            "num_accepted_locally": 0,
+            "num_escalated": 0,
+            "num_audited": 0,
+            "num_audit_agreements": 0,
+            "num_false_rejects": 0,
+            "num_false_accepts": 0,
+        }
+        self._audit_score_errors = []
+        self._counts_lock = threading.Lock()
+
+    def judge_locally(self, base_prompt: str, image: Image.Image) -> LocalJudgement:
+        statistics = get_image_statistics(image)
+        if statistics["std"] < self.min_image_std:
+            return LocalJudgement(score=0.0, judgement="incorrect", reason="blank")
+        if statistics["dark_fraction"] > self.max_dark_fraction:
+            return LocalJudgement(score=0.0, judgement="incorrect", reason="dark")
+        if self._clip_similarity is None:
+            return LocalJudgement(score=0.0, reason="no similarity model")
+        similarity = self._clip_similarity(base_prompt, image)
+        if (
+            self.clip_reject_threshold is not None
+            and similarity < self.clip_reject_threshold
+        ):
+            return LocalJudgement(
+                score=0.0, judgement="incorrect", reason="low similarity"
+            )
+        if (
+            self.clip_accept_threshold is not None
+            and similarity >= self.clip_accept_threshold
+        ):
+            return LocalJudgement(
+                score=1.0, judgement="correct", reason="high similarity"
+            )
+        return LocalJudgement(score=similarity, reason="uncertain similarity")
+
+    def is_audited(self, base_prompt: str, image: Image.Image) -> bool:
+        # Picked by hashing the prompt and the image rather than at random, so
+        # that reruns audit the same images and hit the judgement cache
+        digest = hash_key(base_prompt, image_hash(image))
+        return int(digest[:8], 16) < self.audit_fraction * 16**8
+
+    def record(
+        self, local_judgement: LocalJudgement, judge_output: Optional[Dict]
+    ) -> None:
+        with self._counts_lock:
+            self._counts["num_scored"] += 1
+            if local_judgement.judgement is None:
+                self._counts["num_escalated"] += 1
+                return
+            is_image_correct = local_judgement.judgement == "correct"
+            if is_image_correct:
+                self._counts["num_accepted_locally"] += 1
+            else:
+                self._counts["num_rejected_locally"] += 1
+            if judge_output is None:
+                return
+            self._counts["num_audited"] += 1
+            if is_image_correct == judge_output["is_image_correct"]:
+                self._counts["num_audit_agreements"] += 1
+            elif is_image_correct:
+                self._counts["num_false_accepts"] += 1
+            else:
+                self._counts["num_false_rejects"] += 1
+            self._audit_score_errors.append(
+                abs(local_judgement.score - judge_output["score"])
+            )
+
+    def get_agreement_report(self) -> Dict[str, Any]:
+        with self._counts_lock:
+            counts = dict(self._counts)
+            audit_score_errors = list(self._audit_score_errors)
+        num_decided_locally = (
+            counts["num_rejected_locally"] + counts["num_accepted_locally"]
+        )
+        return {
+            **counts,
+            "escalation_fraction": (
+                counts["num_escalated"] / counts["num_scored"]
+                if counts["num_scored"]
+                else 0.0
+            ),
+            "local_fraction": (
+                num_decided_locally / counts["num_scored"]
+                if counts["num_scored"]
+                else 0.0
+            ),
+            # The fraction of the audited local verdicts the judge agrees with,
+            # an estimate of the accuracy of the images decided locally
+            "audit_agreement": (
+                counts["num_audit_agreements"] / counts["num_audited"]
+                if counts["num_audited"]
+                else None
+            ),
+            "audit_mean_score_error": (
+                float(np.mean(audit_score_errors)) if audit_score_errors else None
+            ),
+        }
+
+    @weave.op()
+    def score(self, base_prompt: str, model_output: Dict) -> Dict:
+        image = load_image(model_output["image"])
+        with get_profiler().stage("prescreen"):
+            local_judgement = self.judge_locally(base_prompt, image)
+        escalated = local_judgement.judgement is None
+        judge_output = None
+        if escalated or self.is_audited(base_prompt, image):
+            judge_output = self._judge.score(base_prompt, model_output)
+        self.record(local_judgement, judge_output)
+        if escalated:
+            return {**judge_output, "escalated": True}
+        return {
+            "score": local_judgement.score,
+            "is_image_correct": local_judgement.judgement == "correct",
+            "escalated": False,
+        }
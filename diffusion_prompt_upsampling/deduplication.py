@@ -0,0 +1,353 @@
+import hashlib
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import weave
+from weave.flow.scorer import get_scorer_attributes
+from weave.trace.env import get_weave_parallelism
+
+from .evaluation_log import (
+    SUMMARY_COLUMNS,
+    EvaluationLog,
+    bounded_foreach,
+    get_evaluation_fingerprint,
+    iter_examples,
+    predict_and_score,
+)
+from .prompt_shards import normalize_prompt
+
+# The largest Mersenne prime below 2**32, so that the products of the universal
+# hash functions of `MinHashLSH` fit in 64 bits
+_MERSENNE_PRIME = (1 << 31) - 1
+
+# fmt: off
+NUMBER_WORDS = {
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine",
+    "ten", "eleven", "twelve", "first", "second", "third", "single", "double",
+    "pair", "dozen",
+}
+# fmt: on
+
+
+def get_prompt_words(prompt: str) -> List[str]:
+    # Casing, whitespace and punctuation do not change the image a prompt asks for
+    return re.sub(r"[^\w\s]", " ", normalize_prompt(prompt).casefold()).split()
+
+
+def get_shingles(words: List[str], size: int = 3) -> Set[str]:
+    text = " ".join(words)
+    if len(text) <= size:
+        return {text}
+    return {text[idx : idx + size] for idx in range(len(text) - size + 1)}
+
+
+def is_number(word: str) -> bool:
+    return word.isdigit() or word in NUMBER_WORDS
+
+
+def get_edit_distance(word: str, other_word: str) -> int:
+    # Optimal string alignment distance, which counts a transposition of two
+    # adjacent characters as a single typo
+    distances = [[0] * (len(other_word) + 1) for _ in range(len(word) + 1)]
+    for i in range(len(word) + 1):
+        distances[i][0] = i
+    for j in range(len(other_word) + 1):
+        distances[0][j] = j
+    for i in range(1, len(word) + 1):
+        for j in range(1, len(other_word) + 1):
+            cost = int(word[i - 1] != other_word[j - 1])
+            distances[i][j] = min(
+                distances[i - 1][j] + 1,
+                distances[i][j - 1] + 1,
+                distances[i - 1][j - 1] + cost,
+            )
+            if (
+                i > 1
+                and j > 1
+                and word[i - 1] == other_word[j - 2]
+                and word[i - 2] == other_word[j - 1]
+            ):
+                distances[i][j] = min(distances[i][j], distances[i - 2][j - 2] + 1)
+    return distances[-1][-1]
+
+
+def are_near_duplicates(
+    words: List[str], other_words: List[str], max_typos: int = 1
+) -> bool:
+    """Whether two prompts only differ by small typos.
+
+    This is deliberately conservative, as prompts that look alike often ask for
+    different images, such as "a red cube on a blue cube" and "a blue cube on
+    a red cube", or "two cats" and "three cats". The prompts must have the same
+    words in the same order, except for at most `max_typos` words that are a
+    single edit or transposition away from each other and are not numbers.
+    """
+    if len(words) != len(other_words):
+        return False
+    num_typos = 0
+    for word, other_word in zip(words, other_words):
+        if word == other_word:
+            continue
+        num_typos += 1
+        if (
+            num_typos > max_typos
+            or is_number(word)
+            or is_number(other_word)
+            or min(len(word), len(other_word)) < 3
+            or get_edit_distance(word, other_word) > 1
+        ):
+            return False
+    return True
+
+
+class MinHashLSH:
+    """A MinHash index of character shingles, banded for locality sensitive hashing.
+
+    Every prompt is summarized by `num_perm` min-hashes of its shingles, split
+    into `num_bands` bands. Prompts sharing all the min-hashes of any band are
+    candidates, so a prompt is only compared with the few prompts likely to be
+    similar to it rather than with all of them. With the defaults, prompts
+    with a Jaccard similarity of 0.6 are candidates with a probability of 0.9.
+    """
+
+    def __init__(self, num_perm: int = 64, num_bands: int = 16, seed: int = 0):
+        if num_perm % num_bands:
+            raise ValueError("`num_perm` must be a multiple of `num_bands`")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.num_bands = num_bands
+        self.band_size = num_perm // num_bands
+        self._buckets: List[Dict[bytes, List[Any]]] = [{} for _ in range(num_bands)]
+
+    def get_signature(self, shingles: Set[str]) -> np.ndarray:
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(),
+                    "little",
+                )
+                % _MERSENNE_PRIME
+                for shingle in shingles
+            ],
+            dtype=np.uint64,
+        )
+        return ((np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME).min(axis=0)
+
+    def get_bands(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[idx * self.band_size : (idx + 1) * self.band_size].tobytes()
+            for idx in range(self.num_bands)
+        ]
+
+    def query(self, signature: np.ndarray) -> Set[Any]:
+        candidates = set()
+        for buckets, band in zip(self._buckets, self.get_bands(signature)):
+            candidates.update(buckets.get(band, []))
+        return candidates
+
+    def insert(self, key: Any, signature: np.ndarray) -> None:
+        for buckets, band in zip(self._buckets, self.get_bands(signature)):
+            buckets.setdefault(band, []).append(key)
+
+
+def cluster_prompts(
+    prompts: List[str],
+    group_keys: Optional[List[str]] = None,
+    max_typos: int = 1,
+    lsh: Optional[MinHashLSH] = None,
+) -> List[int]:
+    """Assigns every prompt to the index of the prompt representing its cluster.
+
+    Prompts equal up to casing, whitespace and punctuation are exact duplicates,
+    and prompts that `are_near_duplicates` of a representative join its cluster.
+    The first prompt of a cluster represents it, and clusters are never merged
+    through chains of near-duplicates. Only prompts with the same group key,
+    e.g. the other columns of their rows, are clustered together.
+    """
+    group_keys = [""] * len(prompts) if group_keys is None else group_keys
+    lsh = MinHashLSH() if lsh is None else lsh
+    exact_representatives: Dict[Tuple[str, str], int] = {}
+    representative_words: Dict[int, List[str]] = {}
+    representatives = []
+    for idx, (prompt, group_key) in enumerate(zip(prompts, group_keys)):
+        words = get_prompt_words(prompt)
+        exact_key = (group_key, " ".join(words))
+        if exact_key in exact_representatives:
+            representatives.append(exact_representatives[exact_key])
+            continue
+        representative = idx
+        if max_typos > 0:
+            signature = lsh.get_signature(get_shingles(words))
+            candidates = sorted(
+                candidate
+                for candidate in lsh.query(signature)
+                if group_keys[candidate] == group_key
+                and are_near_duplicates(
+                    words, representative_words[candidate], max_typos
+                )
+            )
+            if candidates:
+                representative = candidates[0]
+            else:
+                lsh.insert(idx, signature)
+                representative_words[idx] = words
+        exact_representatives[exact_key] = representative
+        representatives.append(representative)
+    return representatives
+
+
+def get_group_key(example: Dict, prompt_column: str = "base_prompt") -> str:
+    # Rows with the same prompt but different generation parameters or negative
+    # prompts are different examples
+    return json.dumps(
+        {k: v for k, v in example.items() if k != prompt_column},
+        sort_keys=True,
+        default=str,
+    )
+
+
+class DeduplicatedEvaluation:
+    """Runs a `weave.Evaluation` once per cluster of duplicate prompts.
+
+    The prompts of the dataset are clustered with `cluster_prompts` before the
+    evaluation, so that the upsampling, generation and judgement of exact and
+    near-duplicate prompts are only performed once, for the first row of their
+    cluster. Its result is then fanned out to the other rows of the cluster,
+    each with a `deduplication` column recording the row and the prompt it was
+    evaluated as, and the summary is computed over all the rows of the dataset
+    so that it weighs the examples as the full evaluation would.
+
+    If `log_path` is given, rows are appended to an `EvaluationLog` as in a
+    `ResumableEvaluation`, and clusters with all their rows in the log are
+    skipped on resume.
+    """
+
+    def __init__(
+        self,
+        evaluation: weave.Evaluation,
+        max_typos: int = 1,
+        log_path: Optional[str] = None,
+        parallelism: Optional[int] = None,
+    ):
+        self.evaluation = evaluation
+        self.max_typos = max_typos
+        self.log = EvaluationLog(log_path) if log_path is not None else None
+        self.parallelism = parallelism
+        self.savings: Dict[str, Any] = {}
+
+    def get_clusters(self, rows: List[Dict]) -> Dict[int, List[int]]:
+        representatives = cluster_prompts(
+            [row["base_prompt"] for row in rows],
+            group_keys=[get_group_key(row) for row in rows],
+            max_typos=self.max_typos,
+        )
+        clusters: Dict[int, List[int]] = {}
+        for idx, representative in enumerate(representatives):
+            clusters.setdefault(representative, []).append(idx)
+        return clusters
+
+    @weave.op()
+    async def evaluate(self, model: Any) -> dict:
+        rows = list(self.evaluation.dataset.rows)
+        clusters = self.get_clusters(rows)
+        num_examples = len(rows) * self.evaluation.trials
+        # Every trial evaluates the representatives again, as trials are meant to
+        # measure the variance of the model
+        trial_clusters = [
+            (
+                trial * len(rows) + representative,
+                [trial * len(rows) + idx for idx in members],
+            )
+            for trial in range(self.evaluation.trials)
+            for representative, members in clusters.items()
+        ]
+        completed_indices = set()
+        if self.log is not None:
+            self.log.check_fingerprint(
+                get_evaluation_fingerprint(self.evaluation, model, rows)
+            )
+            self.log.check_examples(iter_examples(rows, self.evaluation.trials))
+            completed_indices = self.log.get_completed_indices()
+        pending_clusters = [
+            (representative, members)
+            for representative, members in trial_clusters
+            if not completed_indices.issuperset(members)
+        ]
+        eval_rows: Dict[int, Dict] = {}
+        latencies = []
+
+        async def eval_cluster(cluster: Tuple[int, List[int]]):
+            representative, members = cluster
+            example = rows[representative % len(rows)]
+            eval_row, failed = await predict_and_score(self.evaluation, model, example)
+            if not failed:
+                latencies.append(eval_row.get("model_latency", 0.0))
+            for idx in members:
+                member_row = {
+                    **eval_row,
+                    "deduplication": {
+                        "representative_idx": representative,
+                        "representative_prompt": example["base_prompt"],
+                        "is_representative": idx == representative,
+                        "cluster_size": len(members),
+                    },
+                }
+                if self.log is not None:
+                    self.log.append(idx, member_row, rows[idx % len(rows)], failed)
+                else:
+                    eval_rows[idx] = member_row
+
+        num_complete = 0
+        start_time = time.time()
+        async for _ in bounded_foreach(
+            pending_clusters,
+            eval_cluster,
+            self.parallelism or get_weave_parallelism(),
+        ):
+            num_complete += 1
+            print(
+                f"Evaluated {num_complete} of {len(pending_clusters)} clusters "
+                f"({time.time() - start_time:.1f}s)"
+            )
+
+        num_pending_rows = sum(len(members) for _, members in pending_clusters)
+        self.savings = {
+            "num_rows": len(rows),
+            "num_clusters": len(clusters),
+            "num_duplicate_rows": len(rows) - len(clusters),
+            "num_evaluated": len(pending_clusters),
+            "num_fanned_out": num_pending_rows - len(pending_clusters),
+            "saved_fraction": (
+                1 - len(pending_clusters) / num_pending_rows
+                if num_pending_rows
+                else 0.0
+            ),
+            # The model latency of the rows that were not evaluated, estimated
+            # from the representatives that were
+            "saved_model_seconds": (
+                float(np.mean(latencies)) * (num_pending_rows - len(pending_clusters))
+                if latencies
+                else 0.0
+            ),
+        }
+        print("Deduplication savings", self.savings)
+        if self.log is not None:
+            return await self.log.summarize(self.evaluation, num_examples)
+        eval_table = []
+        for idx in range(num_examples):
+            eval_row = {
+                key: eval_rows[idx][key]
+                for key in SUMMARY_COLUMNS
+                if key in eval_rows[idx]
+            }
+            for scorer in self.evaluation.scorers or []:
+                scorer_name, _, _ = get_scorer_attributes(scorer)
+                eval_row["scores"].setdefault(scorer_name, {})
+            eval_table.append(eval_row)
+        summary = await self.evaluation.summarize(eval_table)
+        print("Evaluation summary", summary)
+        return summary
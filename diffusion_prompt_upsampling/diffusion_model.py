@@ -1,16 +1,87 @@
-from typing import List, Optional
+import copy
+import inspect
+import itertools
+import logging
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple, Type
 
 import dspy
-import torch
+import pydantic
 import weave
-from diffusers import AutoPipelineForText2Image, DiffusionPipeline
+from PIL import Image
+from pydantic import BaseModel, Field
 
+from .batching import BATCH_FALLBACK, MicroBatcher
+from .cache import PersistentCache, hash_key
 from .dspy_multi_modal import DSPyOpenAIMultiModalLM
-from .utils import base64_encode_image
+from .embedding_cache import PromptEmbeddingCache, PromptEmbeddings
+from .few_shot import FewShotSelector
+from .image_transport import ImagePayload, ImageTransport
+from .pipeline_registry import PipelineLoader, get_pipeline, get_placement_plan
+from .placement import PlacementPlan
+from .profiling import get_profiler
 
+if TYPE_CHECKING:
+    import torch
+    from diffusers import DiffusionPipeline
+
+
+logger = logging.getLogger(__name__)
 
 STOCK_NEGATIVE_PROMPT = "frame, border, 2d, ugly, static, dull, monochrome, distorted face, deformed fingers, scary, horror, nightmare, deformed lips, deformed eyes, deformed hands, deformed legs, impossible physics, absurdly placed objects"
 
+UPSAMPLER_SYSTEM_PROMPT = """
+You are part of a team of bots that creates images. You work with an assistant bot that will draw anything
+you say in square brackets. For example, outputting "a beautiful morning in the woods with the sun peaking
+through the trees" will trigger your partner bot to output an image of a forest morning, as described.
+You will be prompted by people looking to create detailed, amazing images. The way to accomplish this is to
+take their short prompts and make them extremely detailed and descriptive.
+
+There are a few rules to follow:
+- You will only ever output a single image description per user request.
+- Often times, the base prompt might consist of spelling mistakes or grammatical errors. You should correct
+    such errors before making them extremely detailed and descriptive.
+- Image descriptions must be between 15-80 words. Extra words will be ignored.
+"""
+
+UPSAMPLER_MODEL = "gpt-4"
+
+
+# The generation parameters of a row that can be swept, in the order in which the
+# configurations of a sweep are scheduled
+SWEEP_PARAMETERS = ("image_size", "num_inference_steps", "guidance_scale")
+
+
+def get_sweep_configs(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    unknown_parameters = set(grid) - set(SWEEP_PARAMETERS)
+    if unknown_parameters:
+        raise ValueError(
+            f"Cannot sweep {sorted(unknown_parameters)}, the parameters that can be "
+            f"swept are {list(SWEEP_PARAMETERS)}"
+        )
+    names = [name for name in SWEEP_PARAMETERS if name in grid]
+    # Configurations sharing an image size are scheduled one after the other, so
+    # that the pipeline keeps working on latents of the same shape
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(sorted(set(grid[name])) for name in names))
+    ]
+
+
+def get_config_name(config: Dict[str, Any]) -> str:
+    return ", ".join(f"{name}={value}" for name, value in config.items())
+
+
+def describe_signature(signature: Type[dspy.Signature]) -> Dict[str, Any]:
+    # The parts of a signature that end up in the prompt sent to the LLM
+    return {
+        "instructions": signature.instructions,
+        "fields": {
+            name: [str(field.annotation), field.json_schema_extra]
+            for name, field in signature.fields.items()
+        },
+    }
+
 
 class PromptUpsamplingSignature(dspy.Signature):
     base_prompt = dspy.InputField()
@@ -19,64 +90,247 @@ class PromptUpsamplingSignature(dspy.Signature):
     )
 
 
+class BatchUpsamplingOutput(BaseModel):
+    answers: List[str] = Field(
+        description="One image descriptive caption per base prompt, in the same order as the base prompts"
+    )
+
+
+class BatchPromptUpsamplingSignature(dspy.Signature):
+    """Create an imaginative image descriptive caption for each of the given base
+    prompts, following the style of the examples. Each base prompt is handled
+    independently and gets exactly one caption."""
+
+    examples: str = dspy.InputField(desc="Examples of base prompts and their captions")
+    base_prompts: List[str] = dspy.InputField()
+    output: BatchUpsamplingOutput = dspy.OutputField()
+
+
 class StableDiffusionXLModel(weave.Model):
 
     model_name_or_path: str
-    enable_cpu_offfload: bool
+    enable_cpu_offfload: Optional[bool] = None
+    device: Optional[str] = None
+    placement_strategy: Optional[str] = None
+    placement_dtype: Optional[str] = None
+    placement_image_size: Optional[int] = 1024
     completions: Optional[List[dspy.Prediction]] = None
+    num_few_shot_examples: Optional[int] = None
     diffusion_prompt_upsampler: Optional[dspy.Module] = None
     upsample_prompt: Optional[bool] = False
     use_stock_negative_prompt: Optional[bool] = False
-    _pipeline: DiffusionPipeline
-    _upsampler_llm: dspy.Module
+    upsampler_cache_path: Optional[str] = None
+    upsampler_cache_read_only: Optional[bool] = False
+    batch_size: Optional[int] = 1
+    upsample_batch_size: Optional[int] = 1
+    pad_last_batch: Optional[bool] = True
+    image_transport: Optional[ImageTransport] = None
+    cache_prompt_embeddings: Optional[bool] = False
+    disable_progress_bar: Optional[bool] = False
+    _pipeline: Optional["DiffusionPipeline"]
+    _placement_plan: Optional[PlacementPlan]
+    _pipeline_loader: Optional[PipelineLoader]
+    _upsampler_llm: Optional[DSPyOpenAIMultiModalLM]
+    _upsampler_llm_kwargs: Dict[str, Any]
+    _upsampler_llm_lock: threading.Lock
+    _upsampler_cache: Optional[PersistentCache]
+    _batcher: MicroBatcher
+    _upsample_batcher: MicroBatcher
+    _batch_upsampler: dspy.TypedPredictor
+    _embedding_cache: Optional[PromptEmbeddingCache]
+    _few_shot_selector: Optional[FewShotSelector]
 
     def __init__(
         self,
         model_name_or_path: str,
-        enable_cpu_offfload: bool,
+        enable_cpu_offfload: Optional[bool] = None,
         upsample_prompt: Optional[bool] = False,
         use_stock_negative_prompt: Optional[bool] = False,
+        upsampler_cache_path: Optional[str] = None,
+        upsampler_cache_read_only: Optional[bool] = False,
+        upsampler_cache_max_entries: Optional[int] = None,
+        upsampler_cache_ttl_seconds: Optional[float] = None,
+        batch_size: Optional[int] = 1,
+        batch_max_wait_seconds: Optional[float] = 0.1,
+        upsample_batch_size: Optional[int] = 1,
+        pad_last_batch: Optional[bool] = True,
+        pipeline: Optional["DiffusionPipeline"] = None,
+        pipeline_loader: Optional[PipelineLoader] = None,
+        disable_progress_bar: Optional[bool] = False,
+        upsampler_max_concurrency: Optional[int] = None,
+        upsampler_requests_per_minute: Optional[float] = None,
+        upsampler_tokens_per_minute: Optional[float] = None,
+        upsampler_max_history: Optional[int] = 100,
+        image_transport: Optional[ImageTransport] = None,
+        cache_prompt_embeddings: Optional[bool] = False,
+        embedding_cache_size: Optional[int] = 256,
+        embedding_cache_path: Optional[str] = None,
+        upsampler_llm: Optional[DSPyOpenAIMultiModalLM] = None,
+        completions: Optional[List[dspy.Prediction]] = None,
+        num_few_shot_examples: Optional[int] = None,
+        device: Optional[str] = None,
+        placement_strategy: Optional[str] = None,
+        placement_dtype: Optional[str] = None,
+        placement_image_size: Optional[int] = 1024,
     ):
         super().__init__(
             model_name_or_path=model_name_or_path,
             enable_cpu_offfload=enable_cpu_offfload,
         )
+        # `enable_cpu_offfload` forces model offloading or placing the whole
+        # pipeline on the device, and otherwise the placement policy picks the
+        # strategy with the most throughput that fits, see `get_placement_plan`
+        self.device = device
+        self.placement_strategy = placement_strategy
+        self.placement_dtype = placement_dtype
+        self.placement_image_size = placement_image_size
+        self._placement_plan = None
         self.upsample_prompt = upsample_prompt
         self.use_stock_negative_prompt = use_stock_negative_prompt
+        self.upsampler_cache_path = upsampler_cache_path
+        self.upsampler_cache_read_only = upsampler_cache_read_only
+        self.batch_size = batch_size
+        self.upsample_batch_size = upsample_batch_size
+        self.pad_last_batch = pad_last_batch
+        self.image_transport = (
+            ImageTransport() if image_transport is None else image_transport
+        )
+        self._batcher = MicroBatcher(
+            self._generate_batch,
+            batch_size=self.batch_size,
+            max_wait_seconds=batch_max_wait_seconds,
+        )
+        # Unlike image generation, several upsampling batches can be in flight at
+        # once, as they only wait on the OpenAI API
+        self._upsample_batcher = MicroBatcher(
+            self._upsample_batch,
+            batch_size=self.upsample_batch_size,
+            max_wait_seconds=batch_max_wait_seconds,
+            max_concurrent_batches=upsampler_max_concurrency or 8,
+            fallback_fn=lambda _, base_prompt: self._upsample_single(base_prompt),
+        )
+        self._upsampler_cache = (
+            PersistentCache(
+                self.upsampler_cache_path,
+                namespace="upsampler",
+                max_entries=upsampler_cache_max_entries,
+                ttl_seconds=upsampler_cache_ttl_seconds,
+                read_only=self.upsampler_cache_read_only,
+            )
+            if self.upsampler_cache_path is not None
+            else None
+        )
         self.completions = (
-            self.get_completion_rationales()
-            if self.completions is None
-            else self.completions
+            self.get_completion_rationales() if completions is None else completions
+        )
+        # By default every upsampling request carries the whole example bank,
+        # otherwise only the `num_few_shot_examples` most relevant examples
+        self.num_few_shot_examples = num_few_shot_examples
+        self._few_shot_selector = (
+            FewShotSelector(self.completions, k=self.num_few_shot_examples)
+            if self.num_few_shot_examples is not None
+            and self.num_few_shot_examples < len(self.completions)
+            else None
         )
         self.diffusion_prompt_upsampler = dspy.MultiChainComparison(
-            PromptUpsamplingSignature, M=len(self.completions)
+            PromptUpsamplingSignature,
+            M=(
+                len(self.completions)
+                if self._few_shot_selector is None
+                else self._few_shot_selector.k
+            ),
         )
-        self._pipeline = AutoPipelineForText2Image.from_pretrained(
-            self.model_name_or_path,
-            torch_dtype=torch.float16,
-            variant="fp16",
-            use_safetensors=True,
+        # A malformed batched response falls back to per-prompt requests instead
+        # of being retried
+        self._batch_upsampler = dspy.TypedPredictor(
+            BatchPromptUpsamplingSignature, max_retries=1
         )
-        if self.enable_cpu_offfload:
-            self._pipeline.enable_model_cpu_offload()
-        else:
-            self._pipeline = self._pipeline.to("cuda")
-        self._upsampler_llm = DSPyOpenAIMultiModalLM(
-            model="gpt-4",
-            system_prompt="""
-You are part of a team of bots that creates images. You work with an assistant bot that will draw anything
-you say in square brackets. For example, outputting "a beautiful morning in the woods with the sun peaking
-through the trees" will trigger your partner bot to output an image of a forest morning, as described.
-You will be prompted by people looking to create detailed, amazing images. The way to accomplish this is to
-take their short prompts and make them extremely detailed and descriptive.
-
-There are a few rules to follow:
-- You will only ever output a single image description per user request.
-- Often times, the base prompt might consist of spelling mistakes or grammatical errors. You should correct
-    such errors before making them extremely detailed and descriptive.
-- Image descriptions must be between 15-80 words. Extra words will be ignored.
-""",
+        # The pipeline and the upsampler LLM are only created on first use, see
+        # `get_pipeline` and `get_upsampler_llm`
+        self._pipeline_loader = pipeline_loader
+        self.disable_progress_bar = disable_progress_bar
+        self._upsampler_llm_lock = threading.Lock()
+        self.cache_prompt_embeddings = cache_prompt_embeddings
+        self._pipeline = (
+            self.prepare_pipeline(pipeline) if pipeline is not None else None
         )
+        self._embedding_cache = None
+        if self.cache_prompt_embeddings:
+            self._embedding_cache = PromptEmbeddingCache(
+                self.encode_prompt,
+                namespace=self.model_name_or_path,
+                max_entries=embedding_cache_size,
+                disk_cache=(
+                    PersistentCache(embedding_cache_path, namespace="prompt_embeddings")
+                    if embedding_cache_path is not None
+                    else None
+                ),
+            )
+        self._upsampler_llm = upsampler_llm
+        self._upsampler_llm_kwargs = {
+            "max_concurrency": upsampler_max_concurrency,
+            "requests_per_minute": upsampler_requests_per_minute,
+            "tokens_per_minute": upsampler_tokens_per_minute,
+            "max_history": upsampler_max_history,
+        }
+
+    def prepare_pipeline(self, pipeline: "DiffusionPipeline") -> "DiffusionPipeline":
+        if self.cache_prompt_embeddings:
+            from diffusers import StableDiffusionXLPipeline
+
+            if not isinstance(pipeline, StableDiffusionXLPipeline):
+                raise ValueError(
+                    "Caching prompt embeddings is only supported for Stable Diffusion XL pipelines"
+                )
+        if self.disable_progress_bar:
+            # The pipeline may be shared with other model variants by the pipeline
+            # registry, so the progress bar is configured on a shallow copy, which
+            # shares the components of the pipeline but not its configuration
+            pipeline = copy.copy(pipeline)
+            pipeline.set_progress_bar_config(disable=True)
+        return pipeline
+
+    def get_placement_plan(self) -> PlacementPlan:
+        if self._placement_plan is None:
+            strategy = self.placement_strategy
+            if strategy is None and self.enable_cpu_offfload is not None:
+                strategy = (
+                    "model_offload" if self.enable_cpu_offfload else "full_device"
+                )
+            self._placement_plan = get_placement_plan(
+                self.model_name_or_path,
+                device=self.device,
+                strategy=strategy,
+                dtype=self.placement_dtype,
+                batch_size=self.batch_size,
+                image_size=self.placement_image_size,
+            )
+        return self._placement_plan
+
+    def get_pipeline(self) -> "DiffusionPipeline":
+        # Concurrent first calls are deduplicated by the pipeline registry
+        if self._pipeline is None:
+            self._pipeline = self.prepare_pipeline(
+                get_pipeline(
+                    self.model_name_or_path,
+                    self.get_placement_plan(),
+                    loader=self._pipeline_loader,
+                )
+            )
+        return self._pipeline
+
+    def get_upsampler_llm(self) -> DSPyOpenAIMultiModalLM:
+        if self._upsampler_llm is not None:
+            return self._upsampler_llm
+        with self._upsampler_llm_lock:
+            if self._upsampler_llm is None:
+                self._upsampler_llm = DSPyOpenAIMultiModalLM(
+                    model=UPSAMPLER_MODEL,
+                    system_prompt=UPSAMPLER_SYSTEM_PROMPT,
+                    stage="upsampler",
+                    **self._upsampler_llm_kwargs,
+                )
+        return self._upsampler_llm
 
     def get_completion_rationales(self) -> List[dspy.Prediction]:
         return [
@@ -126,6 +380,257 @@ There are a few rules to follow:
             ),
         ]
 
+    def get_completions(self, base_prompt: str) -> List[dspy.Prediction]:
+        if self._few_shot_selector is None:
+            return self.completions
+        return self._few_shot_selector.select(base_prompt)
+
+    def get_upsampler_cache_key(
+        self,
+        base_prompt: str,
+        completions: List[dspy.Prediction],
+        batched: bool = False,
+    ) -> str:
+        # Built from the request that was actually sent, with the configuration
+        # of the upsampler LLM rather than the client, so that cache hits need
+        # neither the client nor an API key. Batched answers come from a
+        # different prompt, so they are kept apart from the per-prompt ones,
+        # e.g. the fallbacks of a failed batch, to keep evaluations comparable.
+        if self._upsampler_llm is not None:
+            model = self._upsampler_llm.kwargs["model"]
+            system_prompt = self._upsampler_llm.system_prompt
+        else:
+            model, system_prompt = UPSAMPLER_MODEL, UPSAMPLER_SYSTEM_PROMPT
+        return hash_key(
+            base_prompt,
+            [completion.toDict() for completion in completions],
+            model,
+            system_prompt,
+            describe_signature(
+                BatchPromptUpsamplingSignature if batched else PromptUpsamplingSignature
+            ),
+            batched,
+        )
+
+    def get_cached_upsampling(self, cache_key: str) -> Optional[str]:
+        if self._upsampler_cache is None:
+            return None
+        return self._upsampler_cache.get(cache_key)
+
+    def set_cached_upsampling(self, cache_key: str, response: str) -> None:
+        if self._upsampler_cache is not None:
+            self._upsampler_cache.set(cache_key, response)
+
+    def _upsample_single(self, base_prompt: str) -> str:
+        completions = self.get_completions(base_prompt)
+        cache_key = self.get_upsampler_cache_key(base_prompt, completions)
+        cached_response = self.get_cached_upsampling(cache_key)
+        if cached_response is not None:
+            return cached_response
+        with dspy.context(lm=self.get_upsampler_llm()), get_profiler().stage(
+            "upsample"
+        ):
+            response = self.diffusion_prompt_upsampler(
+                completions, base_prompt=base_prompt
+            ).answer
+        self.set_cached_upsampling(cache_key, response)
+        return response
+
+    def _upsample_batch(self, _: Any, base_prompts: List[str]) -> List[str]:
+        # Duplicated base prompts, e.g. from evaluation trials, are only sent once
+        unique_prompts = list(dict.fromkeys(base_prompts))
+        if len(unique_prompts) == 1:
+            return [self._upsample_single(unique_prompts[0])] * len(base_prompts)
+        completions = (
+            self.completions
+            if self._few_shot_selector is None
+            else self._few_shot_selector.select_many(unique_prompts)
+        )
+        # The examples of the request depend on all the prompts of the batch, so
+        # the cached answers are only looked up once the batch is known
+        cache_keys = {
+            prompt: self.get_upsampler_cache_key(prompt, completions, batched=True)
+            for prompt in unique_prompts
+        }
+        responses = {
+            prompt: self.get_cached_upsampling(cache_key)
+            for prompt, cache_key in cache_keys.items()
+        }
+        missing_prompts = [
+            prompt for prompt, response in responses.items() if response is None
+        ]
+        if missing_prompts:
+            examples = "\n\n".join(
+                f"Base prompt: {completion.rationale}\nCaption: {completion.answer}"
+                for completion in completions
+            )
+            try:
+                with dspy.context(lm=self.get_upsampler_llm()), get_profiler().stage(
+                    "upsample_batch", num_items=len(missing_prompts)
+                ):
+                    answers = self._batch_upsampler(
+                        examples=examples, base_prompts=missing_prompts
+                    ).output.answers
+                if len(answers) != len(missing_prompts) or not all(
+                    answer.strip() for answer in answers
+                ):
+                    raise ValueError(
+                        f"Expected {len(missing_prompts)} captions, got {len(answers)}"
+                    )
+            except (ValueError, pydantic.ValidationError) as e:
+                # The prompts are then upsampled on their own by the callers that
+                # submitted them, see `MicroBatcher`
+                logger.warning(
+                    "Batched upsampling failed, upsampling prompts one by one: %s", e
+                )
+                answers = [BATCH_FALLBACK] * len(missing_prompts)
+            for prompt, answer in zip(missing_prompts, answers):
+                responses[prompt] = answer
+                if answer is not BATCH_FALLBACK:
+                    self.set_cached_upsampling(cache_keys[prompt], answer)
+        return [responses[prompt] for prompt in base_prompts]
+
+    @weave.op()
+    def upsample(self, base_prompt: str) -> str:
+        if not self.upsample_prompt:
+            return base_prompt
+        if self.upsample_batch_size <= 1:
+            return self._upsample_single(base_prompt)
+        if self._few_shot_selector is None:
+            # Batched requests then carry every example whatever the batch, so a
+            # cached answer is found without waiting for the batch to form
+            cached_response = self.get_cached_upsampling(
+                self.get_upsampler_cache_key(
+                    base_prompt, self.completions, batched=True
+                )
+            )
+            if cached_response is not None:
+                return cached_response
+        # Concurrent calls are packed into a single request by the batcher
+        return self._upsample_batcher.submit(None, base_prompt)
+
+    @weave.op()
+    def upsample_prompts(self, base_prompts: List[str]) -> List[str]:
+        if not self.upsample_prompt:
+            return list(base_prompts)
+        unique_prompts = list(dict.fromkeys(base_prompts))
+        responses = {}
+        for idx in range(0, len(unique_prompts), self.upsample_batch_size):
+            prompt_batch = unique_prompts[idx : idx + self.upsample_batch_size]
+            for prompt, response in zip(
+                prompt_batch, self._upsample_batch(None, prompt_batch)
+            ):
+                if response is BATCH_FALLBACK:
+                    response = self._upsample_single(prompt)
+                responses[prompt] = response
+        return [responses[prompt] for prompt in base_prompts]
+
+    def encode_prompt(self, prompt: str) -> PromptEmbeddings:
+        import torch
+
+        pipeline = self.get_pipeline()
+        with torch.no_grad():
+            prompt_embeds, _, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+                prompt=prompt,
+                device=pipeline._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False,
+            )
+        return prompt_embeds, pooled_prompt_embeds
+
+    def get_prompt_inputs(
+        self, prompts: List[str], negative_prompts: List[Optional[str]]
+    ) -> Dict[str, Any]:
+        if self._embedding_cache is None:
+            # The pipeline only accepts a list of negative prompts without any `None`
+            # in it, and an empty negative prompt is not equivalent to `None` for SDXL
+            return {
+                "prompt": prompts,
+                "negative_prompt": (
+                    None
+                    if all(prompt is None for prompt in negative_prompts)
+                    else [prompt or "" for prompt in negative_prompts]
+                ),
+            }
+        import torch
+
+        pipeline = self.get_pipeline()
+        device = pipeline._execution_device
+        dtype = pipeline.text_encoder_2.dtype
+        prompt_embeddings = [
+            self._embedding_cache.get(prompt, device, dtype) for prompt in prompts
+        ]
+        negative_prompt_embeddings = []
+        for negative_prompt, (prompt_embeds, pooled_prompt_embeds) in zip(
+            negative_prompts, prompt_embeddings
+        ):
+            if negative_prompt is None and pipeline.config.force_zeros_for_empty_prompt:
+                negative_prompt_embeddings.append(
+                    (
+                        torch.zeros_like(prompt_embeds),
+                        torch.zeros_like(pooled_prompt_embeds),
+                    )
+                )
+            else:
+                negative_prompt_embeddings.append(
+                    self._embedding_cache.get(negative_prompt or "", device, dtype)
+                )
+        return {
+            "prompt_embeds": torch.cat([embeds for embeds, _ in prompt_embeddings]),
+            "pooled_prompt_embeds": torch.cat(
+                [pooled for _, pooled in prompt_embeddings]
+            ),
+            "negative_prompt_embeds": torch.cat(
+                [embeds for embeds, _ in negative_prompt_embeddings]
+            ),
+            "negative_pooled_prompt_embeds": torch.cat(
+                [pooled for _, pooled in negative_prompt_embeddings]
+            ),
+        }
+
+    def run_pipeline(self, num_images: int, **kwargs) -> List[Image.Image]:
+        pipeline = self.get_pipeline()
+        profiler = get_profiler()
+        if (
+            profiler.enabled
+            and "callback_on_step_end"
+            in inspect.signature(pipeline.__call__).parameters
+        ):
+            kwargs["callback_on_step_end"] = profiler.step_callback("denoise_step")
+        with profiler.stage("diffusion", num_items=num_images):
+            return pipeline(**kwargs).images[:num_images]
+
+    def get_seed(self, base_prompt: str, trial: int = 0) -> int:
+        # Every trial of a prompt starts from different latents, while the first
+        # one keeps the seed derived from the prompt alone
+        if trial == 0:
+            return int(hash_key(base_prompt)[:8], 16)
+        return int(hash_key(base_prompt, trial)[:8], 16)
+
+    def get_generators(
+        self, seeds: List[Optional[int]]
+    ) -> Optional[List["torch.Generator"]]:
+        if all(seed is None for seed in seeds):
+            return None
+        import torch
+
+        # CPU generators draw the same initial latents whatever the device and the
+        # offloading strategy of the pipeline, and prompts without a seed get a
+        # random one as they would without generators
+        generators = []
+        for seed in seeds:
+            generator = torch.Generator()
+            if seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(seed)
+            generators.append(generator)
+        return generators
+
+    def encode_images(self, images: List[Image.Image]) -> List[ImagePayload]:
+        with get_profiler().stage("image_encode", num_items=len(images)):
+            return [self.image_transport.encode(image) for image in images]
+
     @weave.op()
     def generate_image(
         self,
@@ -134,45 +639,242 @@ There are a few rules to follow:
         num_inference_steps: Optional[int] = 50,
         image_size: Optional[int] = 1024,
         guidance_scale: Optional[float] = 7.0,
-    ) -> str:
-        image = self._pipeline(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
+        seed: Optional[int] = None,
+    ) -> ImagePayload:
+        images = self.run_pipeline(
+            num_images=1,
+            **self.get_prompt_inputs([prompt], [negative_prompt]),
             num_inference_steps=num_inference_steps,
             height=image_size,
             width=image_size,
             guidance_scale=guidance_scale,
-        ).images[0]
-        return base64_encode_image(image)
+            generator=self.get_generators([seed]),
+        )
+        return self.encode_images(images)[0]
 
     @weave.op()
-    def predict(
+    def generate_images(
         self,
-        base_prompt: str,
-        negative_prompt: Optional[str] = None,
+        prompts: List[str],
+        negative_prompts: Optional[List[Optional[str]]] = None,
         num_inference_steps: Optional[int] = 50,
         image_size: Optional[int] = 1024,
         guidance_scale: Optional[float] = 7.0,
-    ) -> str:
-        negative_prompt = (
+        seeds: Optional[List[Optional[int]]] = None,
+    ) -> List[ImagePayload]:
+        negative_prompts = (
+            [None] * len(prompts) if negative_prompts is None else negative_prompts
+        )
+        seeds = [None] * len(prompts) if seeds is None else seeds
+        images = []
+        for idx in range(0, len(prompts), self.batch_size):
+            prompt_batch = prompts[idx : idx + self.batch_size]
+            negative_prompt_batch = negative_prompts[idx : idx + self.batch_size]
+            seed_batch = seeds[idx : idx + self.batch_size]
+            num_images = len(prompt_batch)
+            if self.pad_last_batch:
+                num_padding = self.batch_size - num_images
+                prompt_batch = prompt_batch + prompt_batch[-1:] * num_padding
+                negative_prompt_batch = (
+                    negative_prompt_batch + negative_prompt_batch[-1:] * num_padding
+                )
+                seed_batch = seed_batch + seed_batch[-1:] * num_padding
+            images += self.run_pipeline(
+                num_images=num_images,
+                **self.get_prompt_inputs(prompt_batch, negative_prompt_batch),
+                num_inference_steps=num_inference_steps,
+                height=image_size,
+                width=image_size,
+                guidance_scale=guidance_scale,
+                generator=self.get_generators(seed_batch),
+            )
+        return self.encode_images(images)
+
+    def get_negative_prompt(self, negative_prompt: Optional[str] = None) -> str:
+        return (
             STOCK_NEGATIVE_PROMPT
             if negative_prompt is None and self.use_stock_negative_prompt
             else negative_prompt
         )
-        with dspy.context(lm=self._upsampler_llm):
-            prompt_upsampler_response = (
-                self.diffusion_prompt_upsampler(
-                    self.completions, base_prompt=base_prompt
-                ).answer
-                if self.upsample_prompt
-                else base_prompt
+
+    def get_batch_key(
+        self,
+        negative_prompt: Optional[str] = None,
+        num_inference_steps: Optional[int] = 50,
+        image_size: Optional[int] = 1024,
+        guidance_scale: Optional[float] = 7.0,
+    ) -> Tuple:
+        return (
+            num_inference_steps,
+            image_size,
+            guidance_scale,
+            negative_prompt is None,
+        )
+
+    def _generate_batch(
+        self, batch_key: Tuple, items: List[Tuple[str, Optional[str], Optional[int]]]
+    ) -> List[ImagePayload]:
+        num_inference_steps, image_size, guidance_scale, _ = batch_key
+        return self.generate_images(
+            prompts=[prompt for prompt, _, _ in items],
+            negative_prompts=[negative_prompt for _, negative_prompt, _ in items],
+            num_inference_steps=num_inference_steps,
+            image_size=image_size,
+            guidance_scale=guidance_scale,
+            seeds=[seed for _, _, seed in items],
+        )
+
+    def _generate_rows(
+        self,
+        rows: List[Dict],
+        prompts: List[str],
+        seeds: Optional[List[Optional[int]]] = None,
+    ) -> List[ImagePayload]:
+        seeds = [None] * len(rows) if seeds is None else seeds
+        batches: Dict[Tuple, List[Tuple[int, Tuple]]] = {}
+        for idx, (row, prompt, seed) in enumerate(zip(rows, prompts, seeds)):
+            negative_prompt = self.get_negative_prompt(row.get("negative_prompt"))
+            batch_key = self.get_batch_key(
+                negative_prompt,
+                row.get("num_inference_steps", 50),
+                row.get("image_size", 1024),
+                row.get("guidance_scale", 7.0),
             )
-        return {
-            "image": self.generate_image(
-                prompt=prompt_upsampler_response,
-                negative_prompt=negative_prompt,
-                num_inference_steps=num_inference_steps,
-                image_size=image_size,
-                guidance_scale=guidance_scale,
+            batches.setdefault(batch_key, []).append(
+                (idx, (prompt, negative_prompt, seed))
             )
-        }
+        images = [None] * len(rows)
+        for batch_key, items in batches.items():
+            batch_images = self._generate_batch(
+                batch_key, [generation_input for _, generation_input in items]
+            )
+            for (idx, _), image in zip(items, batch_images):
+                images[idx] = image
+        return images
+
+    @weave.op()
+    def predict(
+        self,
+        base_prompt: str,
+        negative_prompt: Optional[str] = None,
+        num_inference_steps: Optional[int] = 50,
+        image_size: Optional[int] = 1024,
+        guidance_scale: Optional[float] = 7.0,
+    ) -> str:
+        with get_profiler().stage("predict"):
+            negative_prompt = self.get_negative_prompt(negative_prompt)
+            prompt_upsampler_response = self.upsample(base_prompt)
+            if self.batch_size > 1:
+                batch_key = self.get_batch_key(
+                    negative_prompt, num_inference_steps, image_size, guidance_scale
+                )
+                return {
+                    "image": self._batcher.submit(
+                        batch_key, (prompt_upsampler_response, negative_prompt, None)
+                    ),
+                    "upsampled_prompt": prompt_upsampler_response,
+                }
+            return {
+                "image": self.generate_image(
+                    prompt=prompt_upsampler_response,
+                    negative_prompt=negative_prompt,
+                    num_inference_steps=num_inference_steps,
+                    image_size=image_size,
+                    guidance_scale=guidance_scale,
+                ),
+                "upsampled_prompt": prompt_upsampler_response,
+            }
+
+    @weave.op()
+    def predict_batch(self, rows: List[Dict]) -> List[Dict]:
+        prompts = self.upsample_prompts([row["base_prompt"] for row in rows])
+        images = self._generate_rows(rows, prompts)
+        return [
+            {"image": image, "upsampled_prompt": prompt}
+            for image, prompt in zip(images, prompts)
+        ]
+
+    def get_sweep_chunks(
+        self, rows: List[Dict], prompts: List[str], chunk_size: Optional[int] = None
+    ) -> List[List[int]]:
+        # Without a `chunk_size`, the chunks are as large as possible while all
+        # the embeddings they use fit in the embedding cache, counting the
+        # negative prompts as well as the prompts. A chunk that overflows the
+        # cache would have every prompt evicted before the next configuration
+        # reuses it, as the configurations access them in the same cyclic order.
+        if chunk_size is not None:
+            return [
+                list(range(start, min(start + chunk_size, len(rows))))
+                for start in range(0, len(rows), max(chunk_size, 1))
+            ]
+        if self._embedding_cache is None:
+            return [list(range(len(rows)))] if rows else []
+        # Missing negative prompts are zeros rather than encoded for SDXL, see
+        # `get_prompt_inputs`
+        force_zeros = self.get_pipeline().config.force_zeros_for_empty_prompt
+        chunks, chunk, chunk_prompts = [], [], set()
+        for idx, (row, prompt) in enumerate(zip(rows, prompts)):
+            negative_prompt = self.get_negative_prompt(row.get("negative_prompt"))
+            row_prompts = {prompt}
+            if negative_prompt is not None or not force_zeros:
+                row_prompts.add(negative_prompt or "")
+            if chunk and len(chunk_prompts | row_prompts) > (
+                self._embedding_cache.max_entries
+            ):
+                chunks.append(chunk)
+                chunk, chunk_prompts = [], set()
+            chunk.append(idx)
+            chunk_prompts |= row_prompts
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def sweep(
+        self,
+        rows: List[Dict],
+        grid: Dict[str, List[Any]],
+        chunk_size: Optional[int] = None,
+        trials: int = 1,
+    ) -> Iterator[Tuple[Dict[str, Any], List[int], List[Dict]]]:
+        """Generates the images of `rows` for every configuration of a grid.
+
+        `grid` maps some of `SWEEP_PARAMETERS` to the values to sweep, which
+        override the ones of the rows. The work shared by the configurations is
+        done once per prompt: the prompts are upsampled once, every prompt gets a
+        single seed (its `seed` column, or one derived from the base prompt) so
+        that the configurations start from the same latents, and the prompt
+        embeddings are encoded once when `cache_prompt_embeddings` is enabled.
+
+        Every row is evaluated `trials` times, as the rows `rows * trials`, and
+        every trial gets its own seed, offset by the index of the trial, so
+        that the trials measure the variance of the generations.
+
+        The rows are processed in chunks small enough for their embeddings to
+        stay cached, running all the configurations on a chunk before moving on
+        to the next one, see `get_sweep_chunks`. Yields the configuration, the
+        indices of the rows and their outputs, formatted like the ones of
+        `predict`.
+        """
+        configs = get_sweep_configs(grid)
+        seeds = [
+            (
+                row["seed"] + trial
+                if "seed" in row
+                else self.get_seed(row["base_prompt"], trial)
+            )
+            for trial in range(trials)
+            for row in rows
+        ]
+        rows = list(rows) * trials
+        prompts = self.upsample_prompts([row["base_prompt"] for row in rows])
+        for indices in self.get_sweep_chunks(rows, prompts, chunk_size):
+            for config in configs:
+                images = self._generate_rows(
+                    [{**rows[idx], **config} for idx in indices],
+                    [prompts[idx] for idx in indices],
+                    [seeds[idx] for idx in indices],
+                )
+                yield config, indices, [
+                    {"image": image, "upsampled_prompt": prompts[idx]}
+                    for idx, image in zip(indices, images)
+                ]
@@ -1,4 +1,9 @@
+import hashlib
+import math
 import os
+import threading
+import time
+from collections import OrderedDict
 from typing import Any
 
 import weave
@@ -6,7 +11,26 @@ from weave.integrations.dspy.dspy_sdk import dspy_wrapper
 from dsp import GPT3
 from openai import OpenAI
 
-from .utils import find_base64_images
+from .profiling import get_profiler
+from .rate_limit import RateLimiter, get_backoff_delay, is_retryable_error
+from .usage import get_usage_tracker
+from .utils import get_data_url_image_size, image_placeholder, split_prompt_segments
+
+
+def estimate_image_tokens(
+    image_size: tuple[int, int] | None, image_detail: str | None = None
+) -> int:
+    # OpenAI bills "low" detail images a fixed 85 tokens. Other images are scaled
+    # to fit in 2048x2048 and then to a shortest side of 768 pixels, and billed
+    # 170 tokens per 512x512 tile plus 85. Images of unknown size are assumed to
+    # be 1024x1024.
+    if image_detail == "low":
+        return 85
+    width, height = image_size or (1024, 1024)
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    num_tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 170 * num_tiles + 85
 
 
 class DSPyOpenAIMultiModalLM(GPT3):
@@ -16,6 +40,15 @@ class DSPyOpenAIMultiModalLM(GPT3):
         model: str = "gpt-4o",
         api_key: str | None = None,
         system_prompt: str | None = None,
+        api_base: str | None = None,
+        max_concurrency: int | None = None,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_retries: int = 5,
+        max_image_handles: int = 1024,
+        image_detail: str | None = None,
+        max_history: int | None = 100,
+        stage: str | None = None,
         **kwargs,
     ):
         super().__init__(
@@ -28,44 +61,140 @@ class DSPyOpenAIMultiModalLM(GPT3):
             **kwargs,
         )
         self.model_type = model
-        self._openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        self.max_retries = max_retries
+        self.max_image_handles = max_image_handles
+        # "low" has every image billed as a fixed 85 tokens at a 512px resolution
+        self.image_detail = image_detail
+        self._image_handles: OrderedDict[str, str] = OrderedDict()
+        self._image_handles_lock = threading.Lock()
+        # dspy only inspects the last requests of the history, so only the last
+        # `max_history` are kept, or none if it is 0, rather than every response
+        # of an evaluation. None keeps them all.
+        self.max_history = max_history
+        # The role of the client, e.g. "upsampler" or "judge", under which its
+        # token usage is aggregated
+        self.stage = stage or model
+        api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        # Retries are handled by `basic_request` so that they respect the rate
+        # limiter, hence the retries of the client are disabled
+        self._openai_client = OpenAI(api_key=api_key, base_url=api_base, max_retries=0)
+        self._rate_limiter = RateLimiter(
+            max_concurrency=max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+
+    def register_image(self, image_url: str) -> str:
+        # Returns a short placeholder that can be used in prompts instead of the
+        # multi-megabyte data URL, which is only substituted into the request
+        handle = hashlib.sha1(image_url.encode("utf-8")).hexdigest()
+        with self._image_handles_lock:
+            self._image_handles[handle] = image_url
+            self._image_handles.move_to_end(handle)
+            while len(self._image_handles) > self.max_image_handles:
+                self._image_handles.popitem(last=False)
+        return image_placeholder(handle)
 
     @weave.op()
     def create_messages(self, prompt: str):
-        images = find_base64_images(prompt)
-        for image in images:
-            prompt = prompt.replace(image, "")
+        texts, images = [], []
+        for segment_type, segment in split_prompt_segments(prompt):
+            if segment_type == "text":
+                texts.append(segment)
+            elif segment_type == "image":
+                images.append(segment)
+            else:
+                images.append(self._image_handles[segment])
 
-        user_prompt = [{"type": "text", "text": prompt}]
+        user_prompt = [{"type": "text", "text": "".join(texts)}]
         for image in images:
-            user_prompt.append({"type": "image_url", "image_url": {"url": image}})
+            image_url = {"url": image}
+            if self.image_detail is not None:
+                image_url["detail"] = self.image_detail
+            user_prompt.append({"type": "image_url", "image_url": image_url})
         messages = []
         if self.system_prompt:
             messages.append({"role": "system", "content": self.system_prompt})
         messages.append({"role": "user", "content": user_prompt})
         return messages
 
+    def estimate_prompt_tokens(self, messages: list[dict]) -> tuple[int, int]:
+        # A rough estimate of the prompt tokens and of the image tokens among
+        # them, counting ~4 characters per text token and sizing every image
+        # from its header
+        num_tokens, num_image_tokens = 0, 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                num_tokens += len(content) // 4
+                continue
+            for part in content:
+                if part["type"] == "text":
+                    num_tokens += len(part["text"]) // 4
+                    continue
+                image_url = part["image_url"]
+                num_image_tokens += estimate_image_tokens(
+                    get_data_url_image_size(image_url["url"]),
+                    image_url.get("detail"),
+                )
+        return num_tokens + num_image_tokens, num_image_tokens
+
+    def append_history(self, prompt: str, response, **kwargs) -> None:
+        if self.max_history == 0:
+            return
+        self.history.append({"prompt": prompt, "response": response, "kwargs": kwargs})
+        # The history stays a list, which `inspect_history` slices, and is trimmed
+        # in bulk so that trimming costs a constant amortized time per request
+        if self.max_history is not None and len(self.history) >= 2 * self.max_history:
+            del self.history[: -self.max_history]
+
     @weave.op()
     def basic_request(self, prompt: str, **kwargs):
         messages = self.create_messages(prompt)
-        response = self._openai_client.chat.completions.create(
-            model=self.model_type, messages=messages, **kwargs
-        )
-        self.history.append({"prompt": prompt, "response": response, "kwargs": kwargs})
+        prompt_tokens, image_tokens = self.estimate_prompt_tokens(messages)
+        max_tokens = kwargs.get("max_tokens", self.kwargs["max_tokens"])
+        num_tokens = prompt_tokens + max_tokens
+        profiler, stage_name = get_profiler(), f"openai_request/{self.model_type}"
+        usage_tracker = get_usage_tracker()
+        # The budget is checked before waiting for the rate limiter, so that a run
+        # over budget stops without waiting for its turn
+        with usage_tracker.reserve(self.model_type, prompt_tokens, max_tokens):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with self._rate_limiter.limit(num_tokens), profiler.stage(
+                        stage_name
+                    ):
+                        response = self._openai_client.chat.completions.create(
+                            model=self.model_type, messages=messages, **kwargs
+                        )
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries or not is_retryable_error(e):
+                        raise
+                    time.sleep(get_backoff_delay(attempt))
+            usage_tracker.record(
+                self.model_type, self.stage, response.usage, image_tokens
+            )
+        profiler.record_usage(stage_name, response.usage)
+        self.append_history(prompt, response, **kwargs)
         return response
 
     @weave.op()
     def request(self, prompt: str, **kwargs):
-        return super().request(prompt, **kwargs)
+        kwargs.pop("model_type", None)
+        return self.basic_request(prompt, **kwargs)
 
-    @dspy_wrapper(name="DSPyOpenAIMultiModalLM")
-    def __call__(
-        self, prompt: str, only_completed: bool = True, **kwargs
-    ) -> list[dict[str, Any]]:
-        response = self.request(prompt, **kwargs)
+    def get_choices(self, response, only_completed: bool = True) -> list[str]:
         choices = (
             [choice for choice in response.choices if choice.finish_reason == "stop"]
             if only_completed and len(response.choices) != 0
             else response.choices
         )
         return [choice.message.content for choice in choices]
+
+    @dspy_wrapper(name="DSPyOpenAIMultiModalLM")
+    def __call__(
+        self, prompt: str, only_completed: bool = True, **kwargs
+    ) -> list[dict[str, Any]]:
+        response = self.request(prompt, **kwargs)
+        return self.get_choices(response, only_completed=only_completed)
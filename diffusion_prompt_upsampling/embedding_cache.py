@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+from .cache import PersistentCache, hash_key
+
+if TYPE_CHECKING:
+    import torch
+
+PromptEmbeddings = Tuple["torch.Tensor", "torch.Tensor"]
+
+
+class PromptEmbeddingCache:
+    """An in-memory LRU cache of text-encoder embeddings with an optional disk tier.
+
+    `encode_fn` maps a prompt to its `(prompt_embeds, pooled_prompt_embeds)`. The
+    time spent encoding on misses is tracked, so that the encoder time saved by
+    the hits can be estimated.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[str], PromptEmbeddings],
+        namespace: str,
+        max_entries: int = 256,
+        disk_cache: Optional[PersistentCache] = None,
+    ):
+        self.encode_fn = encode_fn
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_time = 0.0
+        self._entries: OrderedDict[str, PromptEmbeddings] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put(self, key: str, embeddings: PromptEmbeddings) -> None:
+        with self._lock:
+            self._entries[key] = embeddings
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(
+        self, prompt: str, device: "torch.device", dtype: "torch.dtype"
+    ) -> PromptEmbeddings:
+        key = hash_key(self.namespace, prompt)
+        with self._lock:
+            embeddings = self._entries.get(key)
+            if embeddings is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embeddings
+        if self.disk_cache is not None:
+            embeddings = self.disk_cache.get(key)
+            if embeddings is not None:
+                embeddings = tuple(
+                    embedding.to(device=device, dtype=dtype) for embedding in embeddings
+                )
+                self._put(key, embeddings)
+                self.disk_hits += 1
+                return embeddings
+        start_time = time.perf_counter()
+        embeddings = self.encode_fn(prompt)
+        self.encode_time += time.perf_counter() - start_time
+        self.misses += 1
+        self._put(key, embeddings)
+        if self.disk_cache is not None:
+            self.disk_cache.set(
+                key, tuple(embedding.detach().cpu() for embedding in embeddings)
+            )
+        return embeddings
+
+    def stats(self) -> Dict[str, Any]:
+        mean_encode_time = self.encode_time / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "encode_time": self.encode_time,
+            "estimated_encode_time_saved": (self.hits + self.disk_hits)
+            * mean_encode_time,
+        }
@@ -0,0 +1,444 @@
+import asyncio
+import inspect
+import json
+import os
+import threading
+import time
+import traceback
+from numbers import Number
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import weave
+from PIL import Image
+from pydantic import BaseModel
+from weave.flow.eval import async_call
+from weave.flow.scorer import get_scorer_attributes
+from weave.trace.env import get_weave_parallelism
+from weave.trace.op import Op
+
+from .cache import hash_key
+from .image_transport import ImageStore, image_hash, load_image
+from .usage import BudgetExceededError, get_usage_tracker
+
+# The columns of a logged row that `weave.Evaluation.summarize` expects
+SUMMARY_COLUMNS = ("model_output", "scores", "model_latency")
+
+# Parameters that only decide where or how visibly a model runs, which can change
+# between the runs of an evaluation without changing its results, e.g. when a
+# log written by a single process is resumed by a sharded evaluation
+FINGERPRINT_EXCLUDED_PARAMS = ("device", "disable_progress_bar")
+
+
+def to_json_value(value: Any, image_store: Optional[ImageStore] = None) -> Any:
+    # Numbers and booleans are what the evaluation summary is computed from, so
+    # they are kept as they are. Images, either as they are or as data URLs, are
+    # saved to `image_store` and replaced by their path, or by a hash without a
+    # store, and other long strings are replaced by a hash to keep the log small.
+    if value is None or isinstance(value, (bool, Number)):
+        return value
+    if isinstance(value, str):
+        if image_store is not None and value.startswith("data:image/"):
+            return image_store.put(load_image(value))
+        return value if len(value) <= 1024 else f"sha256:{hash_key(value)}"
+    if isinstance(value, dict):
+        return {str(k): to_json_value(v, image_store) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(v, image_store) for v in value]
+    if isinstance(value, Image.Image):
+        if image_store is not None:
+            return image_store.put(value)
+        return f"image:{image_hash(value)}"
+    if hasattr(value, "model_dump"):
+        return to_json_value(value.model_dump(), image_store)
+    return repr(value)
+
+
+def get_params(obj: Any) -> Any:
+    # The configuration of a model or a scorer: the fields of a pydantic model
+    # that are plain values or models themselves, along with the models held in
+    # private attributes such as the judge wrapped by a `CascadeJudgeModel`. A
+    # method such as `OpenAIJudgeModel.score` is configured by its model, and
+    # other functions are identified by their name.
+    if not isinstance(obj, BaseModel):
+        name = getattr(obj, "name", None) or getattr(obj, "__name__", repr(obj))
+        if isinstance(getattr(obj, "__self__", None), BaseModel):
+            return {"method": name, **get_params(obj.__self__)}
+        return name
+    params = {"class": type(obj).__name__}
+    values = {name: getattr(obj, name, None) for name in type(obj).model_fields}
+    for name, value in (obj.__pydantic_private__ or {}).items():
+        if isinstance(value, weave.Model):
+            values[name] = value
+    for name, value in values.items():
+        if name in FINGERPRINT_EXCLUDED_PARAMS:
+            continue
+        if isinstance(value, BaseModel):
+            params[name] = get_params(value)
+        elif value is None or isinstance(value, (bool, Number, str)):
+            params[name] = value
+    return params
+
+
+def get_evaluation_fingerprint(
+    evaluation: weave.Evaluation, model: Any, rows: Iterable[Dict]
+) -> Dict:
+    # Rows in memory are hashed, and streamed rows such as `PromptShards` are
+    # identified by their manifest rather than read, as the examples of the
+    # completed rows are compared with the logged ones on resume anyway
+    if isinstance(rows, list):
+        dataset = hash_key(to_json_value(rows))
+    elif getattr(rows, "manifest", None) is not None:
+        dataset = hash_key(rows.manifest)
+    else:
+        dataset = None
+    return {
+        "dataset": dataset,
+        "num_rows": len(rows),
+        "trials": evaluation.trials,
+        # A model is evaluated the same whether the runner is given the model or
+        # its `predict` method
+        "model": get_params(
+            model.__self__
+            if isinstance(getattr(model, "__self__", None), BaseModel)
+            else model
+        ),
+        "scorers": [get_params(scorer) for scorer in evaluation.scorers or []],
+    }
+
+
+def iter_examples(rows: Iterable[Dict], trials: int = 1) -> Iterator[Tuple[int, Dict]]:
+    # Indexes the examples of an evaluation the way `weave.Evaluation` repeats
+    # its dataset for every trial, without materializing the rows
+    idx = 0
+    for _ in range(trials):
+        for example in rows:
+            yield idx, example
+            idx += 1
+
+
+async def bounded_foreach(
+    items: Iterable[Any],
+    func: Callable[[Any], Awaitable[Any]],
+    max_concurrent_tasks: int,
+) -> AsyncIterator[Any]:
+    # Unlike `weave.flow.util.async_foreach`, which creates a task for every item
+    # upfront, items are only taken from the iterable as tasks complete, so that
+    # rows streamed from disk are not all read into memory
+    iterator = iter(items)
+    pending, done = set(), set()
+    try:
+        while True:
+            for item in iterator:
+                pending.add(asyncio.ensure_future(func(item)))
+                if len(pending) >= max_concurrent_tasks:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            while done:
+                yield done.pop().result()
+    finally:
+        # When a task fails or the caller stops iterating, the tasks still
+        # running are cancelled and the errors of the completed ones discarded,
+        # rather than left unobserved
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not task.cancelled():
+                task.exception()
+
+
+class EvaluationLog:
+    """An append-only JSONL log of the rows of an evaluation.
+
+    Every line is a row keyed by its index in the evaluation, so that a run
+    restarted on the same log can skip the rows that already completed. A row
+    logged several times, for instance a failed row that was retried, is
+    represented by its last occurrence, and a truncated last line left behind
+    by a killed process is ignored.
+
+    The first line of the log is a header with the fingerprint of the
+    evaluation that wrote it, see `check_fingerprint`, and every row records
+    its example, so that a log is never resumed by a different evaluation.
+
+    The images of the rows are saved to an `ImageStore` in `image_store_dir`,
+    by default a directory next to the log, and logged as their paths, so that
+    they can be loaded back with `load_image`.
+    """
+
+    def __init__(self, path: str, image_store_dir: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.image_store = ImageStore(
+            image_store_dir
+            if image_store_dir is not None
+            else f"{os.path.splitext(path)[0]}_images"
+        )
+
+    def iter_records(self) -> Iterator[Dict]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def iter_rows(self) -> Iterator[Dict]:
+        for record in self.iter_records():
+            if "idx" in record:
+                yield record
+
+    def read_header(self) -> Optional[Dict]:
+        for record in self.iter_records():
+            return record if "fingerprint" in record else None
+        return None
+
+    def check_fingerprint(self, fingerprint: Dict) -> None:
+        """Refuses to resume a log written by a different evaluation.
+
+        A new log starts with a header recording `fingerprint`, and an existing
+        one must have been written with the same fingerprint, i.e. the same
+        dataset, trials, model parameters and scorers. Logs written before
+        headers were introduced only get the examples of their rows checked.
+        """
+        fingerprint = json.loads(json.dumps(to_json_value(fingerprint)))
+        with self._lock:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+                return
+        header = self.read_header()
+        if header is None or header["fingerprint"] == fingerprint:
+            return
+        mismatches = [
+            key
+            for key in fingerprint.keys() | header["fingerprint"].keys()
+            if fingerprint.get(key) != header["fingerprint"].get(key)
+        ]
+        raise ValueError(
+            f"The evaluation log {self.path} was written by an evaluation with a "
+            f"different {', '.join(sorted(mismatches))}, use another log path to "
+            f"evaluate this configuration"
+        )
+
+    def read(self) -> Dict[int, Dict]:
+        return {row["idx"]: row for row in self.iter_rows()}
+
+    def get_pending_indices(self, indices: Iterable[int]) -> List[int]:
+        completed_indices = self.get_completed_indices()
+        return [idx for idx in indices if idx not in completed_indices]
+
+    def get_completed_indices(self) -> Set[int]:
+        return set(self.get_completed_examples())
+
+    def get_completed_examples(self) -> Dict[int, Any]:
+        completed_examples = {}
+        for row in self.iter_rows():
+            if row["failed"]:
+                completed_examples.pop(row["idx"], None)
+            else:
+                completed_examples[row["idx"]] = row.get("example")
+        return completed_examples
+
+    def is_completed(
+        self, completed_examples: Dict[int, Any], idx: int, example: Dict
+    ) -> bool:
+        # A completed row is only skipped if it was evaluated on the same
+        # example, as a row of another dataset would be mixed into the summary
+        if idx not in completed_examples:
+            return False
+        if completed_examples[idx] != json.loads(json.dumps(to_json_value(example))):
+            raise ValueError(
+                f"Row {idx} of the evaluation log {self.path} was evaluated on a "
+                f"different example, use another log path to evaluate this dataset"
+            )
+        return True
+
+    def check_examples(self, examples: Iterable[Tuple[int, Dict]]) -> None:
+        completed_examples = self.get_completed_examples()
+        for idx, example in examples:
+            self.is_completed(completed_examples, idx, example)
+
+    @staticmethod
+    def make_row(
+        idx: int,
+        eval_row: Dict,
+        example: Optional[Dict] = None,
+        failed: bool = False,
+        image_store: Optional[ImageStore] = None,
+    ) -> Dict:
+        return {
+            "idx": idx,
+            "failed": failed,
+            "example": to_json_value(example),
+            **to_json_value(eval_row, image_store),
+        }
+
+    def append(
+        self,
+        idx: int,
+        eval_row: Dict,
+        example: Optional[Dict] = None,
+        failed: bool = False,
+    ) -> Dict:
+        row = self.make_row(idx, eval_row, example, failed, self.image_store)
+        self.write(row)
+        return row
+
+    def write(self, row: Dict) -> None:
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(row) + "\n")
+
+    async def summarize(self, evaluation: weave.Evaluation, num_rows: int) -> Dict:
+        # Only the columns needed for the summary are kept while streaming over
+        # the log, the last occurrence of a row replacing the earlier ones
+        eval_rows: Dict[int, Dict] = {}
+        for row in self.iter_rows():
+            if row["idx"] >= num_rows:
+                continue
+            eval_row = {key: row[key] for key in SUMMARY_COLUMNS if key in row}
+            eval_row.setdefault("scores", {})
+            for scorer in evaluation.scorers or []:
+                scorer_name, _, _ = get_scorer_attributes(scorer)
+                eval_row["scores"].setdefault(scorer_name, {})
+            eval_rows[row["idx"]] = eval_row
+        if len(eval_rows) < num_rows:
+            print(f"Summarizing {len(eval_rows)} of {num_rows} examples")
+        summary = await evaluation.summarize(
+            [eval_rows[idx] for idx in sorted(eval_rows)]
+        )
+        print("Evaluation summary", summary)
+        return summary
+
+
+async def predict_and_score(
+    evaluation: weave.Evaluation, model: Any, example: Dict
+) -> Tuple[Dict, bool]:
+    # Mirrors the error handling of `weave.Evaluation.evaluate`, additionally
+    # reporting whether the row failed so that it is retried on resume. Running
+    # out of budget stops the evaluation instead of failing every row after it,
+    # even though `weave.Evaluation.predict_and_score` swallows the errors of the
+    # model, and the row is left to be evaluated on resume.
+    try:
+        eval_row, failed = await evaluation.predict_and_score(model, example), False
+    except BudgetExceededError:
+        raise
+    except Exception:
+        print("Predict and score failed")
+        traceback.print_exc()
+        eval_row, failed = {"model_output": None, "scores": {}}, True
+    get_usage_tracker().raise_if_stopped()
+    return eval_row, failed
+
+
+async def apply_scorers(
+    evaluation: weave.Evaluation, example: Dict, model_output: Any
+) -> Dict:
+    # Scores an output that was not produced by `weave.Evaluation.predict_and_score`,
+    # passing every scorer the columns of the example it asks for
+    scores = {}
+    for scorer in evaluation.scorers or []:
+        scorer_name, score_fn, _ = get_scorer_attributes(scorer)
+        score_signature = (
+            score_fn.signature
+            if isinstance(score_fn, Op)
+            else inspect.signature(score_fn)
+        )
+        score_args = {
+            k: v for k, v in example.items() if k in score_signature.parameters
+        }
+        try:
+            scores[scorer_name] = await async_call(
+                score_fn, model_output=model_output, **score_args
+            )
+        except BudgetExceededError:
+            raise
+        except Exception:
+            print(f"Scorer {scorer_name} failed")
+            traceback.print_exc()
+            scores[scorer_name] = {}
+    return scores
+
+
+class ResumableEvaluation:
+    """Runs a `weave.Evaluation`, checkpointing every completed row to a log.
+
+    Rows are appended to the `EvaluationLog` at `log_path` as soon as they are
+    scored and are not kept in memory, and a run restarted on the same log only
+    evaluates the rows that are missing or failed. The summary is then computed
+    from the log with `weave.Evaluation.summarize`.
+
+    `rows` replaces the rows of the dataset of the evaluation with any iterable
+    of rows with a length, such as `PromptShards`, which are then streamed
+    rather than loaded upfront.
+    """
+
+    def __init__(
+        self,
+        evaluation: weave.Evaluation,
+        log_path: str,
+        parallelism: Optional[int] = None,
+        rows: Optional[Iterable[Dict]] = None,
+    ):
+        self.evaluation = evaluation
+        self.log = EvaluationLog(log_path)
+        self.parallelism = parallelism
+        self.rows = rows
+
+    @weave.op()
+    async def evaluate(self, model: Any) -> dict:
+        rows = list(self.evaluation.dataset.rows) if self.rows is None else self.rows
+        num_examples = len(rows) * self.evaluation.trials
+        self.log.check_fingerprint(
+            get_evaluation_fingerprint(self.evaluation, model, rows)
+        )
+        completed_examples = self.log.get_completed_examples()
+        completed_indices = set(completed_examples)
+        pending_examples = (
+            (idx, example)
+            for idx, example in iter_examples(rows, self.evaluation.trials)
+            if not self.log.is_completed(completed_examples, idx, example)
+        )
+        num_pending = num_examples - len(
+            [idx for idx in completed_indices if idx < num_examples]
+        )
+        print(
+            f"Resuming with {num_examples - num_pending} of "
+            f"{num_examples} examples already evaluated"
+        )
+
+        async def eval_example(item: Tuple[int, Dict]) -> Dict:
+            idx, example = item
+            eval_row, failed = await predict_and_score(self.evaluation, model, example)
+            return self.log.append(idx, eval_row, example, failed)
+
+        num_complete = 0
+        start_time = time.time()
+        async for _ in bounded_foreach(
+            pending_examples,
+            eval_example,
+            self.parallelism or get_weave_parallelism(),
+        ):
+            num_complete += 1
+            print(
+                f"Evaluated {num_complete} of {num_pending} examples "
+                f"({time.time() - start_time:.1f}s)"
+            )
+        return await self.log.summarize(self.evaluation, num_examples)
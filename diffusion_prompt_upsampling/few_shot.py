@@ -0,0 +1,102 @@
+import json
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+
+import dspy
+import numpy as np
+
+
+def load_completions(path: str) -> List[dspy.Prediction]:
+    # Every line of the file is an example with a `base_prompt` and the `caption`
+    # it should be upsampled to
+    with open(path) as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    return [
+        dspy.Prediction(rationale=example["base_prompt"], answer=example["caption"])
+        for example in examples
+    ]
+
+
+def get_terms(text: str) -> List[str]:
+    # Words, plus the character trigrams of every word so that misspelled base
+    # prompts still match the examples sharing most of their letters
+    words = re.findall(r"\w+", text.casefold())
+    terms = list(words)
+    for word in words:
+        padded_word = f" {word} "
+        terms += [padded_word[idx : idx + 3] for idx in range(len(padded_word) - 2)]
+    return terms
+
+
+class FewShotSelector:
+    """Selects the examples of a bank most relevant to a base prompt.
+
+    The base prompts and captions of the examples are embedded once into a
+    TF-IDF matrix, fully offline, and a base prompt is matched against it by
+    cosine similarity, keeping the `k` most similar examples from the most to
+    the least similar. Ties are broken by the order of the bank, so that the
+    selection, and the prompts sent to the upsampler, are deterministic.
+    """
+
+    def __init__(self, completions: List[dspy.Prediction], k: int = 3):
+        if not completions:
+            raise ValueError("The example bank must not be empty")
+        self.completions = completions
+        self.k = min(k, len(completions))
+        documents = [
+            Counter(get_terms(f"{completion.rationale} {completion.answer}"))
+            for completion in completions
+        ]
+        document_frequencies = Counter(
+            term for document in documents for term in document
+        )
+        self.vocabulary: Dict[str, int] = {
+            term: idx for idx, term in enumerate(sorted(document_frequencies))
+        }
+        # Smoothed inverse document frequencies, as in scikit-learn
+        self.idf = np.array(
+            [
+                math.log((1 + len(documents)) / (1 + document_frequencies[term])) + 1
+                for term in self.vocabulary
+            ]
+        )
+        self.matrix = np.stack([self.embed_terms(document) for document in documents])
+
+    def embed_terms(self, term_counts: Counter) -> np.ndarray:
+        vector = np.zeros(len(self.vocabulary))
+        for term, count in term_counts.items():
+            idx = self.vocabulary.get(term)
+            if idx is not None:
+                vector[idx] = 1 + math.log(count)
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get_similarities(self, base_prompt: str) -> np.ndarray:
+        return self.matrix @ self.embed_terms(Counter(get_terms(base_prompt)))
+
+    def select(self, base_prompt: str) -> List[dspy.Prediction]:
+        similarities = self.get_similarities(base_prompt)
+        top_indices = np.argsort(-similarities, kind="stable")[: self.k]
+        return [self.completions[idx] for idx in top_indices]
+
+    def select_many(self, base_prompts: List[str]) -> List[dspy.Prediction]:
+        # The union of the examples selected for each base prompt of a batch,
+        # ordered by their best similarity to any of them
+        similarities = np.stack(
+            [self.get_similarities(base_prompt) for base_prompt in base_prompts]
+        )
+        selected_indices = {
+            idx
+            for row in similarities
+            for idx in np.argsort(-row, kind="stable")[: self.k]
+        }
+        best_similarities = similarities.max(axis=0)
+        return [
+            self.completions[idx]
+            for idx in sorted(
+                selected_indices, key=lambda idx: (-best_similarities[idx], idx)
+            )
+        ]
@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import io
+import os
+import tempfile
+from typing import Literal, Optional, Union
+
+from PIL import Image
+from pydantic import BaseModel
+
+from .utils import base64_encode_image
+
+ImagePayload = Union[str, Image.Image]
+
+
+def image_hash(image: Image.Image) -> str:
+    return hashlib.sha256(
+        f"{image.mode}:{image.size}".encode("utf-8") + image.tobytes()
+    ).hexdigest()
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> int:
+    # A difference hash: the sign of the horizontal gradients of a tiny grayscale
+    # thumbnail, which is stable under re-encoding, resizing and small edits
+    pixels = list(
+        image.convert("L")
+        .resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+        .getdata()
+    )
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            idx = row * (hash_size + 1) + col
+            bits = (bits << 1) | int(pixels[idx] > pixels[idx + 1])
+    return bits
+
+
+class ImageStore:
+    """A local content-addressed store of images.
+
+    Images are keyed by the hash of their raw pixels, so storing the same image
+    twice neither encodes nor writes it again.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def get_path(self, image: Image.Image) -> str:
+        return os.path.join(self.root, f"{image_hash(image)}.png")
+
+    def put(self, image: Image.Image) -> str:
+        path = self.get_path(image)
+        if os.path.exists(path):
+            return path
+        # Every writer gets its own temporary file, as threads and processes may
+        # store the same image at once. Since the store is content-addressed,
+        # whichever of them replaces the target last writes the same bytes.
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format="PNG")
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if not os.path.exists(path):
+                raise
+        return path
+
+    def get(self, path: str) -> Image.Image:
+        return Image.open(path)
+
+
+class ImageTransport(BaseModel):
+    """Decides how generated images are passed from the diffusion model onwards.
+
+    - `png`, `jpeg` and `webp` produce base64-encoded data URLs; `jpeg` and `webp`
+        are lossy with the given `quality`.
+    - `raw` passes the `PIL.Image.Image` through without any encoding, which is
+        the cheapest option when the consumer lives in the same process.
+    - `blob` saves the image once to a content-addressed `ImageStore` in
+        `store_dir` and passes its path.
+
+    If `max_size` is set, images are downscaled so that their longest side is at
+    most `max_size` pixels before being encoded.
+    """
+
+    kind: Literal["png", "jpeg", "webp", "raw", "blob"] = "png"
+    quality: int = 90
+    max_size: Optional[int] = None
+    store_dir: Optional[str] = None
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        if self.max_size is None or max(image.size) <= self.max_size:
+            return image
+        image = image.copy()
+        image.thumbnail((self.max_size, self.max_size), Image.Resampling.LANCZOS)
+        return image
+
+    def encode(self, image: Image.Image) -> ImagePayload:
+        image = self.resize(image)
+        if self.kind == "raw":
+            return image
+        if self.kind == "blob":
+            return ImageStore(self.store_dir or ".image_store").put(image)
+        return base64_encode_image(
+            image, image_format=self.kind.upper(), quality=self.quality
+        )
+
+    def to_data_url(self, payload: ImagePayload) -> str:
+        if (
+            isinstance(payload, str)
+            and payload.startswith(f"data:image/{self.kind};")
+            and self.max_size is None
+        ):
+            return payload
+        image_format = "PNG" if self.kind in ("raw", "blob") else self.kind.upper()
+        return base64_encode_image(
+            self.resize(load_image(payload)),
+            image_format=image_format,
+            quality=self.quality,
+        )
+
+
+def load_image(payload: ImagePayload) -> Image.Image:
+    if isinstance(payload, Image.Image):
+        return payload
+    if payload.startswith("data:image/"):
+        encoded_image = payload.split(";base64,", 1)[1]
+        return Image.open(io.BytesIO(base64.b64decode(encoded_image)))
+    return Image.open(payload)
@@ -1,12 +1,26 @@
-from typing import Dict
+import logging
+from typing import Any, Dict, List, Optional, Tuple
 
 import dspy
+import pydantic
 import weave
 from pydantic import BaseModel, Field
 
+from .batching import BATCH_FALLBACK, MicroBatcher
+from .cache import PersistentCache, hash_key
 from .dspy_multi_modal import DSPyOpenAIMultiModalLM
+from .image_transport import (
+    ImagePayload,
+    ImageTransport,
+    image_hash,
+    load_image,
+    perceptual_hash,
+)
+from .profiling import get_profiler
 
 
+logger = logging.getLogger(__name__)
+
 JUDGE_SYSTEM_PROMPT = """
 You are responsible for judging the faithfulness of images generated by a computer program to the
 base prompt used to generate them. You will be presented with an image and given the base prompt
@@ -61,6 +75,34 @@ class JudgeSignature(dspy.Signature):
     output: JudgeMent = dspy.OutputField()
 
 
+class BatchJudgeItem(BaseModel):
+    base_prompt: str = Field(description="The base prompt used to generate the image")
+    image_number: int = Field(
+        description="The position of the generated image among the attached images, starting at 1"
+    )
+    generated_image: str = Field(description="The generated image")
+
+
+class BatchJudgeInput(BaseModel):
+    items: List[BatchJudgeItem]
+
+
+class BatchJudgeOutput(BaseModel):
+    # Judgements are validated one by one after parsing, so that a single
+    # malformed judgement only causes its own item to be judged again
+    judgements: List[Dict[str, Any]] = Field(
+        description="One judgement per item, in the same order as the items, each with the think_out_loud, score and judgement fields"
+    )
+
+
+class BatchJudgeSignature(dspy.Signature):
+    """Judge each item independently, looking only at the attached image whose
+    position is given by the image number of the item."""
+
+    input: BatchJudgeInput = dspy.InputField()
+    output: BatchJudgeOutput = dspy.OutputField()
+
+
 class MultiModalJudgeModule(dspy.Module):
 
     def __init__(self):
@@ -73,30 +115,279 @@ class MultiModalJudgeModule(dspy.Module):
         ).output
 
 
+class MultiModalBatchJudgeModule(dspy.Module):
+
+    def __init__(self):
+        # A malformed response falls back to judging the items one by one instead
+        # of being retried as a whole
+        self.prog = dspy.TypedPredictor(BatchJudgeSignature, max_retries=1)
+
+    @weave.op()
+    def forward(
+        self, base_prompts: List[str], generated_images: List[str]
+    ) -> List[Dict[str, Any]]:
+        items = [
+            BatchJudgeItem(
+                base_prompt=base_prompt,
+                image_number=idx + 1,
+                generated_image=generated_image,
+            )
+            for idx, (base_prompt, generated_image) in enumerate(
+                zip(base_prompts, generated_images)
+            )
+        ]
+        return self.prog(input=BatchJudgeInput(items=items)).output.judgements
+
+
 class OpenAIJudgeModel(weave.Model):
     openai_model: str
     seed: int
+    image_transport: Optional[ImageTransport] = None
+    batch_size: Optional[int] = 1
+    batch_image_transport: Optional[ImageTransport] = None
+    cache_path: Optional[str] = None
+    cache_read_only: Optional[bool] = False
+    near_duplicate_threshold: Optional[int] = None
+    near_duplicate_max_candidates: Optional[int] = 32
     _judgement_llm: dspy.Module
     _judgement_module: MultiModalJudgeModule
+    _batch_judgement_module: MultiModalBatchJudgeModule
+    _batcher: MicroBatcher
+    _judgement_cache: Optional[PersistentCache]
+    _perceptual_hash_index: Optional[PersistentCache]
 
-    def __init__(self, openai_model: str = "gpt-4-turbo", seed: int = 42):
+    def __init__(
+        self,
+        openai_model: str = "gpt-4-turbo",
+        seed: int = 42,
+        max_concurrency: Optional[int] = None,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        image_transport: Optional[ImageTransport] = None,
+        cache_path: Optional[str] = None,
+        cache_read_only: Optional[bool] = False,
+        cache_max_entries: Optional[int] = None,
+        near_duplicate_threshold: Optional[int] = None,
+        near_duplicate_max_candidates: Optional[int] = 32,
+        judgement_llm: Optional[DSPyOpenAIMultiModalLM] = None,
+        batch_size: Optional[int] = 1,
+        batch_max_wait_seconds: Optional[float] = 0.1,
+        batch_image_max_size: Optional[int] = None,
+        image_detail: Optional[str] = None,
+        max_history: Optional[int] = 100,
+    ):
         super().__init__(openai_model=openai_model, seed=seed)
-        self._judgement_llm = DSPyOpenAIMultiModalLM(
-            model="gpt-4o", system_prompt=JUDGE_SYSTEM_PROMPT, seed=self.seed
+        self.image_transport = (
+            ImageTransport() if image_transport is None else image_transport
+        )
+        # Images sent in batched requests can be downsized further, as every
+        # image of a batch adds to the size and the token count of the request
+        self.batch_size = batch_size
+        self.batch_image_transport = (
+            self.image_transport.model_copy(update={"max_size": batch_image_max_size})
+            if batch_image_max_size is not None
+            else self.image_transport
+        )
+        self._batcher = MicroBatcher(
+            self._predict_batch,
+            batch_size=self.batch_size,
+            max_wait_seconds=batch_max_wait_seconds,
+            max_concurrent_batches=max_concurrency or 8,
+            fallback_fn=lambda _, item: self.predict(
+                base_prompt=item[0], generated_image=item[1]
+            ),
+        )
+        self.cache_path = cache_path
+        self.cache_read_only = cache_read_only
+        self.near_duplicate_threshold = near_duplicate_threshold
+        # Only the most recent judged images of a base prompt are compared with
+        # a new one, which bounds the scan of `find_near_duplicate`
+        self.near_duplicate_max_candidates = near_duplicate_max_candidates
+        self._judgement_cache, self._perceptual_hash_index = None, None
+        if self.cache_path is not None:
+            self._judgement_cache = PersistentCache(
+                self.cache_path,
+                namespace="judgement",
+                max_entries=cache_max_entries,
+                read_only=self.cache_read_only,
+            )
+            self._perceptual_hash_index = PersistentCache(
+                self.cache_path,
+                namespace="judgement_perceptual_hash",
+                max_entries=cache_max_entries,
+                read_only=self.cache_read_only,
+            )
+        self._judgement_llm = (
+            DSPyOpenAIMultiModalLM(
+                model="gpt-4o",
+                system_prompt=JUDGE_SYSTEM_PROMPT,
+                max_concurrency=max_concurrency,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                image_detail=image_detail,
+                stage="judge",
+                max_history=max_history,
+                seed=self.seed,
+            )
+            if judgement_llm is None
+            else judgement_llm
         )
         self._judgement_module = MultiModalJudgeModule()
+        self._batch_judgement_module = MultiModalBatchJudgeModule()
+
+    def get_judgement_context_key(self, base_prompt: str) -> str:
+        return hash_key(
+            base_prompt,
+            self._judgement_llm.kwargs["model"],
+            self.seed,
+            hash_key(self._judgement_llm.system_prompt),
+        )
+
+    def find_near_duplicate(
+        self, context_key: str, image_perceptual_hash: int
+    ) -> Optional[Dict]:
+        candidates: List[Tuple[int, str]] = (
+            self._perceptual_hash_index.get(context_key) or []
+        )
+        for candidate_hash, cache_key in candidates:
+            distance = bin(candidate_hash ^ image_perceptual_hash).count("1")
+            if distance <= self.near_duplicate_threshold:
+                judgement = self._judgement_cache.get(cache_key)
+                if judgement is not None:
+                    return judgement
+        return None
+
+    def get_cached_judgement(
+        self, base_prompt: str, generated_image: ImagePayload
+    ) -> Tuple[Optional[JudgeMent], Optional[Tuple[str, str, Optional[int]]]]:
+        # Returns the cached judgement if any, along with the keys under which a
+        # new judgement of this image should be cached
+        if self._judgement_cache is None:
+            return None, None
+        image = load_image(generated_image)
+        context_key = self.get_judgement_context_key(base_prompt)
+        cache_key = hash_key(context_key, image_hash(image))
+        image_perceptual_hash = None
+        judgement = self._judgement_cache.get(cache_key)
+        if judgement is None and self.near_duplicate_threshold is not None:
+            image_perceptual_hash = perceptual_hash(image)
+            judgement = self.find_near_duplicate(context_key, image_perceptual_hash)
+        cache_entry = (context_key, cache_key, image_perceptual_hash)
+        return (JudgeMent(**judgement) if judgement is not None else None), cache_entry
+
+    def set_cached_judgement(
+        self,
+        cache_entry: Optional[Tuple[str, str, Optional[int]]],
+        judgement: JudgeMent,
+    ) -> None:
+        if cache_entry is None:
+            return
+        context_key, cache_key, image_perceptual_hash = cache_entry
+        self._judgement_cache.set(cache_key, judgement.model_dump())
+        if image_perceptual_hash is not None:
+
+            def add_candidate(candidates: Optional[List[Tuple[int, str]]]):
+                candidates = [
+                    candidate
+                    for candidate in candidates or []
+                    if candidate[1] != cache_key
+                ] + [(image_perceptual_hash, cache_key)]
+                if self.near_duplicate_max_candidates is None:
+                    return candidates
+                return candidates[-self.near_duplicate_max_candidates :]
+
+            self._perceptual_hash_index.update(context_key, add_candidate)
 
     @weave.op()
-    def predict(self, base_prompt: str, generated_image: str) -> JudgeMent:
+    def predict(self, base_prompt: str, generated_image: ImagePayload) -> JudgeMent:
+        judgement, cache_entry = self.get_cached_judgement(base_prompt, generated_image)
+        if judgement is not None:
+            return judgement
+        generated_image = self._judgement_llm.register_image(
+            self.image_transport.to_data_url(generated_image)
+        )
         with dspy.context(lm=self._judgement_llm):
             judgement = self._judgement_module(base_prompt, generated_image)
+        self.set_cached_judgement(cache_entry, judgement)
         return judgement
 
+    def _predict_batch(
+        self, _: Any, items: List[Tuple[str, ImagePayload]]
+    ) -> List[JudgeMent]:
+        judgements: List[Optional[JudgeMent]] = [None] * len(items)
+        cache_entries = []
+        for idx, (base_prompt, generated_image) in enumerate(items):
+            judgements[idx], cache_entry = self.get_cached_judgement(
+                base_prompt, generated_image
+            )
+            cache_entries.append(cache_entry)
+        missing = [idx for idx, judgement in enumerate(judgements) if judgement is None]
+        if len(missing) > 1:
+            try:
+                with dspy.context(lm=self._judgement_llm), get_profiler().stage(
+                    "judge_batch", num_items=len(missing)
+                ):
+                    batch_judgements = self._batch_judgement_module(
+                        [items[idx][0] for idx in missing],
+                        [
+                            self._judgement_llm.register_image(
+                                self.batch_image_transport.to_data_url(items[idx][1])
+                            )
+                            for idx in missing
+                        ],
+                    )
+                if len(batch_judgements) != len(missing):
+                    raise ValueError(
+                        f"Expected {len(missing)} judgements, got {len(batch_judgements)}"
+                    )
+            except (ValueError, pydantic.ValidationError) as e:
+                logger.warning(
+                    "Batched judging failed, judging images one by one: %s", e
+                )
+                batch_judgements = [None] * len(missing)
+            for idx, batch_judgement in zip(missing, batch_judgements):
+                try:
+                    judgements[idx] = JudgeMent.model_validate(batch_judgement)
+                except pydantic.ValidationError:
+                    continue
+                self.set_cached_judgement(cache_entries[idx], judgements[idx])
+        # Items missing from the batched response, or whose judgement did not
+        # validate, are judged individually by the callers that submitted them,
+        # see `MicroBatcher`
+        return [
+            judgement if judgement is not None else BATCH_FALLBACK
+            for judgement in judgements
+        ]
+
+    @weave.op()
+    def predict_batch(
+        self, base_prompts: List[str], generated_images: List[ImagePayload]
+    ) -> List[JudgeMent]:
+        items = list(zip(base_prompts, generated_images))
+        judgements = []
+        for idx in range(0, len(items), self.batch_size):
+            judgements += self._predict_batch(None, items[idx : idx + self.batch_size])
+        return [
+            (
+                judgement
+                if judgement is not BATCH_FALLBACK
+                else self.predict(base_prompt=base_prompt, generated_image=image)
+            )
+            for judgement, (base_prompt, image) in zip(judgements, items)
+        ]
+
     @weave.op()
     def score(self, base_prompt: str, model_output: Dict) -> Dict:
-        judgement: JudgeMent = self.predict(
-            base_prompt=base_prompt, generated_image=model_output["image"]
-        )
+        with get_profiler().stage("judge"):
+            if self.batch_size > 1:
+                # Concurrent calls are judged in a single request by the batcher
+                judgement: JudgeMent = self._batcher.submit(
+                    None, (base_prompt, model_output["image"])
+                )
+            else:
+                judgement: JudgeMent = self.predict(
+                    base_prompt=base_prompt, generated_image=model_output["image"]
+                )
         return {
             "score": judgement.score,
             "is_image_correct": judgement.judgement == "correct",
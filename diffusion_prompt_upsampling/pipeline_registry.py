@@ -0,0 +1,112 @@
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, Optional
+
+from .placement import PlacementPlan, apply_placement, plan_placement
+
+if TYPE_CHECKING:
+    from diffusers import DiffusionPipeline
+
+PipelineLoader = Callable[[str, PlacementPlan], "DiffusionPipeline"]
+
+_PIPELINES: Dict[Hashable, "DiffusionPipeline"] = {}
+_PLANS: Dict[Hashable, PlacementPlan] = {}
+_PIPELINE_LOCKS: Dict[Hashable, threading.Lock] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def load_pipeline(model_name_or_path: str, plan: PlacementPlan) -> "DiffusionPipeline":
+    # torch and diffusers take seconds to import, so they are only imported once
+    # a pipeline is actually needed
+    import torch
+    from diffusers import AutoPipelineForText2Image
+
+    kwargs = {"torch_dtype": getattr(torch, plan.dtype), "use_safetensors": True}
+    if plan.dtype == "float16":
+        try:
+            pipeline = AutoPipelineForText2Image.from_pretrained(
+                model_name_or_path, variant="fp16", **kwargs
+            )
+        except (OSError, ValueError):
+            # Not every checkpoint is published with half-precision weights
+            pipeline = AutoPipelineForText2Image.from_pretrained(
+                model_name_or_path, **kwargs
+            )
+    else:
+        pipeline = AutoPipelineForText2Image.from_pretrained(
+            model_name_or_path, **kwargs
+        )
+    return apply_placement(pipeline, plan)
+
+
+def get_placement_plan(
+    model_name_or_path: str,
+    device: Optional[str] = None,
+    strategy: Optional[str] = None,
+    dtype: Optional[str] = None,
+    batch_size: int = 1,
+    image_size: int = 1024,
+) -> PlacementPlan:
+    """Returns the placement plan of this process for the given configuration.
+
+    The plan is made with `plan_placement` the first time a configuration is
+    requested and reused afterwards. Plans depend on the free memory of the
+    device, which drops once a pipeline is loaded, so planning again for every
+    model variant would give the later variants another placement, and hence
+    another copy of the weights, instead of the pipeline already registered.
+    """
+    key = (model_name_or_path, device, strategy, dtype, batch_size, image_size)
+    with _REGISTRY_LOCK:
+        plan = _PLANS.get(key)
+    if plan is None:
+        plan = plan_placement(
+            model_name_or_path,
+            device=device,
+            strategy=strategy,
+            dtype=dtype,
+            batch_size=batch_size,
+            image_size=image_size,
+        )
+        with _REGISTRY_LOCK:
+            plan = _PLANS.setdefault(key, plan)
+    return plan
+
+
+def get_pipeline(
+    model_name_or_path: str,
+    plan: PlacementPlan,
+    loader: Optional[PipelineLoader] = None,
+) -> "DiffusionPipeline":
+    """Returns the pipeline loaded in this process for the given placement.
+
+    The pipeline is loaded with `loader` (`load_pipeline` by default) the first
+    time it is requested and reused afterwards, so that all the model variants
+    of a process share a single copy of the weights. Concurrent requests for the
+    same configuration wait for one load instead of loading it several times.
+    """
+    key = (model_name_or_path, plan.get_key())
+    with _REGISTRY_LOCK:
+        pipeline = _PIPELINES.get(key)
+        if pipeline is not None:
+            return pipeline
+        lock = _PIPELINE_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _PIPELINES:
+            loader = load_pipeline if loader is None else loader
+            pipeline = loader(model_name_or_path, plan)
+            with _REGISTRY_LOCK:
+                _PIPELINES[key] = pipeline
+        return _PIPELINES[key]
+
+
+def register_pipeline(
+    model_name_or_path: str, plan: PlacementPlan, pipeline: "DiffusionPipeline"
+) -> None:
+    with _REGISTRY_LOCK:
+        _PIPELINES[(model_name_or_path, plan.get_key())] = pipeline
+
+
+def clear_pipelines() -> None:
+    with _REGISTRY_LOCK:
+        _PIPELINES.clear()
+        _PIPELINE_LOCKS.clear()
+        _PLANS.clear()
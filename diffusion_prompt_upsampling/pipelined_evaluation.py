@@ -0,0 +1,297 @@
+import asyncio
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import weave
+from weave.flow.scorer import get_scorer_attributes
+
+from .diffusion_model import StableDiffusionXLModel
+from .evaluation_log import (
+    EvaluationLog,
+    apply_scorers,
+    get_evaluation_fingerprint,
+    iter_examples,
+)
+from .usage import BudgetExceededError
+
+_DONE = object()
+
+
+class StageMetrics:
+
+    def __init__(self, name: str, num_workers: int):
+        self.name = name
+        self.num_workers = num_workers
+        self.num_items = 0
+        self.num_calls = 0
+        self.busy_time = 0.0
+
+    @contextmanager
+    def track(self, num_items: int = 1):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy_time += time.perf_counter() - start_time
+            self.num_items += num_items
+            self.num_calls += 1
+
+    def summary(self, wall_time: float) -> Dict[str, Any]:
+        return {
+            "num_workers": self.num_workers,
+            "num_items": self.num_items,
+            "num_calls": self.num_calls,
+            "busy_time": self.busy_time,
+            "utilization": (
+                self.busy_time / (wall_time * self.num_workers) if wall_time else 0.0
+            ),
+            "throughput": self.num_items / wall_time if wall_time else 0.0,
+        }
+
+
+class PipelinedEvaluation:
+    """Runs a `weave.Evaluation` of a `StableDiffusionXLModel` as a staged pipeline.
+
+    Prompt upsampling and scoring are performed by pools of asynchronous workers,
+    while a single diffusion worker batches all prompts waiting in its queue, so
+    that the OpenAI round-trips overlap with denoising. The stages communicate
+    through bounded queues, so a slow stage applies backpressure to the stages
+    feeding it. The rows and the summary have the same format as the ones
+    produced by `weave.Evaluation.evaluate`.
+
+    If `log_path` is given, completed rows are appended to an `EvaluationLog`
+    instead of being kept in memory, rows already completed in the log are
+    skipped, and the summary is computed from the log. `rows` such as
+    `PromptShards` replace the rows of the dataset and are streamed into the
+    pipeline as its first stage has room for them.
+    """
+
+    def __init__(
+        self,
+        evaluation: weave.Evaluation,
+        num_upsampler_workers: int = 8,
+        num_judge_workers: int = 8,
+        queue_size: int = 16,
+        log_path: Optional[str] = None,
+        rows: Optional[Iterable[Dict]] = None,
+    ):
+        self.evaluation = evaluation
+        self.num_upsampler_workers = num_upsampler_workers
+        self.num_judge_workers = num_judge_workers
+        self.queue_size = queue_size
+        self.log = EvaluationLog(log_path) if log_path is not None else None
+        self.rows = rows
+        self.stage_metrics: Dict[str, StageMetrics] = {}
+        self.wall_time = 0.0
+
+    async def _upsample_worker(
+        self,
+        model: StableDiffusionXLModel,
+        input_queue: asyncio.Queue,
+        diffusion_queue: asyncio.Queue,
+        eval_rows: Dict[int, Dict],
+    ):
+        while True:
+            item = await input_queue.get()
+            if item is _DONE:
+                return
+            idx, example = item
+            try:
+                with self.stage_metrics["upsample"].track():
+                    start_time = time.time()
+                    prompt = await asyncio.to_thread(
+                        model.upsample, example["base_prompt"]
+                    )
+                    upsample_latency = time.time() - start_time
+            except BudgetExceededError:
+                raise
+            except Exception:
+                print("Upsampling failed")
+                traceback.print_exc()
+                self._complete_row(
+                    eval_rows, idx, example, {"model_output": None, "scores": {}}, True
+                )
+                continue
+            negative_prompt = model.get_negative_prompt(example.get("negative_prompt"))
+            batch_key = model.get_batch_key(
+                negative_prompt,
+                example.get("num_inference_steps", 50),
+                example.get("image_size", 1024),
+                example.get("guidance_scale", 7.0),
+            )
+            await diffusion_queue.put(
+                (
+                    idx,
+                    example,
+                    batch_key,
+                    (prompt, negative_prompt, None),
+                    upsample_latency,
+                )
+            )
+
+    async def _diffusion_worker(
+        self,
+        model: StableDiffusionXLModel,
+        diffusion_queue: asyncio.Queue,
+        judge_queue: asyncio.Queue,
+        eval_rows: Dict[int, Dict],
+    ):
+        is_done = False
+        while not is_done:
+            item = await diffusion_queue.get()
+            if item is _DONE:
+                break
+            queued_items = [item]
+            while len(queued_items) < model.batch_size and not diffusion_queue.empty():
+                item = diffusion_queue.get_nowait()
+                if item is _DONE:
+                    is_done = True
+                    break
+                queued_items.append(item)
+            batches: Dict[Any, List] = {}
+            for item in queued_items:
+                batches.setdefault(item[2], []).append(item)
+            for batch_key, items in batches.items():
+                try:
+                    with self.stage_metrics["diffusion"].track(num_items=len(items)):
+                        start_time = time.time()
+                        images = await asyncio.to_thread(
+                            model._generate_batch,
+                            batch_key,
+                            [
+                                generation_input
+                                for _, _, _, generation_input, _ in items
+                            ],
+                        )
+                        diffusion_latency = time.time() - start_time
+                except Exception:
+                    print("Image generation failed")
+                    traceback.print_exc()
+                    for idx, example, *_ in items:
+                        self._complete_row(
+                            eval_rows,
+                            idx,
+                            example,
+                            {"model_output": None, "scores": {}},
+                            True,
+                        )
+                    continue
+                for (idx, example, _, (prompt, _, _), upsample_latency), image in zip(
+                    items, images
+                ):
+                    await judge_queue.put(
+                        (
+                            idx,
+                            example,
+                            {"image": image, "upsampled_prompt": prompt},
+                            upsample_latency + diffusion_latency,
+                        )
+                    )
+        for _ in range(self.num_judge_workers):
+            await judge_queue.put(_DONE)
+
+    async def _judge_worker(
+        self, judge_queue: asyncio.Queue, eval_rows: Dict[int, Dict]
+    ):
+        while True:
+            item = await judge_queue.get()
+            if item is _DONE:
+                return
+            idx, example, model_output, model_latency = item
+            with self.stage_metrics["judge"].track():
+                scores = await apply_scorers(self.evaluation, example, model_output)
+            self._complete_row(
+                eval_rows,
+                idx,
+                example,
+                {
+                    "model_output": model_output,
+                    "scores": scores,
+                    "model_latency": model_latency,
+                },
+            )
+
+    def _complete_row(
+        self,
+        eval_rows: Dict[int, Dict],
+        idx: int,
+        example: Dict,
+        eval_row: Dict,
+        failed: bool = False,
+    ):
+        if self.log is not None:
+            self.log.append(idx, eval_row, example, failed)
+        else:
+            eval_rows[idx] = eval_row
+
+    @weave.op()
+    async def evaluate(self, model: StableDiffusionXLModel) -> dict:
+        rows = list(self.evaluation.dataset.rows) if self.rows is None else self.rows
+        num_examples = len(rows) * self.evaluation.trials
+        completed_examples = {}
+        if self.log is not None:
+            self.log.check_fingerprint(
+                get_evaluation_fingerprint(self.evaluation, model, rows)
+            )
+            completed_examples = self.log.get_completed_examples()
+        eval_rows: Dict[int, Dict] = {}
+        self.stage_metrics = {
+            "upsample": StageMetrics("upsample", self.num_upsampler_workers),
+            "diffusion": StageMetrics("diffusion", 1),
+            "judge": StageMetrics("judge", self.num_judge_workers),
+        }
+        input_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def input_stage():
+            for idx, example in iter_examples(rows, self.evaluation.trials):
+                if self.log is None or not self.log.is_completed(
+                    completed_examples, idx, example
+                ):
+                    await input_queue.put((idx, example))
+            for _ in range(self.num_upsampler_workers):
+                await input_queue.put(_DONE)
+
+        diffusion_queue = asyncio.Queue(maxsize=self.queue_size)
+        judge_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def upsample_stage():
+            await asyncio.gather(
+                *[
+                    self._upsample_worker(
+                        model, input_queue, diffusion_queue, eval_rows
+                    )
+                    for _ in range(self.num_upsampler_workers)
+                ]
+            )
+            await diffusion_queue.put(_DONE)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(
+            input_stage(),
+            upsample_stage(),
+            self._diffusion_worker(model, diffusion_queue, judge_queue, eval_rows),
+            *[
+                self._judge_worker(judge_queue, eval_rows)
+                for _ in range(self.num_judge_workers)
+            ],
+        )
+        self.wall_time = time.perf_counter() - start_time
+
+        if self.log is not None:
+            return await self.log.summarize(self.evaluation, num_examples)
+        eval_table = [eval_rows[idx] for idx in range(num_examples)]
+        for eval_row in eval_table:
+            for scorer in self.evaluation.scorers or []:
+                scorer_name, _, _ = get_scorer_attributes(scorer)
+                eval_row["scores"].setdefault(scorer_name, {})
+        summary = await self.evaluation.summarize(eval_table)
+        print("Evaluation summary", summary)
+        return summary
+
+    def get_stage_metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: metrics.summary(self.wall_time)
+            for name, metrics in self.stage_metrics.items()
+        }
@@ -0,0 +1,327 @@
+import glob
+import json
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+# From the most to the least throughput, the ways a pipeline can be placed
+STRATEGIES = (
+    "full_device",
+    "sliced_device",
+    "model_offload",
+    "sequential_offload",
+    "cpu",
+)
+
+DTYPE_SIZES = {"float32": 4, "float16": 2, "bfloat16": 2}
+
+# The parameter counts of the components of the pipelines used with this repo,
+# for when their weights are not available locally
+KNOWN_COMPONENT_PARAMETERS = {
+    "stabilityai/stable-diffusion-xl-base-1.0": {
+        "unet": 2_567_463_684,
+        "text_encoder": 123_060_480,
+        "text_encoder_2": 694_659_840,
+        "vae": 83_653_863,
+    },
+}
+
+# Rough activation footprints of SDXL for a single 1024x1024 image in float16,
+# which the estimates scale by the number of pixels, the batch size and the
+# dtype. The denoising figure accounts for classifier-free guidance doubling
+# the batch, and the decoding one for the VAE decoding the whole latent at
+# once, which tiling reduces to tiles of 512x512 pixels.
+UNET_ACTIVATION_BYTES = 1.0 * 1024**3
+VAE_ACTIVATION_BYTES = 3.0 * 1024**3
+ATTENTION_SLICING_FACTOR = 0.5
+VAE_TILE_PIXELS = 512 * 512
+# The largest block kept on the device by sequential offloading, as a fraction
+# of the weights of the largest component
+SEQUENTIAL_OFFLOAD_FRACTION = 0.05
+
+# Only this fraction of the free memory of a device is planned for, leaving
+# room for fragmentation and for the other allocations of the process
+MEMORY_HEADROOM = 0.9
+
+
+class PlacementPlan(BaseModel):
+    """How a diffusion pipeline is placed on the devices of the machine.
+
+    - `full_device` moves the whole pipeline to `device`.
+    - `sliced_device` also enables attention and VAE slicing and VAE tiling, so
+        that the activations fit next to the weights, at some cost in speed.
+    - `model_offload` keeps the weights on the CPU and moves every component to
+        `device` while it runs.
+    - `sequential_offload` does the same for every submodule, which fits in
+        very little device memory but is much slower.
+    - `cpu` runs the pipeline on the CPU in `dtype`, `float32` unless it only
+        fits in `bfloat16`.
+
+    `estimated_peak_memory` is the estimated peak of the memory of the device
+    the plan is limited by, the GPU except for the `cpu` strategy, and
+    `available_memory` the memory available there when the plan was made.
+    """
+
+    strategy: str
+    device: str
+    dtype: str
+    enable_attention_slicing: bool = False
+    enable_vae_slicing: bool = False
+    enable_vae_tiling: bool = False
+    estimated_peak_memory: int = 0
+    available_memory: Optional[int] = None
+    reason: str = ""
+
+    def get_key(self) -> Tuple:
+        return (
+            self.strategy,
+            self.device,
+            self.dtype,
+            self.enable_attention_slicing,
+            self.enable_vae_slicing,
+            self.enable_vae_tiling,
+        )
+
+
+def get_cpu_memory() -> int:
+    # Memory that can be allocated without swapping, which on Linux includes the
+    # page cache that the kernel can reclaim
+    if os.path.exists("/proc/meminfo"):
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_device_memory(device: str) -> Optional[int]:
+    if not device.startswith("cuda"):
+        return None
+    import torch
+
+    if not torch.cuda.is_available():
+        return None
+    free_memory, _ = torch.cuda.mem_get_info(torch.device(device))
+    return free_memory
+
+
+def count_safetensors_parameters(path: str) -> int:
+    # The header of a safetensors file lists the shape of every tensor, so the
+    # parameters are counted without loading any weight
+    num_parameters = 0
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    for name, tensor in header.items():
+        if name == "__metadata__":
+            continue
+        tensor_size = 1
+        for dim in tensor["shape"]:
+            tensor_size *= dim
+        num_parameters += tensor_size
+    return num_parameters
+
+
+def get_component_parameters(model_name_or_path: str) -> Dict[str, int]:
+    if os.path.isdir(model_name_or_path):
+        component_parameters = {}
+        for component in ["unet", "text_encoder", "text_encoder_2", "vae"]:
+            paths = glob.glob(
+                os.path.join(model_name_or_path, component, "*.safetensors")
+            )
+            # Only one variant of the weights is loaded
+            paths = [p for p in paths if ".fp16." not in p] or paths
+            if paths:
+                component_parameters[component] = sum(
+                    count_safetensors_parameters(path) for path in paths
+                )
+        if component_parameters:
+            return component_parameters
+    # Pipelines that are neither local nor known are assumed to be the size of
+    # SDXL, the largest pipeline used with this repo
+    return KNOWN_COMPONENT_PARAMETERS.get(
+        model_name_or_path,
+        KNOWN_COMPONENT_PARAMETERS["stabilityai/stable-diffusion-xl-base-1.0"],
+    )
+
+
+def estimate_peak_memory(
+    component_parameters: Dict[str, int],
+    strategy: str,
+    dtype: str,
+    batch_size: int = 1,
+    image_size: int = 1024,
+    sliced: bool = False,
+) -> int:
+    dtype_size = DTYPE_SIZES[dtype]
+    component_sizes = {
+        component: num_parameters * dtype_size
+        for component, num_parameters in component_parameters.items()
+    }
+    scale = (image_size / 1024) ** 2 * dtype_size / 2
+    unet_activations = UNET_ACTIVATION_BYTES * scale * batch_size
+    vae_activations = VAE_ACTIVATION_BYTES * scale * batch_size
+    if sliced:
+        # Attention is computed a slice at a time, and the VAE decodes a single
+        # image at a time, a tile at a time
+        unet_activations *= ATTENTION_SLICING_FACTOR
+        vae_activations = (
+            VAE_ACTIVATION_BYTES
+            * min(image_size**2, VAE_TILE_PIXELS)
+            / 1024**2
+            * dtype_size
+            / 2
+        )
+    # Denoising and decoding happen one after the other
+    activations = max(unet_activations, vae_activations)
+    if strategy in ("full_device", "sliced_device", "cpu"):
+        return int(sum(component_sizes.values()) + activations)
+    largest_component = max(component_sizes.values())
+    if strategy == "model_offload":
+        return int(largest_component + activations)
+    return int(largest_component * SEQUENTIAL_OFFLOAD_FRACTION + activations)
+
+
+def plan_placement(
+    model_name_or_path: str,
+    device: Optional[str] = None,
+    strategy: Optional[str] = None,
+    dtype: Optional[str] = None,
+    batch_size: int = 1,
+    image_size: int = 1024,
+    device_memory: Optional[int] = None,
+    cpu_memory: Optional[int] = None,
+) -> PlacementPlan:
+    """Picks the placement with the most throughput that fits in memory.
+
+    On a GPU, the strategies are tried from `full_device` to
+    `sequential_offload` in `float16`, and the first whose estimated peak
+    memory fits in the free memory of the device, and whose weights fit in the
+    memory of the CPU when offloading, is picked. Without a GPU, or if none of
+    them fits, the pipeline runs on the CPU in `float32`, with slicing and
+    then in `bfloat16` if it does not fit otherwise.
+
+    `strategy` and `dtype` force a strategy or a dtype instead, except that a
+    GPU strategy falls back to the CPU on a machine without a GPU, so that the
+    same configuration runs everywhere. A forced strategy other than
+    `sliced_device` is planned without slicing or tiling, which the policy
+    only adds to fit in memory, as VAE tiling changes the decoded images.
+    `device_memory` and `cpu_memory` replace the detected free memory, e.g. to
+    plan for another machine.
+    """
+    if strategy is not None and strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {strategy}, expected one of {STRATEGIES}")
+    if dtype is not None and dtype not in DTYPE_SIZES:
+        raise ValueError(f"Unknown dtype {dtype}, expected one of {list(DTYPE_SIZES)}")
+    device = device or "cuda"
+    component_parameters = get_component_parameters(model_name_or_path)
+    cpu_memory = get_cpu_memory() if cpu_memory is None else cpu_memory
+    if device_memory is None:
+        device_memory = get_device_memory(device)
+
+    def estimate(strategy: str, dtype: str, sliced: bool) -> int:
+        return estimate_peak_memory(
+            component_parameters, strategy, dtype, batch_size, image_size, sliced
+        )
+
+    def fits(strategy: str, dtype: str, sliced: bool) -> bool:
+        if strategy == "cpu":
+            return estimate(strategy, dtype, sliced) <= cpu_memory * MEMORY_HEADROOM
+        if strategy in ("model_offload", "sequential_offload") and (
+            estimate("cpu", dtype, sliced) > cpu_memory * MEMORY_HEADROOM
+        ):
+            return False
+        return estimate(strategy, dtype, sliced) <= device_memory * MEMORY_HEADROOM
+
+    def plan(strategy: str, dtype: str, sliced: bool, reason: str) -> PlacementPlan:
+        return PlacementPlan(
+            strategy=strategy,
+            device="cpu" if strategy == "cpu" else device,
+            dtype=dtype,
+            enable_attention_slicing=sliced,
+            enable_vae_slicing=sliced,
+            enable_vae_tiling=sliced,
+            estimated_peak_memory=estimate(strategy, dtype, sliced),
+            available_memory=cpu_memory if strategy == "cpu" else device_memory,
+            reason=reason,
+        )
+
+    def plan_cpu(reason: str) -> PlacementPlan:
+        # float32 is the fastest dtype on most CPUs, slicing and bfloat16 are
+        # only used when memory is short
+        options = [("float32", False), ("float32", True), ("bfloat16", True)]
+        if dtype is not None:
+            options = [(dtype, False), (dtype, True)]
+        for cpu_dtype, sliced in options:
+            if fits("cpu", cpu_dtype, sliced):
+                return plan("cpu", cpu_dtype, sliced, reason)
+        cpu_dtype, sliced = options[-1]
+        return plan("cpu", cpu_dtype, sliced, f"{reason}, may not fit in memory")
+
+    if device == "cpu" or device_memory is None:
+        if strategy not in (None, "cpu"):
+            return plan_cpu(f"{strategy} requested but {device} is not available")
+        return plan_cpu("cpu requested" if device == "cpu" else "no GPU")
+    if strategy == "cpu":
+        return plan_cpu("cpu requested")
+    if strategy is not None:
+        return plan(
+            strategy,
+            dtype or "float16",
+            strategy == "sliced_device",
+            f"{strategy} requested",
+        )
+    for gpu_strategy in STRATEGIES[:-1]:
+        sliced = gpu_strategy != "full_device"
+        if fits(gpu_strategy, dtype or "float16", sliced):
+            return plan(
+                gpu_strategy,
+                dtype or "float16",
+                sliced,
+                f"fits in the memory of {device}",
+            )
+    return plan_cpu(f"does not fit in the memory of {device}")
+
+
+def apply_placement(pipeline, plan: PlacementPlan):
+    # Pipelines without slicing or tiling, such as the ones of the benchmarks,
+    # are placed as they are
+    for enabled, method in [
+        (plan.enable_attention_slicing, "enable_attention_slicing"),
+        (plan.enable_vae_slicing, "enable_vae_slicing"),
+        (plan.enable_vae_tiling, "enable_vae_tiling"),
+    ]:
+        if enabled and hasattr(pipeline, method):
+            getattr(pipeline, method)()
+    if plan.strategy == "model_offload":
+        pipeline.enable_model_cpu_offload(device=plan.device)
+    elif plan.strategy == "sequential_offload":
+        pipeline.enable_sequential_cpu_offload(device=plan.device)
+    else:
+        pipeline = pipeline.to(plan.device)
+    return pipeline
+
+
+def format_memory(num_bytes: Optional[int]) -> str:
+    return "unknown" if num_bytes is None else f"{num_bytes / 1024**3:.2f} GiB"
+
+
+def describe_plan(plan: PlacementPlan) -> str:
+    options = [
+        name
+        for name, enabled in [
+            ("attention slicing", plan.enable_attention_slicing),
+            ("VAE slicing", plan.enable_vae_slicing),
+            ("VAE tiling", plan.enable_vae_tiling),
+        ]
+        if enabled
+    ]
+    return (
+        f"{plan.strategy} on {plan.device} in {plan.dtype}"
+        + (f" with {', '.join(options)}" if options else "")
+        + f" ({plan.reason}): estimated peak memory "
+        + f"{format_memory(plan.estimated_peak_memory)} of "
+        + f"{format_memory(plan.available_memory)} available"
+    )
@@ -0,0 +1,157 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import rich
+from rich.table import Table
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Profiler:
+    """Records latencies, item counts and OpenAI token usage per named stage.
+
+    A disabled profiler returns a shared no-op context manager from `stage` and
+    ignores everything it is given, so instrumented code paths cost next to
+    nothing unless profiling is switched on with `enable_profiling`. Stages are
+    recorded from judge threads and the event loop at once, so updates are
+    guarded by a lock.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.start_time = time.perf_counter()
+        self.latencies: Dict[str, List[float]] = {}
+        self.num_items: Dict[str, int] = {}
+        self.token_usage: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, latency: float, num_items: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency)
+            self.num_items[name] = self.num_items.get(name, 0) + num_items
+
+    def stage(self, name: str, num_items: int = 1):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._stage(name, num_items)
+
+    @contextmanager
+    def _stage(self, name: str, num_items: int):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time, num_items)
+
+    def step_callback(self, name: str):
+        # A `callback_on_step_end` for diffusers pipelines that records the time
+        # taken by each denoising step
+        last_step_time = time.perf_counter()
+
+        def callback(pipeline, step: int, timestep, callback_kwargs: Dict) -> Dict:
+            nonlocal last_step_time
+            step_time = time.perf_counter()
+            self.record(name, step_time - last_step_time)
+            last_step_time = step_time
+            return callback_kwargs
+
+        return callback
+
+    def record_usage(self, name: str, usage: Any) -> None:
+        if not self.enabled or usage is None:
+            return
+        with self._lock:
+            stage_usage = self.token_usage.setdefault(
+                name, {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            )
+            for key in stage_usage:
+                stage_usage[key] += getattr(usage, key, 0) or 0
+
+    def get_peak_memory(self) -> Dict[str, float]:
+        # `ru_maxrss` is reported in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_memory = {
+            "cpu_max_rss_mb": max_rss / (1024**2 if sys.platform == "darwin" else 1024)
+        }
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            peak_memory["cuda_max_allocated_mb"] = (
+                torch.cuda.max_memory_allocated() / 1024**2
+            )
+        return peak_memory
+
+    def summary(self) -> Dict[str, Any]:
+        wall_time = time.perf_counter() - self.start_time
+        with self._lock:
+            latencies_by_stage = {
+                name: list(latencies) for name, latencies in self.latencies.items()
+            }
+        stages = {}
+        for name, latencies in latencies_by_stage.items():
+            stages[name] = {
+                "count": len(latencies),
+                "num_items": self.num_items[name],
+                "total": float(np.sum(latencies)),
+                "mean": float(np.mean(latencies)),
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(np.max(latencies)),
+                "throughput": self.num_items[name] / wall_time,
+                **self.token_usage.get(name, {}),
+            }
+        return {
+            "wall_time": wall_time,
+            "stages": stages,
+            "peak_memory": self.get_peak_memory(),
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self, title: Optional[str] = "Stage latencies (seconds)"):
+        summary = self.summary()
+        table = Table(title=title)
+        columns = ["stage", "count", "mean", "p50", "p95", "max", "items/s", "tokens"]
+        for column in columns:
+            table.add_column(column)
+        for name, stats in summary["stages"].items():
+            table.add_row(
+                name,
+                str(stats["count"]),
+                f"{stats['mean']:.4f}",
+                f"{stats['p50']:.4f}",
+                f"{stats['p95']:.4f}",
+                f"{stats['max']:.4f}",
+                f"{stats['throughput']:.2f}",
+                str(stats.get("total_tokens", "")),
+            )
+        rich.print(table)
+        rich.print(f"Wall time: {summary['wall_time']:.2f}s")
+        rich.print(f"Peak memory: {summary['peak_memory']}")
+
+
+_PROFILER = Profiler(enabled=False)
+
+
+def get_profiler() -> Profiler:
+    return _PROFILER
+
+
+def enable_profiling() -> Profiler:
+    global _PROFILER
+    _PROFILER = Profiler(enabled=True)
+    return _PROFILER
+
+
+def disable_profiling() -> None:
+    global _PROFILER
+    _PROFILER = Profiler(enabled=False)
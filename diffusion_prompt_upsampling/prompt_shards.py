@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import unicodedata
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_FILE = "manifest.json"
+
+
+def normalize_prompt(prompt: str) -> str:
+    # Unicode compatibility characters such as non-breaking spaces or full-width
+    # letters are folded, and runs of whitespace collapsed to a single space
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def get_prompt_digest(prompt: str) -> bytes:
+    # Prompts differing only in case are duplicates. Only an 8-byte digest of
+    # every prompt is kept, so deduplicating 100k+ prompts takes a few MB.
+    return hashlib.blake2b(prompt.casefold().encode("utf-8"), digest_size=8).digest()
+
+
+def write_prompt_shards(
+    rows: Iterable[Dict],
+    output_dir: str,
+    prompt_column: str = "base_prompt",
+    extra_columns: Optional[List[str]] = None,
+    shard_size: int = 10000,
+    name: Optional[str] = None,
+    source: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Writes the prompts of a stream of rows to chunked Parquet shards.
+
+    The rows are consumed in a single pass: every prompt is normalized with
+    `normalize_prompt`, empty prompts and duplicates of an earlier prompt are
+    dropped, and the remaining rows are written to a new shard every
+    `shard_size` rows, so only one shard is held in memory at a time. The
+    prompt is stored as `base_prompt`, along with the `extra_columns` of the
+    row. A manifest listing the shards is written last, so that the shards of
+    an interrupted ingestion are never read. Returns the manifest.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    extra_columns = extra_columns or []
+    seen_digests = set()
+    shards, chunk = [], []
+    num_rows = num_duplicates = num_empty = 0
+
+    def write_shard():
+        shard_path = f"prompts-{len(shards):05d}.parquet"
+        pq.write_table(
+            pa.Table.from_pylist(chunk), os.path.join(output_dir, shard_path)
+        )
+        shards.append({"path": shard_path, "num_rows": len(chunk)})
+        chunk.clear()
+
+    for row in rows:
+        prompt = normalize_prompt(row[prompt_column] or "")
+        if not prompt:
+            num_empty += 1
+            continue
+        digest = get_prompt_digest(prompt)
+        if digest in seen_digests:
+            num_duplicates += 1
+            continue
+        seen_digests.add(digest)
+        chunk.append(
+            {"base_prompt": prompt, **{column: row[column] for column in extra_columns}}
+        )
+        num_rows += 1
+        if len(chunk) == shard_size:
+            write_shard()
+    if chunk:
+        write_shard()
+
+    manifest = {
+        "name": name,
+        "source": source,
+        "num_rows": num_rows,
+        "num_duplicates": num_duplicates,
+        "num_empty": num_empty,
+        "shards": shards,
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def ingest_hf_dataset(
+    dataset_name: str,
+    prompt_column: str,
+    output_dir: str,
+    split: str = "train",
+    config_name: Optional[str] = None,
+    extra_columns: Optional[List[str]] = None,
+    shard_size: int = 10000,
+    name: Optional[str] = None,
+) -> Dict[str, Any]:
+    # The dataset is streamed rather than downloaded and loaded as a whole
+    from datasets import load_dataset
+
+    dataset = load_dataset(dataset_name, config_name, split=split, streaming=True)
+    return write_prompt_shards(
+        dataset,
+        output_dir,
+        prompt_column=prompt_column,
+        extra_columns=extra_columns,
+        shard_size=shard_size,
+        name=name or dataset_name.split("/")[-1],
+        source=dataset_name,
+    )
+
+
+class PromptShards:
+    """Rows read lazily from the shards written by `write_prompt_shards`.
+
+    Iterating over the shards reads them a record batch at a time, and the
+    number of rows comes from the manifest, so the rows can be passed to the
+    evaluation runners in place of the rows of a `weave.Dataset` and evaluated
+    with constant memory. The object only holds the path of the shards, so it
+    can be sent to the workers of a `ShardedEvaluation`.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1024):
+        self.path = path
+        self.batch_size = batch_size
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.manifest["name"]
+
+    def __len__(self) -> int:
+        return self.manifest["num_rows"]
+
+    def __iter__(self) -> Iterator[Dict]:
+        for shard in self.manifest["shards"]:
+            shard_file = pq.ParquetFile(os.path.join(self.path, shard["path"]))
+            for batch in shard_file.iter_batches(batch_size=self.batch_size):
+                yield from batch.to_pylist()
+
+    def head(self, num_rows: int) -> List[Dict]:
+        rows = []
+        for row in self:
+            if len(rows) == num_rows:
+                break
+            rows.append(row)
+        return rows
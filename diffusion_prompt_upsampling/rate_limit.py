@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import openai
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at `capacity_per_minute` per minute."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.refill_rate = capacity_per_minute / 60.0
+        self._available = capacity_per_minute
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float) -> float:
+        # Reserves `amount` tokens, possibly driving the bucket into debt, and
+        # returns how long the caller has to wait before the reservation is valid
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.capacity,
+                self._available + (now - self._last_refill) * self.refill_rate,
+            )
+            self._last_refill = now
+            self._available -= amount
+            return max(0.0, -self._available / self.refill_rate)
+
+    def acquire(self, amount: float = 1) -> None:
+        wait_time = self._reserve(amount)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class RateLimiter:
+    """Limits the number of in-flight requests and the request/token throughput.
+
+    The limits are shared by all the threads using the limiter through `limit`.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self._request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self._token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self._semaphore = (
+            threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        )
+
+    @contextmanager
+    def limit(self, num_tokens: int = 0):
+        if self._request_bucket is not None:
+            self._request_bucket.acquire(1)
+        if self._token_bucket is not None and num_tokens > 0:
+            self._token_bucket.acquire(num_tokens)
+        if self._semaphore is None:
+            yield
+            return
+        with self._semaphore:
+            yield
+
+
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(
+        error,
+        (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError),
+    ):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def get_backoff_delay(
+    attempt: int, base_delay: float = 1.0, max_delay: float = 60.0
+) -> float:
+    # Exponential backoff with full jitter, so that concurrent requests which were
+    # rate-limited together do not retry in lockstep
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
@@ -0,0 +1,215 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import weave
+
+from .evaluation_log import (
+    EvaluationLog,
+    bounded_foreach,
+    get_evaluation_fingerprint,
+    iter_examples,
+    predict_and_score,
+)
+from .image_transport import ImageStore
+
+EvaluationBuilder = Callable[[str], Tuple[weave.Evaluation, Any]]
+
+_DONE = "done"
+
+
+def get_shard_indices(num_rows: int, num_shards: int, shard_id: int) -> List[int]:
+    # Rows are assigned round-robin rather than in contiguous blocks, so that the
+    # shards stay balanced when the dataset is sorted by category or difficulty
+    return list(range(shard_id, num_rows, num_shards))
+
+
+def set_visible_device(device: str) -> str:
+    # Each worker only sees its own GPU, so the models it builds can keep using
+    # the default "cuda" device. This has to happen before torch is imported.
+    if device.startswith("cuda"):
+        _, _, device_index = device.partition(":")
+        os.environ["CUDA_VISIBLE_DEVICES"] = device_index or "0"
+        return "cuda"
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    return device
+
+
+def run_shard(
+    build_fn: EvaluationBuilder,
+    shard_id: int,
+    device: str,
+    indices: List[int],
+    parallelism: int,
+    result_queue: multiprocessing.Queue,
+    rows: Optional[Iterable[Dict]] = None,
+    image_store: Optional[ImageStore] = None,
+):
+    device = set_visible_device(device)
+    evaluation, model = build_fn(device)
+    rows = list(evaluation.dataset.rows) if rows is None else rows
+    shard_indices = set(indices)
+    shard_examples = (
+        (idx, example)
+        for idx, example in iter_examples(rows, evaluation.trials)
+        if idx in shard_indices
+    )
+
+    async def eval_example(item: Tuple[int, Dict]) -> Dict:
+        idx, example = item
+        eval_row, failed = await predict_and_score(evaluation, model, example)
+        return EvaluationLog.make_row(idx, eval_row, example, failed, image_store)
+
+    async def evaluate_shard():
+        async for eval_row in bounded_foreach(
+            shard_examples, eval_example, parallelism
+        ):
+            result_queue.put((shard_id, eval_row))
+
+    asyncio.run(evaluate_shard())
+    result_queue.put((shard_id, _DONE))
+
+
+class ShardedEvaluation:
+    """Runs a `weave.Evaluation` across several worker processes.
+
+    `build_fn` is called with a device name in every worker, as well as with
+    "cpu" in the coordinator, and returns the evaluation and the model to
+    evaluate; it must be picklable, e.g. a module-level function or a
+    `functools.partial` of one. The rows of the evaluation are split
+    deterministically into `num_shards` shards, each evaluated by a worker on
+    `devices[shard_id % len(devices)]`.
+
+    Workers stream the rows they evaluate back to the coordinator, which
+    appends them to the `EvaluationLog` at `results_path`. Running the
+    evaluation again with the same log only evaluates the rows that are missing
+    or failed, so a crashed shard is resumed rather than restarted, and the
+    summary is computed over all the rows of the log with
+    `weave.Evaluation.summarize`, exactly as a single-process evaluation would.
+
+    As with `ResumableEvaluation`, `rows` such as `PromptShards` replace the
+    rows of the dataset and are streamed by every worker.
+    """
+
+    def __init__(
+        self,
+        build_fn: EvaluationBuilder,
+        num_shards: int,
+        results_path: str,
+        devices: Optional[Sequence[str]] = None,
+        parallelism: int = 8,
+        max_restarts: int = 1,
+        rows: Optional[Iterable[Dict]] = None,
+    ):
+        self.build_fn = build_fn
+        self.num_shards = num_shards
+        self.results_path = results_path
+        self.log = EvaluationLog(results_path)
+        self.devices = list(devices) if devices else ["cpu"]
+        self.parallelism = parallelism
+        self.max_restarts = max_restarts
+        self.rows = rows
+
+    def get_pending_indices(self, num_rows: int, shard_id: int) -> List[int]:
+        return self.log.get_pending_indices(
+            get_shard_indices(num_rows, self.num_shards, shard_id)
+        )
+
+    def _start_shard(
+        self,
+        context: multiprocessing.context.BaseContext,
+        shard_id: int,
+        indices: List[int],
+        result_queue: multiprocessing.Queue,
+    ) -> multiprocessing.Process:
+        process = context.Process(
+            target=run_shard,
+            args=(
+                self.build_fn,
+                shard_id,
+                self.devices[shard_id % len(self.devices)],
+                indices,
+                self.parallelism,
+                result_queue,
+                self.rows,
+                self.log.image_store,
+            ),
+            name=f"evaluation-shard-{shard_id}",
+        )
+        process.start()
+        return process
+
+    def run(self, shard_ids: Optional[Sequence[int]] = None) -> Dict:
+        evaluation, model = self.build_fn("cpu")
+        rows = list(evaluation.dataset.rows) if self.rows is None else self.rows
+        num_rows = len(rows) * evaluation.trials
+        self.log.check_fingerprint(get_evaluation_fingerprint(evaluation, model, rows))
+        self.log.check_examples(iter_examples(rows, evaluation.trials))
+        shard_ids = range(self.num_shards) if shard_ids is None else shard_ids
+
+        # Workers are spawned rather than forked, as CUDA cannot be initialized
+        # again in a forked process
+        context = multiprocessing.get_context("spawn")
+        result_queue = context.Queue()
+        pending_indices = {
+            shard_id: self.get_pending_indices(num_rows, shard_id)
+            for shard_id in shard_ids
+        }
+        num_pending = sum(len(indices) for indices in pending_indices.values())
+        processes = {
+            shard_id: self._start_shard(context, shard_id, indices, result_queue)
+            for shard_id, indices in pending_indices.items()
+            if indices
+        }
+        num_restarts = {shard_id: 0 for shard_id in processes}
+        finished_shards, failed_shards = set(), set()
+        num_complete = 0
+        start_time = time.time()
+        while len(finished_shards) + len(failed_shards) < len(processes):
+            try:
+                shard_id, eval_row = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                for shard_id, process in processes.items():
+                    # A worker that exited cleanly has already sent all its
+                    # rows, which are still on their way through the queue
+                    if (
+                        shard_id in finished_shards
+                        or shard_id in failed_shards
+                        or process.exitcode in (None, 0)
+                    ):
+                        continue
+                    # The worker died without reporting that it finished, so
+                    # it is restarted on the rows it did not send back yet
+                    if num_restarts[shard_id] < self.max_restarts:
+                        num_restarts[shard_id] += 1
+                        print(f"Shard {shard_id} crashed, restarting it")
+                        processes[shard_id] = self._start_shard(
+                            context,
+                            shard_id,
+                            self.get_pending_indices(num_rows, shard_id),
+                            result_queue,
+                        )
+                    else:
+                        print(f"Shard {shard_id} crashed")
+                        failed_shards.add(shard_id)
+                continue
+            if eval_row == _DONE:
+                finished_shards.add(shard_id)
+                continue
+            self.log.write(eval_row)
+            num_complete += 1
+            print(
+                f"Evaluated {num_complete} of {num_pending} examples "
+                f"({time.time() - start_time:.1f}s)"
+            )
+        for process in processes.values():
+            process.join()
+        if failed_shards:
+            print(
+                f"Shards {sorted(failed_shards)} did not complete, run the evaluation "
+                f"again with the same results file to resume them"
+            )
+        return asyncio.run(self.log.summarize(evaluation, num_rows))
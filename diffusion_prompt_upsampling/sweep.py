@@ -0,0 +1,167 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+import rich
+import weave
+from rich.table import Table
+
+from .diffusion_model import StableDiffusionXLModel, get_config_name
+from .evaluation_log import apply_scorers
+
+_DONE = object()
+
+
+def flatten_summary(summary: Dict, prefix: str = "") -> Dict[str, Any]:
+    flat_summary = {}
+    for key, value in summary.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat_summary.update(flatten_summary(value, prefix=f"{name}."))
+        else:
+            flat_summary[name] = value
+    return flat_summary
+
+
+def get_summary_table(config: Dict[str, Any], summary: Dict) -> Table:
+    table = Table(title=get_config_name(config))
+    table.add_column("metric")
+    table.add_column("value")
+    for name, value in flatten_summary(summary).items():
+        table.add_row(name, f"{value:.4f}" if isinstance(value, float) else str(value))
+    return table
+
+
+class SweepEvaluation:
+    """Evaluates a `StableDiffusionXLModel` on every configuration of a grid.
+
+    Rather than running a `weave.Evaluation` once per configuration, the images
+    of all the configurations are generated by `StableDiffusionXLModel.sweep`,
+    which upsamples and seeds every prompt once, and they are scored by the
+    scorers of `evaluation` while the next configuration is being generated.
+    Each configuration is summarized with `weave.Evaluation.summarize` into
+    its own table.
+
+    Generated images wait for the judges in a queue of at most `queue_size`
+    images, so that when judging is slower than generation, generation waits
+    for the judges rather than the images of every configuration piling up in
+    memory.
+    """
+
+    def __init__(
+        self,
+        evaluation: weave.Evaluation,
+        grid: Dict[str, List[Any]],
+        num_judge_workers: int = 8,
+        chunk_size: Optional[int] = None,
+        queue_size: int = 16,
+    ):
+        self.evaluation = evaluation
+        self.grid = grid
+        self.num_judge_workers = num_judge_workers
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+
+    async def _judge_worker(
+        self, judge_queue: asyncio.Queue, eval_rows: Dict[str, Dict[int, Dict]]
+    ):
+        while True:
+            item = await judge_queue.get()
+            if item is _DONE:
+                return
+            config, idx, example, model_output, model_latency = item
+            scores = await apply_scorers(self.evaluation, example, model_output)
+            # The image is dropped once scored, so that the rows of all the
+            # configurations can be kept until the end of the sweep
+            eval_rows[get_config_name(config)][idx] = {
+                "model_output": {"upsampled_prompt": model_output["upsampled_prompt"]},
+                "scores": scores,
+                "model_latency": model_latency,
+            }
+
+    async def _put(
+        self, judge_queue: asyncio.Queue, judge_workers: List[asyncio.Task], item
+    ):
+        # Waiting on a full queue is raced against the judge workers, so that
+        # if they fail, e.g. when the usage budget is exceeded, their error is
+        # raised rather than the sweep waiting forever for a queue that nobody
+        # drains anymore
+        put = asyncio.ensure_future(judge_queue.put(item))
+        while not put.done():
+            await asyncio.wait(
+                [put, *[worker for worker in judge_workers if not worker.done()]],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for worker in judge_workers:
+                if worker.done() and (
+                    worker.cancelled() or worker.exception() is not None
+                ):
+                    put.cancel()
+                    worker.result()
+        await put
+
+    @weave.op()
+    async def evaluate(self, model: StableDiffusionXLModel) -> List[Dict]:
+        examples = list(self.evaluation.dataset.rows) * self.evaluation.trials
+        configs, eval_rows = {}, {}
+        judge_queue = asyncio.Queue(maxsize=self.queue_size)
+        judge_workers = [
+            asyncio.create_task(self._judge_worker(judge_queue, eval_rows))
+            for _ in range(self.num_judge_workers)
+        ]
+        sweep = model.sweep(
+            list(self.evaluation.dataset.rows),
+            self.grid,
+            chunk_size=self.chunk_size,
+            trials=self.evaluation.trials,
+        )
+
+        def generate_next():
+            generation_start_time = time.time()
+            return next(sweep, None), time.time() - generation_start_time
+
+        start_time = time.time()
+        # Generation runs in a thread, and the next configuration is generated
+        # while the images of the current one are queued for the judge workers
+        next_result = asyncio.ensure_future(asyncio.to_thread(generate_next))
+        try:
+            while True:
+                result, generation_time = await next_result
+                if result is None:
+                    break
+                next_result = asyncio.ensure_future(asyncio.to_thread(generate_next))
+                config, indices, outputs = result
+                model_latency = generation_time / len(indices)
+                config_name = get_config_name(config)
+                configs[config_name] = config
+                eval_rows.setdefault(config_name, {})
+                for idx, model_output in zip(indices, outputs):
+                    await self._put(
+                        judge_queue,
+                        judge_workers,
+                        (config, idx, examples[idx], model_output, model_latency),
+                    )
+                print(
+                    f"Generated {len(indices)} examples for {config_name} "
+                    f"({time.time() - start_time:.1f}s)"
+                )
+            for _ in judge_workers:
+                await self._put(judge_queue, judge_workers, _DONE)
+            await asyncio.gather(*judge_workers)
+        except BaseException:
+            # The generation already running in its thread cannot be stopped,
+            # but no further configuration is started
+            next_result.cancel()
+            for worker in judge_workers:
+                worker.cancel()
+            raise
+
+        results = []
+        for config_name, config in configs.items():
+            rows = eval_rows[config_name]
+            summary = await self.evaluation.summarize(
+                [rows[idx] for idx in sorted(rows)]
+            )
+            rich.print(get_summary_table(config, summary))
+            results.append({"config": config, "summary": summary})
+        return results
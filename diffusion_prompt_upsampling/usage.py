@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Literal, Optional, Tuple
+
+import rich
+from rich.table import Table
+
+
+logger = logging.getLogger(__name__)
+
+# USD per million prompt and completion tokens of the models used with this
+# repo, at the time of writing. Images are billed as prompt tokens.
+MODEL_PRICES = {
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4": (30.0, 60.0),
+}
+
+USAGE_KEYS = (
+    "num_requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "image_tokens",
+    "total_tokens",
+    "cost",
+)
+
+
+class BudgetExceededError(RuntimeError):
+    """Raised instead of sending a request that would exceed the usage budget."""
+
+
+def estimate_cost(
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    prices: Optional[Dict[str, Tuple[float, float]]] = None,
+) -> float:
+    # Versioned model names such as "gpt-4o-2024-05-13" are priced as their base
+    # model, and unknown models as free
+    prices = MODEL_PRICES if prices is None else prices
+    base_models = [name for name in prices if model.startswith(name)]
+    if not base_models:
+        return 0.0
+    prompt_price, completion_price = prices[max(base_models, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+class UsageTracker:
+    """Aggregates OpenAI token usage per model and per stage, and enforces a budget.
+
+    Every request is recorded with its prompt and completion tokens from the
+    `usage` of the response, the image tokens estimated from the sizes of its
+    images before it was sent, and its cost according to `prices`. Stages are
+    the roles the clients were given, e.g. "upsampler" and "judge".
+
+    `max_tokens` and `max_cost` bound the total usage, or the usage of the last
+    `window_seconds` if set. Before a request is sent, its estimated usage is
+    reserved, so that concurrent requests cannot overshoot the budget together.
+    A request that does not fit raises a `BudgetExceededError` if
+    `on_budget_exceeded` is "stop", which stops the evaluation runners, while
+    "pause" makes it wait until older requests leave the window.
+
+    If `log_path` is set, every request is appended to a JSONL log, read back
+    on startup and before every request, so that a budget holds across
+    resumed runs and across the workers of a sharded evaluation.
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        window_seconds: Optional[float] = None,
+        on_budget_exceeded: Literal["stop", "pause"] = "stop",
+        log_path: Optional[str] = None,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        if on_budget_exceeded not in ("stop", "pause"):
+            raise ValueError("`on_budget_exceeded` must be either 'stop' or 'pause'")
+        if on_budget_exceeded == "pause" and window_seconds is None:
+            raise ValueError("Pausing requires a budget over `window_seconds`")
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.window_seconds = window_seconds
+        self.on_budget_exceeded = on_budget_exceeded
+        self.log_path = log_path
+        self.prices = MODEL_PRICES if prices is None else prices
+        self.by_model: Dict[str, Dict[str, float]] = {}
+        self.by_stage: Dict[str, Dict[str, float]] = {}
+        # The tokens and cost the budget applies to, along with the time, tokens
+        # and cost of every request when the budget is over a window
+        self._spent_tokens, self._spent_cost = 0, 0.0
+        self._window: Deque[Tuple[float, int, float]] = deque()
+        self._reserved_tokens, self._reserved_cost = 0, 0.0
+        self._log_offset = 0
+        self._lock = threading.Lock()
+        # Once a request is refused with "stop", every later request is too
+        self.stopped_error: Optional[BudgetExceededError] = None
+        if self.log_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            with self._lock:
+                self._sync()
+
+    def _add(self, record: Dict[str, Any]) -> None:
+        for totals in [
+            self.by_model.setdefault(record["model"], dict.fromkeys(USAGE_KEYS, 0)),
+            self.by_stage.setdefault(record["stage"], dict.fromkeys(USAGE_KEYS, 0)),
+        ]:
+            totals["num_requests"] += 1
+            for key in USAGE_KEYS[1:]:
+                totals[key] += record[key]
+        if self.window_seconds is not None and (
+            record["time"] < time.time() - self.window_seconds
+        ):
+            return
+        self._spent_tokens += record["total_tokens"]
+        self._spent_cost += record["cost"]
+        if self.window_seconds is not None:
+            self._window.append(
+                (record["time"], record["total_tokens"], record["cost"])
+            )
+
+    def _sync(self) -> None:
+        # Reads the requests logged since the last sync, by this process or by
+        # others, skipping a last line that is still being written
+        if self.log_path is None or not os.path.exists(self.log_path):
+            return
+        with open(self.log_path) as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                self._log_offset += len(line.encode("utf-8"))
+                try:
+                    self._add(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+    def _get_spent(self) -> Tuple[int, float, Optional[float]]:
+        # Returns the tokens and cost counted against the budget, and when the
+        # oldest of them leaves the window
+        if self.window_seconds is None:
+            return self._spent_tokens, self._spent_cost, None
+        window_start = time.time() - self.window_seconds
+        while self._window and self._window[0][0] < window_start:
+            _, num_tokens, cost = self._window.popleft()
+            self._spent_tokens -= num_tokens
+            self._spent_cost -= cost
+        expiry = self._window[0][0] + self.window_seconds if self._window else None
+        return self._spent_tokens, self._spent_cost, expiry
+
+    def _try_reserve(self, num_tokens: int, cost: float) -> Optional[float]:
+        # Reserves the usage of a request and returns None, or returns how long
+        # to wait before trying again
+        with self._lock:
+            self._sync()
+            spent_tokens, spent_cost, expiry = self._get_spent()
+            exceeded = []
+            if (
+                self.max_tokens is not None
+                and spent_tokens + self._reserved_tokens + num_tokens > self.max_tokens
+            ):
+                exceeded.append(f"{spent_tokens} of {self.max_tokens} tokens")
+            if (
+                self.max_cost is not None
+                and spent_cost + self._reserved_cost + cost > self.max_cost
+            ):
+                exceeded.append(f"${spent_cost:.2f} of ${self.max_cost:.2f}")
+            if not exceeded:
+                self._reserved_tokens += num_tokens
+                self._reserved_cost += cost
+                return None
+            # A request larger than the whole budget never fits, and requests
+            # only waiting on other in-flight requests try again shortly
+            fits_alone = (
+                self.max_tokens is None or num_tokens <= self.max_tokens
+            ) and (self.max_cost is None or cost <= self.max_cost)
+            if self.on_budget_exceeded == "stop" or not fits_alone:
+                self.stopped_error = BudgetExceededError(
+                    f"Usage budget exceeded, {' and '.join(exceeded)} spent"
+                )
+                raise self.stopped_error
+            return max(0.1, expiry - time.time()) if expiry is not None else 1.0
+
+    def raise_if_stopped(self) -> None:
+        # For callers behind code that swallows exceptions, such as the model
+        # calls of `weave.Evaluation.predict_and_score`
+        if self.stopped_error is not None:
+            raise self.stopped_error
+
+    def _release(self, num_tokens: int, cost: float) -> None:
+        with self._lock:
+            self._reserved_tokens -= num_tokens
+            self._reserved_cost -= cost
+
+    def _get_reservation(
+        self, model: str, prompt_tokens: int, completion_tokens: int
+    ) -> Tuple[int, float]:
+        return prompt_tokens + completion_tokens, estimate_cost(
+            model, prompt_tokens, completion_tokens, self.prices
+        )
+
+    @contextmanager
+    def reserve(self, model: str, prompt_tokens: int, completion_tokens: int):
+        num_tokens, cost = self._get_reservation(
+            model, prompt_tokens, completion_tokens
+        )
+        while (wait_time := self._try_reserve(num_tokens, cost)) is not None:
+            logger.warning("Usage budget reached, pausing for %.1fs", wait_time)
+            time.sleep(wait_time)
+        try:
+            yield
+        finally:
+            self._release(num_tokens, cost)
+
+    def record(self, model: str, stage: str, usage: Any, image_tokens: int) -> None:
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        record = {
+            "time": time.time(),
+            "model": model,
+            "stage": stage,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "image_tokens": image_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost": estimate_cost(model, prompt_tokens, completion_tokens, self.prices),
+        }
+        with self._lock:
+            if self.log_path is None:
+                self._add(record)
+                return
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self._sync()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            self._sync()
+            spent_tokens, spent_cost, _ = self._get_spent()
+            by_model = {name: dict(totals) for name, totals in self.by_model.items()}
+            by_stage = {name: dict(totals) for name, totals in self.by_stage.items()}
+        total = {
+            key: sum(totals[key] for totals in by_model.values()) for key in USAGE_KEYS
+        }
+        return {
+            "by_model": by_model,
+            "by_stage": by_stage,
+            "total": total,
+            "budget": {
+                "max_tokens": self.max_tokens,
+                "max_cost": self.max_cost,
+                "window_seconds": self.window_seconds,
+                "spent_tokens": spent_tokens,
+                "spent_cost": spent_cost,
+            },
+        }
+
+    def print_summary(self, title: Optional[str] = "OpenAI usage"):
+        summary = self.summary()
+        table = Table(title=title)
+        columns = ["model or stage", "requests", "prompt", "completion", "image"]
+        for column in columns + ["total", "cost"]:
+            table.add_column(column)
+        rows = [
+            *summary["by_model"].items(),
+            *[
+                (f"stage: {name}", totals)
+                for name, totals in summary["by_stage"].items()
+            ],
+            ("total", summary["total"]),
+        ]
+        for name, totals in rows:
+            table.add_row(
+                name,
+                *[str(int(totals[key])) for key in USAGE_KEYS[:-1]],
+                f"${totals['cost']:.4f}",
+            )
+        rich.print(table)
+        rich.print(f"Budget: {summary['budget']}")
+
+
+_USAGE_TRACKER = UsageTracker()
+
+
+def get_usage_tracker() -> UsageTracker:
+    return _USAGE_TRACKER
+
+
+def track_usage(**kwargs) -> UsageTracker:
+    # Replaces the tracker shared by all the clients of the process, e.g. to set
+    # a budget for an evaluation
+    global _USAGE_TRACKER
+    _USAGE_TRACKER = UsageTracker(**kwargs)
+    return _USAGE_TRACKER
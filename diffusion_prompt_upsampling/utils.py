@@ -1,34 +1,91 @@
 import base64
 import io
 import re
-from pathlib import Path
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 
 from PIL import Image
 
-EXT_TO_MIMETYPE = {
-    ".jpg": "image/jpeg",
-    ".png": "image/png",
-    ".svg": "image/svg+xml",
+FORMAT_TO_MIMETYPE = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
 }
 
 
 def base64_encode_image(
-    image_path: Union[str, Image.Image], mimetype: Optional[str] = None
+    image_path: Union[str, Image.Image],
+    mimetype: Optional[str] = None,
+    image_format: Optional[str] = "PNG",
+    quality: Optional[int] = 90,
 ) -> str:
     image = Image.open(image_path) if isinstance(image_path, str) else image_path
-    mimetype = (
-        EXT_TO_MIMETYPE[Path(image_path).suffix]
-        if isinstance(image_path, str)
-        else "image/png"
-    )
+    # The mimetype has to match the encoded bytes rather than the source file, so
+    # a given mimetype picks the format the image is encoded in
+    if mimetype is not None:
+        image_formats = [
+            name for name, value in FORMAT_TO_MIMETYPE.items() if value == mimetype
+        ]
+        if not image_formats:
+            raise ValueError(
+                f"Cannot encode an image as {mimetype}, expected one of "
+                f"{list(FORMAT_TO_MIMETYPE.values())}"
+            )
+        image_format = image_formats[0]
+    mimetype = FORMAT_TO_MIMETYPE[image_format]
     byte_arr = io.BytesIO()
-    image.save(byte_arr, format="PNG")
+    if image_format == "PNG":
+        image.save(byte_arr, format=image_format)
+    else:
+        image.convert("RGB").save(byte_arr, format=image_format, quality=quality)
     encoded_string = base64.b64encode(byte_arr.getvalue()).decode("utf-8")
     encoded_string = f"data:{mimetype};base64,{encoded_string}"
     return str(encoded_string)
 
 
+BASE64_IMAGE_PATTERN = re.compile(
+    r"data:image/(?:jpeg|png|svg\+xml|webp);base64,[A-Za-z0-9+/=]+"
+)
+IMAGE_SEGMENT_PATTERN = re.compile(
+    BASE64_IMAGE_PATTERN.pattern + r"|<image:(?P<handle>[A-Za-z0-9_\-]+)>"
+)
+
+
+def get_data_url_image_size(data_url: str) -> Optional[Tuple[int, int]]:
+    # The dimensions are in the header of the encoded image, so only the start of
+    # the data URL is decoded, unless the header does not fit in it
+    encoded_image = data_url.split(";base64,", 1)[-1]
+    for prefix_length in (4096, len(encoded_image)):
+        prefix = encoded_image[: prefix_length - prefix_length % 4]
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(prefix))) as image:
+                return image.size
+        except Exception:
+            continue
+    return None
+
+
 def find_base64_images(input_text):
-    pattern = r"(data:image/(jpeg|png|svg\+xml);base64,[A-Za-z0-9+/=]+)"
-    return [match[0] for match in re.findall(pattern, input_text)]
+    return BASE64_IMAGE_PATTERN.findall(input_text)
+
+
+def image_placeholder(handle: str) -> str:
+    return f"<image:{handle}>"
+
+
+def split_prompt_segments(prompt: str) -> List[Tuple[str, str]]:
+    """Splits a prompt into `("text", text)`, `("image", data_url)` and
+    `("handle", handle)` segments in their original order, in a single pass."""
+    if "data:image/" not in prompt and "<image:" not in prompt:
+        return [("text", prompt)]
+    segments, position = [], 0
+    for match in IMAGE_SEGMENT_PATTERN.finditer(prompt):
+        if match.start() > position:
+            segments.append(("text", prompt[position : match.start()]))
+        handle = match.group("handle")
+        segments.append(
+            ("image", match.group()) if handle is None else ("handle", handle)
+        )
+        position = match.end()
+    if position < len(prompt):
+        segments.append(("text", prompt[position:]))
+    return segments
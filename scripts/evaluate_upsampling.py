@@ -1,56 +1,381 @@
 import asyncio
-from typing import Optional
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 
 import fire
+import rich
 import weave
 
+from diffusion_prompt_upsampling.cascade import CascadeJudgeModel
+from diffusion_prompt_upsampling.deduplication import DeduplicatedEvaluation
 from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+from diffusion_prompt_upsampling.evaluation_log import ResumableEvaluation
+from diffusion_prompt_upsampling.few_shot import load_completions
+from diffusion_prompt_upsampling.image_transport import ImageTransport
 from diffusion_prompt_upsampling.judge_model import OpenAIJudgeModel
+from diffusion_prompt_upsampling.pipelined_evaluation import PipelinedEvaluation
+from diffusion_prompt_upsampling.placement import describe_plan
+from diffusion_prompt_upsampling.profiling import enable_profiling
+from diffusion_prompt_upsampling.prompt_shards import PromptShards
+from diffusion_prompt_upsampling.sharded_evaluation import ShardedEvaluation
+from diffusion_prompt_upsampling.sweep import SweepEvaluation
+from diffusion_prompt_upsampling.usage import get_usage_tracker, track_usage
+
+
+async def run_evaluation(
+    evaluation: weave.Evaluation,
+    model: weave.Model,
+    evaluation_parallelism: Optional[int] = None,
+    pipelined_evaluation: Optional[PipelinedEvaluation] = None,
+    resumable_evaluation: Optional[ResumableEvaluation] = None,
+    sweep_evaluation: Optional[SweepEvaluation] = None,
+    deduplicated_evaluation: Optional[DeduplicatedEvaluation] = None,
+):
+    # `weave.Evaluation` runs the synchronous predict and scorer functions in the
+    # default executor of the event loop, which caps the number of concurrent
+    # OpenAI requests to the number of its worker threads
+    if evaluation_parallelism is not None:
+        os.environ["WEAVE_PARALLELISM"] = str(evaluation_parallelism)
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=evaluation_parallelism)
+        )
+    if sweep_evaluation is not None:
+        return await sweep_evaluation.evaluate(model)
+    if deduplicated_evaluation is not None:
+        return await deduplicated_evaluation.evaluate(model)
+    if pipelined_evaluation is not None:
+        return await pipelined_evaluation.evaluate(model)
+    if resumable_evaluation is not None:
+        return await resumable_evaluation.evaluate(model)
+    return await evaluation.evaluate(model)
+
+
+def build_evaluation(
+    project_name: str,
+    dataset_ref: Optional[str],
+    evaluation_name: Optional[str],
+    diffusion_model_kwargs: Dict,
+    judge_model_kwargs: Dict,
+    dataset_path: Optional[str] = None,
+    cascade_kwargs: Optional[Dict] = None,
+    usage_kwargs: Optional[Dict] = None,
+) -> Tuple[
+    weave.Evaluation,
+    StableDiffusionXLModel,
+    Union[OpenAIJudgeModel, CascadeJudgeModel],
+]:
+    weave.init(project_name=project_name)
+    # Every worker of a sharded evaluation tracks its own usage, sharing the
+    # budget through the usage log
+    if usage_kwargs is not None:
+        track_usage(**usage_kwargs)
+    if dataset_path is not None:
+        # A `weave.Evaluation` needs a non-empty dataset, but the rows evaluated
+        # are streamed from the shards by the runners, so only the first ones are
+        # recorded with it
+        shards = PromptShards(dataset_path)
+        dataset = weave.Dataset(
+            name=shards.name,
+            rows=shards.head(8),
+            description=f"First rows of the {len(shards)} prompts of {dataset_path}",
+        )
+    else:
+        dataset = weave.ref(dataset_ref).get()
+    diffusion_model = StableDiffusionXLModel(**diffusion_model_kwargs)
+    judge_model = OpenAIJudgeModel(**judge_model_kwargs)
+    if cascade_kwargs is not None:
+        judge_model = CascadeJudgeModel(judge_model, **cascade_kwargs)
+    evaluation = weave.Evaluation(
+        name=evaluation_name, dataset=dataset, scorers=[judge_model.score]
+    )
+    return evaluation, diffusion_model, judge_model
+
+
+def build_shard_evaluation(device: str, diffusion_model_kwargs: Dict, **kwargs):
+    # The sharded runner restricts every worker to its own GPU before this is
+    # called, so `device` is either "cuda" or "cpu", and the pipeline of every
+    # worker is placed according to the memory of its own GPU
+    evaluation, diffusion_model, _ = build_evaluation(
+        diffusion_model_kwargs={**diffusion_model_kwargs, "device": device}, **kwargs
+    )
+    return evaluation, diffusion_model.predict
 
 
 def evaluate_upsampling(
-    dataset_ref: str,
-    upsample_prompt: bool,
+    dataset_ref: Optional[str] = None,
+    upsample_prompt: Optional[bool] = False,
     project_name: Optional[str] = "diffusion-prompt-upsample",
     entity_name: Optional[str] = None,
     evaluation_name: Optional[str] = None,
     diffusion_model_name_or_path: Optional[
         str
     ] = "stabilityai/stable-diffusion-xl-base-1.0",
-    diffusion_model_enable_cpu_offfload: Optional[bool] = True,
+    diffusion_model_enable_cpu_offfload: Optional[bool] = None,
+    diffusion_model_device: Optional[str] = None,
+    placement_strategy: Optional[str] = None,
+    placement_dtype: Optional[str] = None,
     use_stock_negative_prompt: Optional[bool] = False,
     disable_diffusion_model_progress_bar: Optional[bool] = False,
+    diffusion_model_batch_size: Optional[int] = 1,
+    upsample_batch_size: Optional[int] = 1,
     openai_model: Optional[str] = "gpt-4-turbo",
     judge_model_seed: Optional[int] = 42,
+    upsampler_cache_path: Optional[str] = None,
+    upsampler_cache_read_only: Optional[bool] = False,
+    evaluation_parallelism: Optional[int] = None,
+    openai_max_concurrency: Optional[int] = None,
+    openai_requests_per_minute: Optional[float] = None,
+    openai_tokens_per_minute: Optional[float] = None,
+    pipelined: Optional[bool] = False,
+    num_upsampler_workers: Optional[int] = 8,
+    num_judge_workers: Optional[int] = 8,
+    pipeline_queue_size: Optional[int] = 16,
+    image_transport: Optional[str] = "png",
+    image_store_dir: Optional[str] = None,
+    judge_image_format: Optional[str] = "png",
+    judge_image_quality: Optional[int] = 90,
+    judge_image_max_size: Optional[int] = None,
+    judge_cache_path: Optional[str] = None,
+    judge_cache_read_only: Optional[bool] = False,
+    judge_near_duplicate_threshold: Optional[int] = None,
+    judge_near_duplicate_max_candidates: Optional[int] = 32,
+    judge_batch_size: Optional[int] = 1,
+    judge_batch_image_max_size: Optional[int] = None,
+    judge_image_detail: Optional[str] = None,
+    cache_prompt_embeddings: Optional[bool] = False,
+    embedding_cache_path: Optional[str] = None,
+    profile: Optional[bool] = False,
+    profile_output_path: Optional[str] = None,
+    num_shards: Optional[int] = 1,
+    shard_devices: Optional[Union[str, List[str]]] = None,
+    results_log_path: Optional[str] = None,
+    shard_ids: Optional[List[int]] = None,
+    sweep_num_inference_steps: Optional[List[int]] = None,
+    sweep_image_sizes: Optional[List[int]] = None,
+    sweep_guidance_scales: Optional[List[float]] = None,
+    dataset_path: Optional[str] = None,
+    deduplicate_prompts: Optional[bool] = False,
+    near_duplicate_max_typos: Optional[int] = 1,
+    num_few_shot_examples: Optional[int] = None,
+    few_shot_examples_path: Optional[str] = None,
+    cascade_judge: Optional[bool] = False,
+    cascade_min_image_std: Optional[float] = 0.01,
+    cascade_max_dark_fraction: Optional[float] = 0.98,
+    cascade_clip_model: Optional[str] = None,
+    cascade_clip_reject_threshold: Optional[float] = 0.15,
+    cascade_clip_accept_threshold: Optional[float] = None,
+    cascade_audit_fraction: Optional[float] = 0.1,
+    openai_max_history: Optional[int] = 100,
+    openai_budget_tokens: Optional[int] = None,
+    openai_budget_cost: Optional[float] = None,
+    openai_budget_window_seconds: Optional[float] = None,
+    openai_on_budget_exceeded: Optional[str] = "stop",
+    openai_usage_log_path: Optional[str] = None,
 ):
     project_name = (
         project_name if entity_name is None else f"{entity_name}/{project_name}"
     )
-    weave.init(project_name=project_name)
-    dataset = weave.ref(dataset_ref).get()
-    diffusion_model = StableDiffusionXLModel(
-        model_name_or_path=diffusion_model_name_or_path,
-        enable_cpu_offfload=diffusion_model_enable_cpu_offfload,
-        upsample_prompt=upsample_prompt,
-        use_stock_negative_prompt=use_stock_negative_prompt,
-    )
-    if disable_diffusion_model_progress_bar:
-        diffusion_model._pipeline.set_progress_bar_config(disable=True)
-    judge_model = OpenAIJudgeModel(
-        openai_model=openai_model,
-        seed=judge_model_seed,
-    )
-    evaluation = weave.Evaluation(
-        name=evaluation_name, dataset=dataset, scorers=[judge_model.score]
-    )
-    with weave.attributes(
-        {
+    build_kwargs = {
+        "project_name": project_name,
+        "dataset_ref": dataset_ref,
+        "evaluation_name": evaluation_name,
+        "dataset_path": dataset_path,
+        "diffusion_model_kwargs": {
+            "model_name_or_path": diffusion_model_name_or_path,
+            "enable_cpu_offfload": diffusion_model_enable_cpu_offfload,
+            "device": diffusion_model_device,
+            "placement_strategy": placement_strategy,
+            "placement_dtype": placement_dtype,
             "upsample_prompt": upsample_prompt,
             "use_stock_negative_prompt": use_stock_negative_prompt,
-            "enable_cpu_offfload": diffusion_model_enable_cpu_offfload,
-        }
+            "upsampler_cache_path": upsampler_cache_path,
+            "upsampler_cache_read_only": upsampler_cache_read_only,
+            "batch_size": diffusion_model_batch_size,
+            "upsample_batch_size": upsample_batch_size,
+            "upsampler_max_concurrency": openai_max_concurrency,
+            "upsampler_requests_per_minute": openai_requests_per_minute,
+            "upsampler_tokens_per_minute": openai_tokens_per_minute,
+            "upsampler_max_history": openai_max_history,
+            "image_transport": ImageTransport(
+                kind=image_transport, store_dir=image_store_dir
+            ),
+            "cache_prompt_embeddings": cache_prompt_embeddings,
+            "embedding_cache_path": embedding_cache_path,
+            "disable_progress_bar": disable_diffusion_model_progress_bar,
+            "completions": (
+                load_completions(few_shot_examples_path)
+                if few_shot_examples_path is not None
+                else None
+            ),
+            "num_few_shot_examples": num_few_shot_examples,
+        },
+        "judge_model_kwargs": {
+            "openai_model": openai_model,
+            "seed": judge_model_seed,
+            "max_concurrency": openai_max_concurrency,
+            "requests_per_minute": openai_requests_per_minute,
+            "tokens_per_minute": openai_tokens_per_minute,
+            "image_transport": ImageTransport(
+                kind=judge_image_format,
+                quality=judge_image_quality,
+                max_size=judge_image_max_size,
+            ),
+            "cache_path": judge_cache_path,
+            "cache_read_only": judge_cache_read_only,
+            "near_duplicate_threshold": judge_near_duplicate_threshold,
+            "near_duplicate_max_candidates": judge_near_duplicate_max_candidates,
+            "batch_size": judge_batch_size,
+            "batch_image_max_size": judge_batch_image_max_size,
+            "image_detail": judge_image_detail,
+            "max_history": openai_max_history,
+        },
+        "cascade_kwargs": (
+            {
+                "min_image_std": cascade_min_image_std,
+                "max_dark_fraction": cascade_max_dark_fraction,
+                "clip_model_name_or_path": cascade_clip_model,
+                "clip_reject_threshold": cascade_clip_reject_threshold,
+                "clip_accept_threshold": cascade_clip_accept_threshold,
+                "audit_fraction": cascade_audit_fraction,
+            }
+            if cascade_judge
+            else None
+        ),
+        "usage_kwargs": {
+            "max_tokens": openai_budget_tokens,
+            "max_cost": openai_budget_cost,
+            "window_seconds": openai_budget_window_seconds,
+            "on_budget_exceeded": openai_on_budget_exceeded,
+            "log_path": openai_usage_log_path,
+        },
+    }
+    evaluation_attributes = {
+        "upsample_prompt": upsample_prompt,
+        "use_stock_negative_prompt": use_stock_negative_prompt,
+        "enable_cpu_offfload": diffusion_model_enable_cpu_offfload,
+        "placement_strategy": placement_strategy,
+        "cascade_judge": cascade_judge,
+    }
+    if (dataset_ref is None) == (dataset_path is None):
+        raise ValueError("Exactly one of `dataset_ref` and `dataset_path` is required")
+    # Rows streamed from shards are only kept in the results log, and are not
+    # supported by the in-memory `weave.Evaluation` and sweep runners
+    if dataset_path is not None and results_log_path is None:
+        raise ValueError("`results_log_path` is required to evaluate `dataset_path`")
+    if deduplicate_prompts and (
+        num_shards > 1 or pipelined or dataset_path is not None
     ):
-        asyncio.run(evaluation.evaluate(diffusion_model.predict))
+        raise ValueError(
+            "`deduplicate_prompts` is not supported with sharded, pipelined or "
+            "streamed evaluations"
+        )
+    rows = PromptShards(dataset_path) if dataset_path is not None else None
+    if num_shards > 1:
+        if results_log_path is None:
+            raise ValueError(
+                "`results_log_path` is required to run a sharded evaluation"
+            )
+        sharded_evaluation = ShardedEvaluation(
+            functools.partial(build_shard_evaluation, **build_kwargs),
+            num_shards=num_shards,
+            results_path=results_log_path,
+            devices=(
+                shard_devices.split(",")
+                if isinstance(shard_devices, str)
+                else shard_devices
+            ),
+            parallelism=evaluation_parallelism or 8,
+            rows=rows,
+        )
+        with weave.attributes(evaluation_attributes):
+            sharded_evaluation.run(shard_ids=shard_ids)
+        # Only the usage logged by the workers is seen by the coordinator
+        if openai_usage_log_path is not None:
+            get_usage_tracker().print_summary()
+        return
+
+    profiler = enable_profiling() if profile else None
+    evaluation, diffusion_model, judge_model = build_evaluation(**build_kwargs)
+    pipelined_evaluation = (
+        PipelinedEvaluation(
+            evaluation,
+            num_upsampler_workers=num_upsampler_workers,
+            num_judge_workers=num_judge_workers,
+            queue_size=pipeline_queue_size,
+            log_path=results_log_path,
+            rows=rows,
+        )
+        if pipelined
+        else None
+    )
+    resumable_evaluation = (
+        ResumableEvaluation(evaluation, results_log_path, rows=rows)
+        if results_log_path is not None and not pipelined and not deduplicate_prompts
+        else None
+    )
+    deduplicated_evaluation = (
+        DeduplicatedEvaluation(
+            evaluation,
+            max_typos=near_duplicate_max_typos,
+            log_path=results_log_path,
+            parallelism=evaluation_parallelism,
+        )
+        if deduplicate_prompts
+        else None
+    )
+    sweep_grid = {
+        name: list(values) if isinstance(values, (list, tuple)) else [values]
+        for name, values in [
+            ("num_inference_steps", sweep_num_inference_steps),
+            ("image_size", sweep_image_sizes),
+            ("guidance_scale", sweep_guidance_scales),
+        ]
+        if values is not None
+    }
+    if sweep_grid and dataset_path is not None:
+        raise ValueError("Sweeps over `dataset_path` are not supported")
+    sweep_evaluation = (
+        SweepEvaluation(evaluation, sweep_grid, num_judge_workers=num_judge_workers)
+        if sweep_grid
+        else None
+    )
+    with weave.attributes(evaluation_attributes):
+        asyncio.run(
+            run_evaluation(
+                evaluation,
+                (
+                    diffusion_model
+                    if pipelined_evaluation is not None or sweep_evaluation is not None
+                    else diffusion_model.predict
+                ),
+                evaluation_parallelism,
+                pipelined_evaluation,
+                resumable_evaluation,
+                sweep_evaluation,
+                deduplicated_evaluation,
+            )
+        )
+    rich.print(describe_plan(diffusion_model.get_placement_plan()))
+    get_usage_tracker().print_summary()
+    if profiler is not None:
+        profiler.print_summary()
+        if profile_output_path is not None:
+            profiler.save(profile_output_path)
+    if pipelined_evaluation is not None:
+        rich.print(f"{pipelined_evaluation.get_stage_metrics()=}")
+    if deduplicated_evaluation is not None:
+        rich.print(f"{deduplicated_evaluation.savings=}")
+    if diffusion_model._upsampler_cache is not None:
+        rich.print(f"{diffusion_model._upsampler_cache.stats()=}")
+    if diffusion_model._embedding_cache is not None:
+        rich.print(f"{diffusion_model._embedding_cache.stats()=}")
+    if isinstance(judge_model, CascadeJudgeModel):
+        rich.print(f"{judge_model.get_agreement_report()=}")
+        judge_model = judge_model._judge
+    if judge_model._judgement_cache is not None:
+        rich.print(f"{judge_model._judgement_cache.stats()=}")
 
 
 if __name__ == "__main__":
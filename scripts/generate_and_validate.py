@@ -5,6 +5,7 @@ import rich
 import weave
 from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
 from diffusion_prompt_upsampling.judge_model import OpenAIJudgeModel
+from diffusion_prompt_upsampling.placement import describe_plan
 
 
 def generate_and_validate(
@@ -14,7 +15,10 @@ def generate_and_validate(
     diffusion_model_name_or_path: Optional[
         str
     ] = "stabilityai/stable-diffusion-xl-base-1.0",
-    diffusion_model_enable_cpu_offfload: Optional[bool] = True,
+    diffusion_model_enable_cpu_offfload: Optional[bool] = None,
+    diffusion_model_device: Optional[str] = None,
+    placement_strategy: Optional[str] = None,
+    placement_dtype: Optional[str] = None,
     upsample_prompt: Optional[bool] = False,
     use_stock_negative_prompt: Optional[bool] = False,
     openai_model: Optional[str] = "gpt-4-turbo",
@@ -27,6 +31,9 @@ def generate_and_validate(
     diffusion_model = StableDiffusionXLModel(
         model_name_or_path=diffusion_model_name_or_path,
         enable_cpu_offfload=diffusion_model_enable_cpu_offfload,
+        device=diffusion_model_device,
+        placement_strategy=placement_strategy,
+        placement_dtype=placement_dtype,
         upsample_prompt=upsample_prompt,
         use_stock_negative_prompt=use_stock_negative_prompt,
     )
@@ -34,6 +41,7 @@ def generate_and_validate(
     image = diffusion_model.predict(base_prompt=base_prompt)["image"]
     judgement = judge_model.predict(base_prompt=base_prompt, generated_image=image)
 
+    rich.print(describe_plan(diffusion_model.get_placement_plan()))
     rich.print(f"{judgement=}")
 
 
@@ -0,0 +1,62 @@
+import json
+import os
+from typing import Dict, Iterator, List, Optional
+
+import fire
+import rich
+
+from diffusion_prompt_upsampling.prompt_shards import (
+    ingest_hf_dataset,
+    write_prompt_shards,
+)
+
+
+def iter_prompt_file(path: str, prompt_column: str) -> Iterator[Dict]:
+    # JSONL files hold a row per line, and any other file a prompt per line
+    with open(path) as f:
+        for line in f:
+            if path.endswith(".jsonl"):
+                yield json.loads(line)
+            else:
+                yield {prompt_column: line}
+
+
+def ingest_prompts(
+    source: str,
+    output_dir: str,
+    prompt_column: Optional[str] = "base_prompt",
+    split: Optional[str] = "train",
+    config_name: Optional[str] = None,
+    extra_columns: Optional[List[str]] = None,
+    shard_size: Optional[int] = 10000,
+):
+    """Streams a prompt set into shards that can be evaluated with `--dataset_path`.
+
+    `source` is either a local text or JSONL file, or the name of a dataset on
+    the Hugging Face Hub.
+    """
+    if os.path.isfile(source):
+        manifest = write_prompt_shards(
+            iter_prompt_file(source, prompt_column),
+            output_dir,
+            prompt_column=prompt_column,
+            extra_columns=extra_columns,
+            shard_size=shard_size,
+            name=os.path.splitext(os.path.basename(source))[0],
+            source=source,
+        )
+    else:
+        manifest = ingest_hf_dataset(
+            source,
+            prompt_column=prompt_column,
+            output_dir=output_dir,
+            split=split,
+            config_name=config_name,
+            extra_columns=extra_columns,
+            shard_size=shard_size,
+        )
+    rich.print(f"{manifest=}")
+
+
+if __name__ == "__main__":
+    fire.Fire(ingest_prompts)
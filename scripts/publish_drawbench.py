@@ -1,14 +1,31 @@
 from typing import Optional
 
 import fire
+import rich
 import weave
 from datasets import load_dataset
 
+from diffusion_prompt_upsampling.prompt_shards import ingest_hf_dataset
+
 
 def publish_dataset(
     project_name: Optional[str] = "diffusion-prompt-upsample",
     entity_name: Optional[str] = None,
+    shards_dir: Optional[str] = None,
+    shard_size: Optional[int] = 10000,
 ):
+    if shards_dir is not None:
+        # Streams the dataset into local shards to be evaluated with
+        # `--dataset_path`, instead of publishing it as a `weave.Dataset`
+        manifest = ingest_hf_dataset(
+            "shunk031/DrawBench",
+            prompt_column="prompts",
+            output_dir=shards_dir,
+            split="test",
+            shard_size=shard_size,
+        )
+        rich.print(f"{manifest=}")
+        return
     project_name = (
         project_name if entity_name is None else f"{entity_name}/{project_name}"
     )
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tests reuse the CPU stand-ins of the benchmarks, see `benchmarks/stubs.py`
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+)
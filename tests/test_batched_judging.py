@@ -0,0 +1,138 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+from stubs import ReplayChatCompletions, ReplayMultiModalLM
+
+from diffusion_prompt_upsampling.image_transport import ImageTransport
+from diffusion_prompt_upsampling.judge_model import (
+    JUDGE_SYSTEM_PROMPT,
+    OpenAIJudgeModel,
+)
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "benchmarks", "fixtures"
+)
+BASE_PROMPTS = ["a red cube", "a fish eating a pelican", "a bird", "two cats"]
+JUDGEMENT = {"think_out_loud": "Looks right.", "score": 0.5, "judgement": "correct"}
+
+
+class BatchCompletions(ReplayChatCompletions):
+    """Answers batched judging requests, which attach several images, with
+    `batch_content`, and counts the requests."""
+
+    def __init__(self, responses, batch_content):
+        super().__init__(responses)
+        self.batch_content = batch_content
+        self.num_requests = 0
+        self.num_batch_requests = 0
+
+    def get_content(self, messages):
+        self.num_requests += 1
+        num_images = sum(
+            part["type"] == "image_url" for part in messages[-1]["content"]
+        )
+        if num_images > 1:
+            self.num_batch_requests += 1
+            if self.batch_content is not None:
+                return self.batch_content
+        return super().get_content(messages)
+
+
+@pytest.fixture
+def judge_responses():
+    with open(os.path.join(FIXTURES_DIR, "recorded_responses.json")) as f:
+        return json.load(f)["judge"]
+
+
+@pytest.fixture
+def images():
+    transport = ImageTransport()
+    return [
+        transport.encode(Image.new("RGB", (32, 32), (idx * 60, 0, 0)))
+        for idx in range(len(BASE_PROMPTS))
+    ]
+
+
+def build_judge(responses, batch_size: int, batch_content=None):
+    llm = ReplayMultiModalLM(
+        responses, model="gpt-4o", system_prompt=JUDGE_SYSTEM_PROMPT, stage="judge"
+    )
+    completions = BatchCompletions(responses, batch_content)
+    llm._openai_client.chat.completions = completions
+    return OpenAIJudgeModel(judgement_llm=llm, batch_size=batch_size), completions
+
+
+def test_images_are_judged_in_batches(judge_responses, images):
+    judge, completions = build_judge(judge_responses, batch_size=4)
+    judgements = judge.predict_batch(BASE_PROMPTS, images)
+    assert (completions.num_requests, completions.num_batch_requests) == (1, 1)
+    assert len(judgements) == len(BASE_PROMPTS)
+
+    # Concurrent scores are judged in a single request by the micro-batcher
+    judge, completions = build_judge(judge_responses, batch_size=4)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        scores = list(
+            executor.map(
+                lambda item: judge.score(item[0], {"image": item[1]}),
+                zip(BASE_PROMPTS, images),
+            )
+        )
+    assert completions.num_batch_requests == 1
+    assert [score["score"] for score in scores] == [
+        judgement.score for judgement in judgements
+    ]
+
+
+@pytest.mark.parametrize(
+    "batch_content",
+    [
+        # Malformed, not JSON at all
+        "These all look fine!",
+        # One judgement short
+        json.dumps({"judgements": [JUDGEMENT] * (len(BASE_PROMPTS) - 1)}),
+    ],
+)
+def test_failed_batches_fall_back_to_single_images(
+    judge_responses, images, batch_content
+):
+    single_judge, _ = build_judge(judge_responses, batch_size=1)
+    expected_judgements = single_judge.predict_batch(BASE_PROMPTS, images)
+
+    judge, completions = build_judge(
+        judge_responses, batch_size=4, batch_content=batch_content
+    )
+    assert judge.predict_batch(BASE_PROMPTS, images) == expected_judgements
+    assert completions.num_requests == (
+        completions.num_batch_requests + len(BASE_PROMPTS)
+    )
+
+    judge, _ = build_judge(judge_responses, batch_size=4, batch_content=batch_content)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        scores = list(
+            executor.map(
+                lambda item: judge.score(item[0], {"image": item[1]}),
+                zip(BASE_PROMPTS, images),
+            )
+        )
+    assert [score["score"] for score in scores] == [
+        judgement.score for judgement in expected_judgements
+    ]
+
+
+def test_invalid_judgements_fall_back_on_their_own(judge_responses, images):
+    single_judge, _ = build_judge(judge_responses, batch_size=1)
+    expected_judgement = single_judge.predict(BASE_PROMPTS[1], images[1])
+
+    batch_content = json.dumps(
+        {"judgements": [JUDGEMENT, {"score": "high"}, JUDGEMENT, JUDGEMENT]}
+    )
+    judge, completions = build_judge(
+        judge_responses, batch_size=4, batch_content=batch_content
+    )
+    judgements = judge.predict_batch(BASE_PROMPTS, images)
+    assert completions.num_requests == completions.num_batch_requests + 1
+    assert judgements[1] == expected_judgement
+    assert [judgements[idx].model_dump() for idx in (0, 2, 3)] == [JUDGEMENT] * 3
@@ -0,0 +1,152 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from stubs import BATCH_PROMPT_PATTERN, ReplayChatCompletions, ReplayMultiModalLM
+
+from diffusion_prompt_upsampling.diffusion_model import (
+    UPSAMPLER_SYSTEM_PROMPT,
+    StableDiffusionXLModel,
+)
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "benchmarks", "fixtures"
+)
+BASE_PROMPTS = ["a red cube", "a fish eating a pelican", "a bird", "two cats"]
+
+
+class BatchCompletions(ReplayChatCompletions):
+    """Answers batched upsampling requests with `batch_content` if given, and
+    counts the requests."""
+
+    def __init__(self, responses, batch_content):
+        super().__init__(responses)
+        self.batch_content = batch_content
+        self.num_requests = 0
+        self.num_batch_requests = 0
+        self.batch_prompts = []
+
+    def get_content(self, messages):
+        self.num_requests += 1
+        text = "".join(part.get("text", "") for part in messages[-1]["content"])
+        if BATCH_PROMPT_PATTERN.search(text):
+            self.num_batch_requests += 1
+            self.batch_prompts.append(BATCH_PROMPT_PATTERN.findall(text))
+            if self.batch_content is not None:
+                return self.batch_content
+        return super().get_content(messages)
+
+
+@pytest.fixture
+def upsampler_responses():
+    with open(os.path.join(FIXTURES_DIR, "recorded_responses.json")) as f:
+        return json.load(f)["upsampler"]
+
+
+def build_model(responses, upsample_batch_size: int, batch_content=None, **kwargs):
+    llm = ReplayMultiModalLM(
+        responses,
+        model="gpt-4",
+        system_prompt=UPSAMPLER_SYSTEM_PROMPT,
+        stage="upsampler",
+    )
+    completions = BatchCompletions(responses, batch_content)
+    llm._openai_client.chat.completions = completions
+    model = StableDiffusionXLModel(
+        model_name_or_path="tiny-diffusion-pipeline",
+        upsample_prompt=True,
+        upsample_batch_size=upsample_batch_size,
+        upsampler_llm=llm,
+        **kwargs,
+    )
+    return model, completions
+
+
+def test_prompts_are_upsampled_in_batches(upsampler_responses):
+    model, _ = build_model(upsampler_responses, upsample_batch_size=4)
+    # A duplicated prompt is only sent once
+    answers = model.upsample_prompts(BASE_PROMPTS + BASE_PROMPTS[:1])
+    assert len(model.get_upsampler_llm().history) == 1
+    assert len(answers) == len(BASE_PROMPTS) + 1
+    assert answers[-1] == answers[0]
+    assert all(answer.strip() for answer in answers)
+
+    # Concurrent calls are batched by the micro-batcher as well
+    model, _ = build_model(upsampler_responses, upsample_batch_size=4)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(model.upsample, BASE_PROMPTS)) == answers[:-1]
+
+
+@pytest.mark.parametrize(
+    "batch_content",
+    [
+        # Malformed, not JSON at all
+        "Here are your captions!",
+        # One caption short
+        json.dumps({"answers": ["A caption."] * (len(BASE_PROMPTS) - 1)}),
+        # An empty caption
+        json.dumps({"answers": ["A caption."] * (len(BASE_PROMPTS) - 1) + [" "]}),
+    ],
+)
+def test_failed_batches_fall_back_to_single_prompts(upsampler_responses, batch_content):
+    single_model, _ = build_model(upsampler_responses, upsample_batch_size=1)
+    expected_answers = [single_model.upsample(prompt) for prompt in BASE_PROMPTS]
+
+    model, completions = build_model(
+        upsampler_responses, upsample_batch_size=4, batch_content=batch_content
+    )
+    assert model.upsample_prompts(BASE_PROMPTS) == expected_answers
+    num_batch_requests = completions.num_batch_requests
+    assert num_batch_requests >= 1
+    assert completions.num_requests == num_batch_requests + len(BASE_PROMPTS)
+
+    model, completions = build_model(
+        upsampler_responses, upsample_batch_size=4, batch_content=batch_content
+    )
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(model.upsample, BASE_PROMPTS)) == expected_answers
+
+
+def test_fallbacks_are_cached_as_single_prompt_answers(upsampler_responses, tmp_path):
+    cache_path = str(tmp_path / "upsampler.db")
+    model, _ = build_model(
+        upsampler_responses,
+        upsample_batch_size=4,
+        batch_content="Here are your captions!",
+        upsampler_cache_path=cache_path,
+    )
+    answers = model.upsample_prompts(BASE_PROMPTS)
+
+    # The fallbacks were single-prompt requests, so they serve single-prompt
+    # upsampling but not batched upsampling
+    model, completions = build_model(
+        upsampler_responses, upsample_batch_size=1, upsampler_cache_path=cache_path
+    )
+    assert model.upsample_prompts(BASE_PROMPTS) == answers
+    assert completions.num_requests == 0
+    model, completions = build_model(
+        upsampler_responses, upsample_batch_size=4, upsampler_cache_path=cache_path
+    )
+    model.upsample_prompts(BASE_PROMPTS)
+    assert completions.num_batch_requests == 1
+
+
+def test_batched_answers_are_cached_with_the_examples_sent(
+    upsampler_responses, tmp_path
+):
+    cache_path = str(tmp_path / "upsampler.db")
+    kwargs = {"num_few_shot_examples": 2, "upsampler_cache_path": cache_path}
+    model, completions = build_model(upsampler_responses, 4, **kwargs)
+    answers = model.upsample_prompts(BASE_PROMPTS)
+    assert completions.num_batch_requests == 1
+
+    # The same batch is served from the cache, while a prompt batched with
+    # other prompts gets other examples and is sent again
+    model, completions = build_model(upsampler_responses, 4, **kwargs)
+    assert model.upsample_prompts(BASE_PROMPTS) == answers
+    assert completions.num_requests == 0
+    model, completions = build_model(upsampler_responses, 4, **kwargs)
+    other_prompts = BASE_PROMPTS[:2] + ["a tiny house", "a big tree"]
+    model.upsample_prompts(other_prompts)
+    assert completions.batch_prompts == [other_prompts]
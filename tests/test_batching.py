@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from stubs import TinyDiffusionPipeline
+
+from diffusion_prompt_upsampling.batching import BATCH_FALLBACK, MicroBatcher
+from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+from diffusion_prompt_upsampling.image_transport import load_image
+
+
+def get_marker(prompt: str) -> int:
+    return sum(prompt.encode("utf-8")) % 256
+
+
+class RecordingPipeline(TinyDiffusionPipeline):
+    """Records the prompts of every call of the pipeline.
+
+    The first pixel of every image is set to a marker of its prompt, so that
+    the tests can tell which prompt an image was generated for.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def __call__(self, prompt, **kwargs):
+        self.calls.append(list(prompt))
+        output = super().__call__(prompt, **kwargs)
+        for image, image_prompt in zip(output.images, prompt):
+            image.putpixel((0, 0), (get_marker(image_prompt), 0, 0))
+        return output
+
+
+def build_model(batch_size: int, pad_last_batch: bool = True):
+    pipeline = RecordingPipeline()
+    model = StableDiffusionXLModel(
+        model_name_or_path="tiny-diffusion-pipeline",
+        pipeline=pipeline,
+        batch_size=batch_size,
+        pad_last_batch=pad_last_batch,
+    )
+    return model, pipeline
+
+
+def test_batches_are_grouped_by_key():
+    batches = []
+
+    def batch_fn(key, items):
+        batches.append((key, list(items)))
+        return [f"{key}:{item}" for item in items]
+
+    batcher = MicroBatcher(batch_fn, batch_size=4, max_wait_seconds=0.5)
+    items = [("even" if idx % 2 == 0 else "odd", idx) for idx in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda item: batcher.submit(*item), items))
+
+    # Every caller gets the result of its own item, and no batch mixes keys
+    assert results == [f"{key}:{idx}" for key, idx in items]
+    assert sorted(len(batch) for _, batch in batches) == [4, 4]
+    for key, batch in batches:
+        assert all(items[idx][0] == key for idx in batch)
+
+
+def test_short_batches_are_flushed_after_waiting():
+    batches = []
+    batcher = MicroBatcher(
+        lambda key, items: batches.append(list(items)) or list(items),
+        batch_size=4,
+        max_wait_seconds=0.05,
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda idx: batcher.submit(None, idx), range(2)))
+    assert results == [0, 1]
+    assert sum(len(batch) for batch in batches) == 2
+
+
+def test_fallbacks_run_in_the_submitting_threads():
+    fallback_threads = {}
+
+    def fallback_fn(key, item):
+        fallback_threads[item] = threading.get_ident()
+        return f"fallback:{item}"
+
+    batcher = MicroBatcher(
+        lambda key, items: [
+            BATCH_FALLBACK if item % 2 else f"batch:{item}" for item in items
+        ],
+        batch_size=4,
+        max_wait_seconds=0.5,
+        fallback_fn=fallback_fn,
+    )
+
+    def submit(item):
+        return batcher.submit(None, item), threading.get_ident()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(submit, range(4)))
+
+    assert [result for result, _ in results] == [
+        "batch:0",
+        "fallback:1",
+        "batch:2",
+        "fallback:3",
+    ]
+    for item in (1, 3):
+        assert fallback_threads[item] == results[item][1]
+
+
+def test_short_batches_are_padded():
+    model, pipeline = build_model(batch_size=4)
+    images = model.generate_images(
+        ["a cat", "a dog", "a bird"],
+        num_inference_steps=1,
+        image_size=32,
+        seeds=[0] * 3,
+    )
+    assert len(images) == 3
+    assert pipeline.calls == [["a cat", "a dog", "a bird", "a bird"]]
+
+    model, pipeline = build_model(batch_size=4, pad_last_batch=False)
+    model.generate_images(["a cat"], num_inference_steps=1, image_size=32)
+    assert pipeline.calls == [["a cat"]]
+
+
+def test_outputs_are_mapped_back_to_their_rows():
+    # Rows of different sizes are generated in separate batches, and each image
+    # still lands on the row it was generated for
+    model, pipeline = build_model(batch_size=4)
+    rows = [
+        {
+            "base_prompt": f"prompt {idx}",
+            "num_inference_steps": 1,
+            "image_size": 16 if idx % 2 else 32,
+        }
+        for idx in range(5)
+    ]
+    images = [
+        load_image(image)
+        for image in model._generate_rows(rows, [row["base_prompt"] for row in rows])
+    ]
+
+    assert sorted(pipeline.calls) == [
+        ["prompt 0", "prompt 2", "prompt 4", "prompt 4"],
+        ["prompt 1", "prompt 3", "prompt 3", "prompt 3"],
+    ]
+    for row, image in zip(rows, images):
+        assert image.size == (row["image_size"], row["image_size"])
+        assert image.getpixel((0, 0))[0] == get_marker(row["base_prompt"])
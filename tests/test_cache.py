@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from diffusion_prompt_upsampling.cache import PersistentCache
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    cache = PersistentCache(str(tmp_path / "cache.db"))
+
+    def append(idx: int) -> None:
+        cache.update("key", lambda values: (values or []) + [idx])
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(append, range(200)))
+    assert sorted(cache.get("key")) == list(range(200))
+
+
+def test_concurrent_updates_across_connections(tmp_path):
+    # Separate caches on the same file stand in for separate processes
+    caches = [PersistentCache(str(tmp_path / "cache.db")) for _ in range(4)]
+
+    def append(idx: int) -> None:
+        caches[idx % len(caches)].update("key", lambda values: (values or []) + [idx])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(append, range(100)))
+    assert sorted(caches[0].get("key")) == list(range(100))
+
+
+def test_read_only_cache_must_exist(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        PersistentCache(str(tmp_path / "missing.db"), read_only=True)
@@ -0,0 +1,98 @@
+import asyncio
+
+import weave
+
+from diffusion_prompt_upsampling.deduplication import (
+    DeduplicatedEvaluation,
+    cluster_prompts,
+)
+
+
+def test_exact_and_near_duplicates_are_clustered():
+    prompts = [
+        "A red cube on a wooden table.",
+        "a  red CUBE on a wooden table",
+        "a red cbue on a wooden table",
+        "a blue cube on a wooden table",
+        "two cats sleeping on a sofa",
+        "three cats sleeping on a sofa",
+    ]
+    assert cluster_prompts(prompts) == [0, 0, 0, 3, 4, 5]
+
+
+def test_prompts_asking_for_different_images_are_kept_apart():
+    prompts = [
+        "a red cube on a blue cube",
+        "a blue cube on a red cube",
+        "a red cube",
+        "a red cube",
+    ]
+    # Swapped words and other columns of the rows change the image
+    assert cluster_prompts(prompts, group_keys=["", "", "", "steps=4"]) == [
+        0,
+        1,
+        2,
+        3,
+    ]
+    assert cluster_prompts(prompts[2:], max_typos=0) == [0, 0]
+
+
+class CountingModel(weave.Model):
+    num_calls: int = 0
+
+    @weave.op()
+    def predict(self, base_prompt: str) -> dict:
+        self.num_calls += 1
+        return {"upsampled_prompt": base_prompt.upper()}
+
+
+@weave.op()
+def prompt_length(base_prompt: str, model_output: dict) -> dict:
+    return {"length": len(model_output["upsampled_prompt"])}
+
+
+def test_cluster_results_are_fanned_out_to_every_row():
+    prompts = [
+        "a red cube on a table",
+        "A red cube on a table!",
+        "a red cbue on a table",
+        "two cats",
+        "three cats",
+    ]
+    evaluation = weave.Evaluation(
+        dataset=[{"base_prompt": prompt} for prompt in prompts],
+        scorers=[prompt_length],
+    )
+    model = CountingModel()
+    deduplicated_evaluation = DeduplicatedEvaluation(evaluation)
+    summary = asyncio.run(deduplicated_evaluation.evaluate(model))
+
+    # The representative's output is used for every row of its cluster, and
+    # the summary still weighs all the rows
+    assert model.num_calls == 3
+    assert summary["prompt_length"]["length"]["mean"] == (
+        len("a red cube on a table") * 3 + len("two cats") + len("three cats")
+    ) / len(prompts)
+    savings = deduplicated_evaluation.savings
+    assert savings["num_rows"] == 5
+    assert savings["num_clusters"] == 3
+    assert savings["num_evaluated"] == 3
+    assert savings["num_fanned_out"] == 2
+    assert savings["saved_fraction"] == 1 - 3 / 5
+
+
+def test_resumed_clusters_are_skipped(tmp_path):
+    evaluation = weave.Evaluation(
+        dataset=[{"base_prompt": prompt} for prompt in ["a cat", "A cat", "a dog"]],
+        scorers=[prompt_length],
+    )
+    log_path = str(tmp_path / "results.jsonl")
+    asyncio.run(
+        DeduplicatedEvaluation(evaluation, log_path=log_path).evaluate(CountingModel())
+    )
+
+    model = CountingModel()
+    deduplicated_evaluation = DeduplicatedEvaluation(evaluation, log_path=log_path)
+    asyncio.run(deduplicated_evaluation.evaluate(model))
+    assert model.num_calls == 0
+    assert deduplicated_evaluation.savings["num_evaluated"] == 0
@@ -0,0 +1,42 @@
+import pytest
+from PIL import Image
+
+from diffusion_prompt_upsampling.evaluation_log import EvaluationLog
+from diffusion_prompt_upsampling.image_transport import ImageTransport, load_image
+
+
+def test_fingerprint_is_recorded_and_checked(tmp_path):
+    log = EvaluationLog(str(tmp_path / "results.jsonl"))
+    fingerprint = {"dataset": "abc", "num_rows": 2, "model": {"seed": 1}}
+    log.check_fingerprint(fingerprint)
+    log.append(0, {"model_output": "a", "scores": {}}, {"base_prompt": "a cat"})
+
+    # Resuming the same evaluation is allowed, and the header is not a row
+    log.check_fingerprint(dict(fingerprint))
+    assert log.get_completed_indices() == {0}
+    with pytest.raises(ValueError, match="different model"):
+        log.check_fingerprint({**fingerprint, "model": {"seed": 2}})
+
+
+def test_completed_rows_are_checked_against_their_example(tmp_path):
+    log = EvaluationLog(str(tmp_path / "results.jsonl"))
+    log.append(0, {"model_output": "a", "scores": {}}, {"base_prompt": "a cat"})
+    log.append(1, {"model_output": None, "scores": {}}, {"base_prompt": "a dog"}, True)
+    completed_examples = log.get_completed_examples()
+
+    assert log.is_completed(completed_examples, 0, {"base_prompt": "a cat"})
+    assert not log.is_completed(completed_examples, 1, {"base_prompt": "a dog"})
+    with pytest.raises(ValueError, match="different example"):
+        log.is_completed(completed_examples, 0, {"base_prompt": "a bird"})
+
+
+def test_logged_images_can_be_loaded_back(tmp_path):
+    image = Image.new("RGB", (8, 8), (255, 0, 0))
+    data_url = ImageTransport().to_data_url(ImageTransport().encode(image))
+    log = EvaluationLog(str(tmp_path / "results.jsonl"))
+    row = log.append(0, {"model_output": {"image": data_url}, "scores": {}})
+
+    # The data URL is logged as the path of the image rather than its hash
+    path = row["model_output"]["image"]
+    assert path.startswith(str(tmp_path / "results_images"))
+    assert load_image(path).tobytes() == image.tobytes()
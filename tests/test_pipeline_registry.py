@@ -0,0 +1,88 @@
+import pytest
+
+from diffusion_prompt_upsampling import placement
+from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+from diffusion_prompt_upsampling.pipeline_registry import (
+    clear_pipelines,
+    get_pipeline,
+    get_placement_plan,
+)
+
+SDXL = "stabilityai/stable-diffusion-xl-base-1.0"
+
+
+class RecordingPipeline:
+    """Records the placement methods called on a pipeline."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if not name.startswith("enable_"):
+            raise AttributeError(name)
+        return lambda **kwargs: self.calls.append(name)
+
+    def to(self, device):
+        self.calls.append(f"to({device})")
+        return self
+
+
+@pytest.fixture
+def device_memory(monkeypatch):
+    # The free memory of a simulated GPU, which the test lowers as if pipelines
+    # had been loaded on it
+    memory = {"free": 80 * 1024**3}
+    monkeypatch.setattr(placement, "get_device_memory", lambda _: memory["free"])
+    monkeypatch.setattr(placement, "get_cpu_memory", lambda: 64 * 1024**3)
+    clear_pipelines()
+    yield memory
+    clear_pipelines()
+
+
+def test_plan_is_stable_once_a_pipeline_is_registered(device_memory):
+    plan = get_placement_plan(SDXL, device="cuda")
+    assert plan.strategy == "full_device"
+    pipeline = get_pipeline(SDXL, plan, loader=lambda *_: object())
+
+    # Loading the pipeline used most of the device, so planning again from the
+    # free memory would pick an offloading strategy
+    device_memory["free"] = 4 * 1024**3
+    assert placement.plan_placement(SDXL, device="cuda").get_key() != plan.get_key()
+
+    replanned = get_placement_plan(SDXL, device="cuda")
+    assert replanned.get_key() == plan.get_key()
+    assert get_pipeline(SDXL, replanned, loader=lambda *_: object()) is pipeline
+
+
+def test_model_variants_share_the_registered_pipeline(device_memory):
+    pipelines = []
+    for use_stock_negative_prompt in [False, True]:
+        model = StableDiffusionXLModel(
+            model_name_or_path=SDXL,
+            device="cuda",
+            use_stock_negative_prompt=use_stock_negative_prompt,
+            pipeline_loader=lambda *_: object(),
+        )
+        pipelines.append(model.get_pipeline())
+        device_memory["free"] = 4 * 1024**3
+    assert pipelines[0] is pipelines[1]
+
+
+@pytest.mark.parametrize(
+    "enable_cpu_offfload, strategy, calls",
+    [
+        (True, "model_offload", ["enable_model_cpu_offload"]),
+        (False, "full_device", ["to(cuda)"]),
+    ],
+)
+def test_forced_offloading_matches_the_previous_placement(
+    device_memory, enable_cpu_offfload, strategy, calls
+):
+    # `enable_cpu_offfload` used to load the pipeline in float16 and either
+    # offload it or move it to the GPU, without any slicing or tiling
+    model = StableDiffusionXLModel(
+        model_name_or_path=SDXL, enable_cpu_offfload=enable_cpu_offfload
+    )
+    plan = model.get_placement_plan()
+    assert plan.get_key() == (strategy, "cuda", "float16", False, False, False)
+    assert placement.apply_placement(RecordingPipeline(), plan).calls == calls
@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from diffusion_prompt_upsampling.profiling import Profiler
+
+
+def test_concurrent_records_are_not_lost():
+    profiler = Profiler()
+    usage = SimpleNamespace(prompt_tokens=2, completion_tokens=1, total_tokens=3)
+
+    def record(_):
+        for _ in range(1000):
+            profiler.record("judge", 0.01, num_items=2)
+            profiler.record_usage("judge", usage)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(record, range(8)))
+
+    stats = profiler.summary()["stages"]["judge"]
+    assert stats["count"] == 8000
+    assert stats["num_items"] == 16000
+    assert stats["total_tokens"] == 24000
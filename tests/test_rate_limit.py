@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from diffusion_prompt_upsampling import dspy_multi_modal
+from diffusion_prompt_upsampling.dspy_multi_modal import DSPyOpenAIMultiModalLM
+
+
+class StubChatCompletionsServer(ThreadingHTTPServer):
+    """A local stand-in for the chat completions endpoint of the OpenAI API.
+
+    Every request is answered after `latency` seconds, while the number of
+    requests in flight is tracked. The first `num_failures` requests get a 500.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.05, num_failures: int = 0):
+        super().__init__(("127.0.0.1", 0), StubChatCompletionsHandler)
+        self.latency = latency
+        self.num_failures = num_failures
+        self.num_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+
+class StubChatCompletionsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.num_requests += 1
+            failed = server.num_requests <= server.num_failures
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.latency)
+        with server.lock:
+            server.in_flight -= 1
+        if failed:
+            self.send_response(500)
+            body = {"error": {"message": "stub failure", "type": "server_error"}}
+        else:
+            self.send_response(200)
+            body = {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "ok"},
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 1,
+                    "total_tokens": 11,
+                },
+            }
+        payload = json.dumps(body).encode("utf-8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def stub_server(request):
+    server = StubChatCompletionsServer(**getattr(request, "param", {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def build_lm(server: StubChatCompletionsServer, **kwargs) -> DSPyOpenAIMultiModalLM:
+    return DSPyOpenAIMultiModalLM(
+        api_key="stub",
+        api_base=f"http://127.0.0.1:{server.server_address[1]}",
+        **kwargs,
+    )
+
+
+def test_max_concurrency_caps_requests_in_flight(stub_server):
+    lm = build_lm(stub_server, max_concurrency=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        answers = list(executor.map(lm, [f"prompt {idx}" for idx in range(8)]))
+    assert answers == [["ok"]] * 8
+    assert stub_server.num_requests == 8
+    assert stub_server.max_in_flight == 2
+
+
+@pytest.mark.parametrize("stub_server", [{"num_failures": 2}], indirect=True)
+def test_retries_stay_within_max_concurrency(stub_server, monkeypatch):
+    monkeypatch.setattr(dspy_multi_modal, "get_backoff_delay", lambda attempt: 0.0)
+    lm = build_lm(stub_server, max_concurrency=1, max_retries=2)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        answers = list(executor.map(lm, [f"prompt {idx}" for idx in range(4)]))
+    assert answers == [["ok"]] * 4
+    assert stub_server.num_requests == 6
+    assert stub_server.max_in_flight == 1
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+import weave
+from stubs import TinyDiffusionPipeline
+
+from diffusion_prompt_upsampling.diffusion_model import StableDiffusionXLModel
+from diffusion_prompt_upsampling.sweep import SweepEvaluation
+from diffusion_prompt_upsampling.usage import BudgetExceededError
+
+
+class StubSweepModel:
+    """Stands in for `StableDiffusionXLModel.sweep`, without generating images."""
+
+    def sweep(self, rows, grid, chunk_size=None, trials=1):
+        rows = rows * trials
+        for num_inference_steps in grid["num_inference_steps"]:
+            yield (
+                {"num_inference_steps": num_inference_steps},
+                list(range(len(rows))),
+                [
+                    {"image": None, "upsampled_prompt": row["base_prompt"]}
+                    for row in rows
+                ],
+            )
+
+
+def test_sweep_scores_every_configuration():
+    @weave.op()
+    def prompt_length(upsampled_prompt: str, model_output: dict) -> dict:
+        return {"length": len(model_output["upsampled_prompt"])}
+
+    evaluation = weave.Evaluation(
+        dataset=[{"base_prompt": f"prompt {idx}"} for idx in range(8)],
+        scorers=[prompt_length],
+    )
+    sweep = SweepEvaluation(
+        evaluation, {"num_inference_steps": [1, 2]}, num_judge_workers=2
+    )
+    results = asyncio.run(sweep.evaluate(StubSweepModel()))
+    assert [result["config"] for result in results] == [
+        {"num_inference_steps": 1},
+        {"num_inference_steps": 2},
+    ]
+
+
+def test_failing_judges_stop_the_sweep():
+    # Every judge worker dies on its first row, which used to leave the sweep
+    # waiting forever on its bounded queue
+    @weave.op()
+    def over_budget(model_output: dict) -> dict:
+        raise BudgetExceededError("over budget")
+
+    evaluation = weave.Evaluation(
+        dataset=[{"base_prompt": f"prompt {idx}"} for idx in range(32)],
+        scorers=[over_budget],
+    )
+    sweep = SweepEvaluation(
+        evaluation,
+        {"num_inference_steps": [1, 2, 3]},
+        num_judge_workers=2,
+        queue_size=2,
+    )
+
+    async def evaluate():
+        return await asyncio.wait_for(sweep.evaluate(StubSweepModel()), timeout=30)
+
+    with pytest.raises(BudgetExceededError):
+        asyncio.run(evaluate())
+
+
+@pytest.mark.parametrize("seed", [None, 1234])
+def test_every_trial_gets_its_own_seed(seed):
+    model = StableDiffusionXLModel(
+        model_name_or_path="tiny-diffusion-pipeline", pipeline=TinyDiffusionPipeline()
+    )
+    row = {"base_prompt": "a cat", "num_inference_steps": 1, "image_size": 16}
+    if seed is not None:
+        row["seed"] = seed
+    results = list(model.sweep([row], {"guidance_scale": [1.0, 7.0]}, trials=2))
+
+    # The trials of a row start from different latents
+    images = [[output["image"] for output in outputs] for _, _, outputs in results]
+    assert [indices for _, indices, _ in results] == [[0, 1], [0, 1]]
+    assert images[0][0] != images[0][1]
+    assert model.get_seed("a cat", 0) != model.get_seed("a cat", 1)
@@ -0,0 +1,72 @@
+import logging
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from diffusion_prompt_upsampling.usage import BudgetExceededError, UsageTracker
+
+
+def send_request(
+    tracker: UsageTracker, prompt_tokens: int, completion_tokens: int
+) -> None:
+    with tracker.reserve("gpt-4o", prompt_tokens, completion_tokens):
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+        tracker.record("gpt-4o", "judge", usage, image_tokens=0)
+
+
+def test_stop_mode_raises_once_the_budget_is_spent():
+    tracker = UsageTracker(max_tokens=100)
+    send_request(tracker, 40, 20)
+    with pytest.raises(BudgetExceededError):
+        send_request(tracker, 40, 20)
+    # The evaluation runners check for a refused request after every row
+    with pytest.raises(BudgetExceededError):
+        tracker.raise_if_stopped()
+    assert tracker.summary()["by_stage"]["judge"]["total_tokens"] == 60
+
+
+def test_in_flight_requests_count_against_the_budget():
+    tracker = UsageTracker(max_tokens=100)
+    with tracker.reserve("gpt-4o", 40, 20):
+        with pytest.raises(BudgetExceededError):
+            send_request(tracker, 40, 20)
+
+
+def test_cost_budget_uses_model_prices():
+    tracker = UsageTracker(max_cost=1.0, prices={"gpt-4o": (1e6, 0.0)})
+    with pytest.raises(BudgetExceededError):
+        send_request(tracker, 2, 0)
+    send_request(tracker, 1, 10)
+    assert tracker.summary()["total"]["cost"] == 1.0
+
+
+def test_pause_mode_waits_for_the_window(caplog):
+    tracker = UsageTracker(
+        max_tokens=100, window_seconds=0.5, on_budget_exceeded="pause"
+    )
+    send_request(tracker, 40, 20)
+    start_time = time.time()
+    with caplog.at_level(logging.WARNING, logger="diffusion_prompt_upsampling.usage"):
+        send_request(tracker, 40, 20)
+    assert time.time() - start_time >= 0.4
+    assert "Usage budget reached, pausing" in caplog.text
+    assert tracker.stopped_error is None
+    assert tracker.summary()["total"]["num_requests"] == 2
+
+
+def test_pause_mode_stops_on_requests_larger_than_the_budget():
+    tracker = UsageTracker(
+        max_tokens=100, window_seconds=0.5, on_budget_exceeded="pause"
+    )
+    with pytest.raises(BudgetExceededError):
+        send_request(tracker, 100, 20)
+
+
+def test_budget_holds_across_trackers_sharing_a_log(tmp_path):
+    log_path = str(tmp_path / "usage.jsonl")
+    send_request(UsageTracker(max_tokens=100, log_path=log_path), 40, 20)
+    with pytest.raises(BudgetExceededError):
+        send_request(UsageTracker(max_tokens=100, log_path=log_path), 40, 20)